@@ -40,6 +40,7 @@ Usage:
     python cogsearch_main.py search_index baseballplayers aaronha01
     -
     python cogsearch_main.py vector_search_like baseballplayers aaronha01
+    python cogsearch_main.py vector_search_like baseballplayers aaronha01 --neighbors
     -
     python cogsearch_main.py lookup_doc baseballplayers eVBWc0FPdExvZzJYQXdBQUFBQUFBQT090
 """
@@ -53,7 +54,7 @@ import traceback
 
 from docopt import docopt
 
-from pysrc.cogbundle import Bytes, CogSearchClient, CogSvcsClient, Counter, Env, FS, OpenAIClient, Storage, System
+from pysrc.cogbundle import Bytes, CogSearchClient, CogSvcsClient, Counter, Env, FS, NeighborTable, OpenAIClient, Storage, System
 
 def print_options(msg):
     print(msg)
@@ -103,6 +104,9 @@ def load_json_file(infile):
 def searches_json_file():
     return 'cogsearch_searches.json'
 
+def wrangled_neighbors_file():
+    return '../data/wrangled/neighbors.bin'
+
 def vector_search_like(client, index_name, pid):
     # First do a lookup search for the given playerID
     lookup_name = f'lookup_{pid}'
@@ -137,6 +141,30 @@ def vector_search_like(client, index_name, pid):
                     resp_obj = json.loads(r.text)
                     print(json.dumps(resp_obj, sort_keys=False, indent=2))
 
+def vector_search_like_neighbors(client, index_name, pid):
+    # Read the precomputed neighbors of the player from the neighbor table file
+    # written by bb_wrangle.py build_neighbor_table, rather than searching by vector,
+    # then look up the player and neighbor documents with a playerID filter.
+    neighbors = NeighborTable(wrangled_neighbors_file()).lookup(pid, 9)
+    if neighbors is None:
+        print(f'player not found in neighbor table: {pid}')
+        return
+    result_pids = [pid] + [id for id, _ in neighbors]  # the player itself first, as with the vector search
+    lookup_params = {}
+    lookup_params['count'] = "true"
+    lookup_params['filter'] = "search.in(playerID, '{}', ',')".format(','.join(result_pids))
+    lookup_params['select'] = 'id,playerID,nameFirst,nameLast,primary_position'
+    lookup_params['top'] = len(result_pids)
+    r = client.search_index(index_name, f'neighbors_{pid}', lookup_params)
+    if r.status_code == 200:
+        docs = {doc['playerID']: doc for doc in json.loads(r.text).get('value', [])}
+        for seq, id in enumerate(result_pids, start=1):
+            doc = docs.get(id, {})
+            print('result {}: {} {} {} {}'.format(
+                seq, id, doc.get('nameFirst'), doc.get('nameLast'), doc.get('primary_position')))
+    else:
+        print(f'lookup search failed for players: {result_pids} {r.status_code}')
+
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -256,7 +284,10 @@ if __name__ == "__main__":
 
         elif func == 'vector_search_like':
             index_name, pid = sys.argv[2], sys.argv[3]
-            vector_search_like(client, index_name, pid)
+            if Env.boolean_arg('--neighbors'):
+                vector_search_like_neighbors(client, index_name, pid)
+            else:
+                vector_search_like(client, index_name, pid)
 
         elif func == 'create_searches_json':
             create_searches_json()
@@ -21,7 +21,7 @@ import uuid
 
 from docopt import docopt
 
-from pysrc.nosqlbundle import Bytes, Cosmos, Counter, Env, FS, OpenAIClient, Storage, System
+from pysrc.nosqlbundle import Bytes, Cosmos, Counter, EmbeddingStore, Env, FS, OpenAIClient, Storage, System
 
 import matplotlib
 import openai
@@ -45,8 +45,11 @@ def check_env():
     print('AZURE_COSMOSDB_NOSQL_URI:     {}'.format(Env.var('AZURE_COSMOSDB_NOSQL_URI')))
     print('AZURE_COSMOSDB_NOSQL_RW_KEY1: {}'.format(Env.var('AZURE_COSMOSDB_NOSQL_RW_KEY1')))
 
+def wrangled_documents_file():
+    return '../data/wrangled/documents.jsonl'
+
 def wrangled_embeddings_file():
-    return '../data/wrangled/documents_with_embeddings.json'
+    return '../data/wrangled/embeddings.f32'
 
 def load_nosql_baseballplayers():
     opts = dict()
@@ -56,13 +59,15 @@ def load_nosql_baseballplayers():
     c.set_db('dev')
     c.set_container('baseballplayers')
 
-    documents = FS.read_json(wrangled_embeddings_file())
-    player_ids = sorted(documents.keys())
-
-    for idx, pid in enumerate(player_ids):
+    # the documents file is sorted by playerID, and is read one line at a time;
+    # the embeddings are memory-mapped from the binary embedding store.
+    store = EmbeddingStore(wrangled_embeddings_file())
+    for idx, doc in enumerate(FS.read_jsonl(wrangled_documents_file())):
         try:
-            doc = documents[pid]
-            embeddings = doc['embeddings']
+            pid = doc['playerID']
+            embeddings = store.vector(pid)
+            embeddings = [] if embeddings is None else embeddings.tolist()
+            doc['embeddings'] = embeddings
             if idx < 100_000:
                 if len(embeddings) == EXPECTED_EMBEDDINGS_ARRAY_LENGTH:
                     id = str(uuid.uuid4())
@@ -9,6 +9,7 @@ Usage:
   -
   python main.py search_similar_baseball_players <envname> <dbname> <player-id>
   python main.py search_similar_baseball_players cosmos citus aaronha01
+  python main.py search_similar_baseball_players cosmos citus aaronha01 --neighbors
 Options:
   -h --help     Show this screen.
   --version     Show version.
@@ -26,7 +27,7 @@ from docopt import docopt
 import psycopg2
 from psycopg2 import pool
 
-from pysrc.minbundle import Bytes, Counter, Env, FS, Storage, System
+from pysrc.minbundle import Bytes, Counter, EmbeddingStore, Env, FS, NeighborTable, Storage, System
 
 EXPECTED_EMBEDDINGS_ARRAY_LENGTH = 1536
 
@@ -147,13 +148,14 @@ def load_baseball_players(envname, dbname):
         columns_tup = str(tuple(columns_list)).replace("'",'')
 
         print('reading the wrangled_embeddings_file...')
-        documents = FS.read_json(wrangled_embeddings_file())
-        player_ids = sorted(documents.keys())
-
-        for idx, pid in enumerate(player_ids):
+        # the documents file is sorted by playerID, and is read one line at a time;
+        # the embeddings are memory-mapped from the binary embedding store.
+        store = EmbeddingStore(wrangled_embeddings_file())
+        for idx, doc in enumerate(FS.read_jsonl(wrangled_documents_file())):
             try:
-                doc = documents[pid]
-                embeddings = doc['embeddings']
+                embeddings = store.vector(doc['playerID'])
+                embeddings = [] if embeddings is None else embeddings.tolist()
+                doc['embeddings'] = embeddings
                 if idx < 100_000:
                     if len(embeddings) == EXPECTED_EMBEDDINGS_ARRAY_LENGTH:
                         id = idx + 1
@@ -228,6 +230,46 @@ def search_similar_baseball_players(envname, dbname, player_id):
         if client != None:
             client.close()
 
+def search_similar_baseball_players_neighbors(envname, dbname, player_id):
+    # Read the precomputed neighbors of the player from the neighbor table file
+    # written by bb_wrangle.py build_neighbor_table, rather than searching by vector,
+    # then select the player and neighbor rows by player_id.
+    print(f'search_similar_baseball_players_neighbors: {envname} {dbname} {player_id}')
+    neighbors = NeighborTable(wrangled_neighbors_file()).lookup(player_id, 9)
+    if neighbors is None:
+        print(f'player not found in neighbor table: {player_id}')
+        return
+    result_ids = [player_id] + [pid for pid, _ in neighbors]  # the player itself first, as with the vector query
+    client = None
+    try:
+        client = PostgreSqlClient(envname, dbname)
+        cursor = client.get_cursor()
+        cursor.execute(neighbors_query_sql(), (result_ids,))
+        rows = {row[0]: row for row in cursor.fetchall()}
+        for row_idx, pid in enumerate(result_ids):
+            seq = row_idx + 1
+            if pid in rows:
+                row = rows[pid]
+                first_name = row[1]
+                last_name = row[2]
+                position = row[5]
+                print(f'result {seq}: {pid} {first_name} {last_name} {position}')
+            else:
+                print(f'result {seq}: {pid} not in players table')
+    except Exception as excp:
+        print(str(excp))
+        print(traceback.format_exc())
+    finally:
+        if client != None:
+            client.close()
+
+def neighbors_query_sql():
+    return """
+select player_id, first_name, last_name, bats, throws, primary_position, batting_data
+from players
+where player_id = ANY(%s);
+    """.strip()
+
 def vector_query_sql(embeddings):
     return """
 select player_id, first_name, last_name, bats, throws, primary_position, batting_data
@@ -236,8 +278,14 @@ order by embeddings <-> '{}'
 limit 10;
     """.format(embeddings).strip()
 
+def wrangled_documents_file():
+    return '../data/wrangled/documents.jsonl'
+
 def wrangled_embeddings_file():
-    return '../data/wrangled/documents_with_embeddings.json'
+    return '../data/wrangled/embeddings.f32'
+
+def wrangled_neighbors_file():
+    return '../data/wrangled/neighbors.bin'
 
 def get_jsonb_value(doc, key):
     if key in doc.keys():
@@ -261,6 +309,9 @@ if __name__ == "__main__":
             load_baseball_players(envname, dbname)
         elif func == 'search_similar_baseball_players':
             envname, dbname, player_id = sys.argv[2], sys.argv[3], sys.argv[4]
-            search_similar_baseball_players(envname, dbname, player_id)
+            if Env.boolean_arg('--neighbors'):
+                search_similar_baseball_players_neighbors(envname, dbname, player_id)
+            else:
+                search_similar_baseball_players(envname, dbname, player_id)
         else:
             print_options('Error: invalid function: {}'.format(func))
@@ -10,6 +10,7 @@ Usage:
   python main.py search_player_like blombro01
   python main.py search_player_like guidrro01
   python main.py search_player_like rosepe01
+  python main.py search_player_like aaronha01 --neighbors
   python main.py random_player_search
 Options:
   -h --help     Show this screen.
@@ -29,7 +30,7 @@ import uuid
 
 from docopt import docopt
 
-from pysrc.mongobundle import Bytes, Counter, Env, FS, Mongo, OpenAIClient, Storage, System, Template
+from pysrc.mongobundle import Bytes, Counter, EmbeddingStore, Env, FS, Mongo, NeighborTable, OpenAIClient, Storage, System, Template
 
 import matplotlib
 import openai
@@ -52,8 +53,14 @@ def print_options(msg):
 def check_env():
     print('AZURE_COSMOSDB_MONGO_VCORE_CONN_STR: {}'.format(Env.var('AZURE_COSMOSDB_MONGO_VCORE_CONN_STR')))
 
+def wrangled_documents_file():
+    return '../data/wrangled/documents.jsonl'
+
 def wrangled_embeddings_file():
-    return '../data/wrangled/documents_with_embeddings.json'
+    return '../data/wrangled/embeddings.f32'
+
+def wrangled_neighbors_file():
+    return '../data/wrangled/neighbors.bin'
 
 def load_vcore_baseball_players():
     opts = dict()
@@ -65,13 +72,15 @@ def load_vcore_baseball_players():
     count = m.count_docs({})
     print('document count in db: {}, collection: {} = {}'.format(dbname, cname, count))
     
-    documents = FS.read_json(wrangled_embeddings_file())
-    player_ids = sorted(documents.keys())
-
-    for idx, pid in enumerate(player_ids):
+    # the documents file is sorted by playerID, and is read one line at a time;
+    # the embeddings are memory-mapped from the binary embedding store.
+    store = EmbeddingStore(wrangled_embeddings_file())
+    for idx, doc in enumerate(FS.read_jsonl(wrangled_documents_file())):
         try:
-            doc = documents[pid]
-            embeddings = doc['embeddings']
+            pid = doc['playerID']
+            embeddings = store.vector(pid)
+            embeddings = [] if embeddings is None else embeddings.tolist()
+            doc['embeddings'] = embeddings
             if idx < 100_000:
                 if len(embeddings) == EXPECTED_EMBEDDINGS_ARRAY_LENGTH:
                     id = str(uuid.uuid4())
@@ -180,11 +189,55 @@ def search_player_like(pid):
     print('result_count: {}'.format(result_count))
     FS.write_json(output_doc, outfile) 
 
+def search_player_like_neighbors(pid):
+    # Read the precomputed neighbors of the player from the neighbor table file
+    # written by bb_wrangle.py build_neighbor_table, rather than searching by vector,
+    # then read the player and neighbor documents by playerID.
+    outfile = 'tmp/search_player_like_{}.json'.format(pid)
+    table = NeighborTable(wrangled_neighbors_file())
+    neighbors = table.lookup(pid, 9)
+    print('===')
+    print(f'searching for: {pid}')
+    if neighbors is None:
+        print(f'player not found in neighbor table: {pid}')
+        return
+    scores = {pid: 1.0}  # the player itself is the first result, as with the vector search
+    scores.update(dict(neighbors))
+    result_pids = [pid] + [id for id, _ in neighbors]
+
+    opts = dict()
+    opts['conn_string'] = Env.var('AZURE_COSMOSDB_MONGO_VCORE_CONN_STR')
+    dbname, cname = 'dev', 'baseball_players'
+    m = Mongo(opts)
+    m.set_db(dbname)
+    m.set_coll(cname)
+    docs = dict()
+    for doc in m.find({'playerID': {'$in': result_pids}}):
+        doc['_id'] = str(doc['_id'])  # an ObjectId is not JSON serializable
+        doc['embeddings'] = 'removed'
+        docs[doc['playerID']] = doc
+
+    output_doc = {}
+    output_doc['pid'] = pid
+    output_doc['player'] = docs.get(pid, {'playerID': pid})
+    output_doc['pipeline'] = {'neighbor_table': {'k': len(result_pids), 'path': wrangled_neighbors_file()}}
+    output_doc['results'] = []
+    player = output_doc['player']
+    print('found player: {} {} {} {}'.format(
+        pid, player.get('nameFirst'), player.get('nameLast'), player.get('primary_position')))
+    for result_count, id in enumerate(result_pids, start=1):
+        result_doc = dict(docs.get(id, {'playerID': id}))
+        result_doc['score'] = scores[id]
+        print('result {}: {} {} {} {}'.format(result_count, id,
+            result_doc.get('nameFirst'), result_doc.get('nameLast'), result_doc.get('primary_position')))
+        output_doc['results'].append(result_doc)
+    print('result_count: {}'.format(len(result_pids)))
+    FS.write_json(output_doc, outfile)
+
 def random_player_search():
     print('===')
     print('random_player_search...')
-    documents = FS.read_json(wrangled_embeddings_file())
-    player_ids = sorted(documents.keys())
+    player_ids = EmbeddingStore(wrangled_embeddings_file()).ids
     random_pid = random.choice(player_ids)
     print('random_pid: {}'.format(random_pid))
     search_player_like(random_pid)
@@ -202,7 +255,10 @@ if __name__ == "__main__":
                 random_player_search()
             elif func == 'search_player_like':
                 pid = sys.argv[2]
-                search_player_like(pid)
+                if Env.boolean_arg('--neighbors'):
+                    search_player_like_neighbors(pid)
+                else:
+                    search_player_like(pid)
             else:
                 print_options('Error: invalid function: {}'.format(func))
         except Exception as e:
@@ -3,7 +3,7 @@ Module mongobundle.py - bundled standard codebase.
 Copyright (c) 2023 Chris Joakim, MIT License
 Timestamp: 2023-07-28 16:46
 
-Usage:  from pysrc.mongobundle import Bytes, Counter, Env, FS, Mongo, OpenAIClient, Storage, System, Template
+Usage:  from pysrc.mongobundle import Bytes, Counter, EmbeddingStore, EmbeddingStoreWriter, Env, FS, Mongo, NeighborTable, OpenAIClient, Storage, System, Template
 """
 
 import csv
@@ -11,6 +11,7 @@ import json
 import os
 import platform
 import socket
+import struct
 import sys
 import time
 import traceback
@@ -18,6 +19,7 @@ import traceback
 import certifi
 import jinja2
 import matplotlib
+import numpy as np
 import openai
 import pandas as pd
 import psutil
@@ -25,7 +27,7 @@ import requests
 import tiktoken
 
 from numbers import Number
-from typing import Iterator
+from typing import Iterable, Iterator
 
 from azure.storage.blob import BlobServiceClient
 from bson.objectid import ObjectId
@@ -167,6 +169,214 @@ class Counter():
         return self.data
 # ==============================================================================
 
+class EmbeddingStore():
+    """
+    A float32 matrix of embeddings in a binary file, one row per document,
+    after a 64-byte header with the dims, row count, and embedding model.
+    The sidecar '<file>.ids' text file has the document id of each row.
+    The matrix is opened with numpy.memmap, so vectors are read zero-copy
+    from the page cache rather than parsed from JSON text.
+    """
+    MAGIC = b'EMBSTORE'
+    VERSION = 1
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sIIQ40s'  # magic, version, dims, count, model
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(file=path, mode='rb') as file:
+            header = file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise ValueError(f'truncated embedding store header: {path}')
+        magic, version, dims, count, model = struct.unpack(self.HEADER_FORMAT, header)
+        if magic != self.MAGIC:
+            raise ValueError(f'not an embedding store file: {path}')
+        if version != self.VERSION:
+            raise ValueError(f'unsupported embedding store version {version}: {path}')
+        self.dims = dims
+        self.count = count
+        self.model = model.rstrip(b'\0').decode('utf-8')
+        if count > 0:
+            self.matrix = np.memmap(path, dtype='<f4', mode='r',
+                offset=self.HEADER_SIZE, shape=(count, dims))
+        else:
+            self.matrix = np.zeros((0, dims), dtype='<f4')
+        with open(file=self.ids_file(path), encoding='utf-8', mode='rt') as file:
+            self.ids = [line.strip() for line in file if len(line.strip()) > 0]
+        if len(self.ids) != count:
+            raise ValueError(f'embedding store has {count} rows but {len(self.ids)} ids: {path}')
+        self.rows = {id: idx for idx, id in enumerate(self.ids)}
+
+    @classmethod
+    def ids_file(cls, path: str) -> str:
+        return f'{path}.ids'
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.isfile(path) and os.path.isfile(cls.ids_file(path))
+
+    @classmethod
+    def writer(cls, path: str, dims: int, model: str) -> 'EmbeddingStoreWriter':
+        return EmbeddingStoreWriter(path, dims, model)
+
+    def row(self, id: str) -> int | None:
+        """ Return the matrix row index of the given document id, or None. """
+        return self.rows.get(id)
+
+    def vector(self, id: str) -> np.ndarray | None:
+        """ Return the read-only, memory-mapped vector of the given document id, or None. """
+        idx = self.rows.get(id)
+        if idx is None:
+            return None
+        return self.matrix[idx]
+
+    def close(self) -> None:
+        """ Release the memory map; vectors returned by vector() are invalid after this. """
+        if isinstance(self.matrix, np.memmap):
+            self.matrix._mmap.close()
+        self.matrix = None
+
+
+class EmbeddingStoreWriter():
+    """
+    Appends vectors to a new EmbeddingStore file.  The file and its ids file
+    are written under temporary names, and are renamed into place, with the
+    final row count in the header, by close().  Use as a context manager.
+    """
+    def __init__(self, path: str, dims: int, model: str):
+        self.path = path
+        self.dims = dims
+        self.model = model
+        self.ids = []
+        self.tmp_file = f'{path}.{os.getpid()}.tmp'
+        self.file = open(file=self.tmp_file, mode='wb')
+        self.file.write(self.header(0))
+
+    def header(self, count: int) -> bytes:
+        model = self.model.encode('utf-8')[:40]
+        return struct.pack(EmbeddingStore.HEADER_FORMAT,
+            EmbeddingStore.MAGIC, EmbeddingStore.VERSION, self.dims, count, model)
+
+    def add(self, id: str, vector) -> bool:
+        """ Append the given vector; return False, and skip it, if it has the wrong dims. """
+        values = np.asarray(vector, dtype='<f4')
+        if values.shape != (self.dims,):
+            return False
+        self.file.write(values.tobytes())
+        self.ids.append(id)
+        return True
+
+    def close(self) -> None:
+        self.file.seek(0)
+        self.file.write(self.header(len(self.ids)))
+        self.file.close()
+        ids_tmp_file = f'{EmbeddingStore.ids_file(self.path)}.{os.getpid()}.tmp'
+        with open(file=ids_tmp_file, encoding='utf-8', mode='w') as file:
+            for id in self.ids:
+                file.write(id + "\n")
+        os.replace(self.tmp_file, self.path)
+        os.replace(ids_tmp_file, EmbeddingStore.ids_file(self.path))
+
+    def abort(self) -> None:
+        """ Discard the vectors written so far, leaving any existing store as it was. """
+        self.file.close()
+        os.remove(self.tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# ==============================================================================
+
+class NeighborTable():
+    """
+    The precomputed k nearest neighbors of every document in a binary file,
+    after a 64-byte header with k, the row count, and the embedding model:
+    a (count, k) int32 matrix of neighbor row indexes, nearest first, then a
+    (count, k) float16 matrix of their cosine similarities.  The sidecar
+    '<file>.ids' text file has the document id of each row.  The matrices
+    are opened with numpy.memmap, so a lookup reads one row of each.
+    """
+    MAGIC = b'NBRTABLE'
+    VERSION = 1
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sIIQ40s'  # magic, version, k, count, model
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(file=path, mode='rb') as file:
+            header = file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise ValueError(f'truncated neighbor table header: {path}')
+        magic, version, k, count, model = struct.unpack(self.HEADER_FORMAT, header)
+        if magic != self.MAGIC:
+            raise ValueError(f'not a neighbor table file: {path}')
+        if version != self.VERSION:
+            raise ValueError(f'unsupported neighbor table version {version}: {path}')
+        self.k = k
+        self.count = count
+        self.model = model.rstrip(b'\0').decode('utf-8')
+        if count > 0 and k > 0:
+            self.neighbors = np.memmap(path, dtype='<i4', mode='r',
+                offset=self.HEADER_SIZE, shape=(count, k))
+            self.scores = np.memmap(path, dtype='<f2', mode='r',
+                offset=self.HEADER_SIZE + count * k * 4, shape=(count, k))
+        else:
+            self.neighbors = np.zeros((count, k), dtype='<i4')
+            self.scores = np.zeros((count, k), dtype='<f2')
+        with open(file=self.ids_file(path), encoding='utf-8', mode='rt') as file:
+            self.ids = [line.strip() for line in file if len(line.strip()) > 0]
+        if len(self.ids) != count:
+            raise ValueError(f'neighbor table has {count} rows but {len(self.ids)} ids: {path}')
+        self.rows = {id: idx for idx, id in enumerate(self.ids)}
+
+    @classmethod
+    def ids_file(cls, path: str) -> str:
+        return f'{path}.ids'
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.isfile(path) and os.path.isfile(cls.ids_file(path))
+
+    @classmethod
+    def write(cls, path: str, ids: list[str], neighbors: np.ndarray, scores: np.ndarray, model: str) -> None:
+        """ Write a neighbor table file, and its ids file, under temporary names renamed into place. """
+        count, k = neighbors.shape
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(file=tmp_file, mode='wb') as file:
+            file.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION, k, count, model.encode('utf-8')[:40]))
+            file.write(np.ascontiguousarray(neighbors, dtype='<i4').tobytes())
+            file.write(np.ascontiguousarray(scores, dtype='<f2').tobytes())
+        ids_tmp_file = f'{cls.ids_file(path)}.{os.getpid()}.tmp'
+        with open(file=ids_tmp_file, encoding='utf-8', mode='w') as file:
+            for id in ids:
+                file.write(id + "\n")
+        os.replace(tmp_file, path)
+        os.replace(ids_tmp_file, cls.ids_file(path))
+
+    def lookup(self, id: str, k: int = None) -> list[tuple[str, float]] | None:
+        """ Return the ids and similarities of the k nearest neighbors of the given document id, or None. """
+        idx = self.rows.get(id)
+        if idx is None:
+            return None
+        k = self.k if k is None else min(k, self.k)
+        return [(self.ids[n], float(s)) for n, s in zip(self.neighbors[idx, :k].tolist(), self.scores[idx, :k].tolist())]
+
+    def close(self) -> None:
+        """ Release the memory maps. """
+        for matrix in (self.neighbors, self.scores):
+            if isinstance(matrix, np.memmap):
+                matrix._mmap.close()
+        self.neighbors = self.scores = None
+
+# ==============================================================================
+
 class Env():
     """
     This class is used to read the host environment, such as username and
@@ -355,6 +565,36 @@ class FS():
                 if verbose is True:
                     print(f'file written: {outfile}')
 
+    @classmethod
+    def read_jsonl(cls, infile: str) -> Iterator[dict] | None:
+        """
+        Return a generator of the objects in the given JSON Lines file, parsed
+        one line at a time so that the whole file is never held in memory.
+        """
+        if os.path.isfile(infile):
+            with open(file=infile, encoding='utf-8', mode='rt') as file:
+                for line in file:
+                    if len(line.strip()) > 0:
+                        yield json.loads(line)
+
+    @classmethod
+    def write_jsonl(cls, objects: Iterable, outfile: str, verbose=True) -> int:
+        """
+        Write each of the given objects, which may be a generator, to the given
+        file as one line of JSON.  The file is written under a temporary name
+        and renamed when complete.  Return the number of objects written.
+        """
+        count, tmp_file = 0, f'{outfile}.{os.getpid()}.tmp'
+        with open(file=tmp_file, encoding='utf-8', mode='w') as file:
+            for obj in objects:
+                file.write(json.dumps(obj))
+                file.write("\n")
+                count += 1
+        os.replace(tmp_file, outfile)
+        if verbose is True:
+            print(f'file written: {outfile}, lines: {count}')
+        return count
+
     @classmethod
     def text_file_iterator(cls, infile: str) -> Iterator[str] | None:
         """ Return a line generator that can be iterated with iterate() """
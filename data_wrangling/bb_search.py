@@ -0,0 +1,537 @@
+"""
+Usage:
+  python bb_search.py <func>
+  python bb_search.py search_player_like <player_id>
+  python bb_search.py search_player_like aaronha01
+  python bb_search.py search_player_like henderi01 20
+  python bb_search.py search_players_like aaronha01 jeterde01 guidrro01
+  python bb_search.py search_player_like aaronha01 --neighbors
+  python bb_search.py random_player_search
+  python bb_search.py build_ivf_index
+  python bb_search.py build_ivf_index 200
+  python bb_search.py ivf_search_player_like aaronha01 4
+  python bb_search.py ivf_search_player_like aaronha01 8 200
+  python bb_search.py ivf_sweep
+  python bb_search.py build_hnsw_index
+  python bb_search.py build_hnsw_index 32 128
+  python bb_search.py hnsw_search_player_like aaronha01 80
+  python bb_search.py hnsw_search_player_like aaronha01 80 32 128
+  python bb_search.py hnsw_report
+  python bb_search.py hnsw_report 32 128
+  python bb_search.py create_benchmark_queries
+  python bb_search.py create_benchmark_queries 1000
+  python bb_search.py benchmark
+  python bb_search.py benchmark exact ivf hnsw vcore pg cogsearch
+  python bb_search.py benchmark exact table
+  python bb_search.py benchmark exact ivf:200:8 ivf:50:2
+  python bb_search.py benchmark exact hnsw:32:128 hnsw:32:128:80
+Options:
+  -h --help     Show this screen.
+  --version     Show version.
+"""
+
+# Search the vectorized baseball players locally, with no database or
+# network, using the embeddings written by bb_wrangle.py.
+# Chris Joakim, Microsoft, 2023
+
+import json
+import os
+import random
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from docopt import docopt
+
+from pysrc.aibundle import CogSearchClient, EmbeddingStore, Env, FS, NeighborTable
+from pysrc.hnswindex import HNSWIndex
+from pysrc.ivfindex import IVFIndex
+from pysrc.searchbenchmark import CogSearchBackend, LocalBackend, NeighborTableBackend, PGBackend, SearchBenchmark, \
+    VCoreBackend, latency_summary
+from pysrc.vectorsearch import ExactIndex
+
+SEARCH_K = 10
+
+# like the vector-ivf index in cosmos_vcore/mongo/baseball_players_create_indexes.txt
+IVF_NUM_LISTS = 100
+IVF_NPROBE = 4
+IVF_SWEEP_LISTS = [25, 50, 100, 200]
+IVF_SWEEP_NPROBES = [1, 2, 4, 8, 16, 32]
+# the pgvector hnsw defaults
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 64
+HNSW_EF_SEARCH = 40
+HNSW_REPORT_EF_SEARCH = [10, 20, 40, 80, 160, 320]
+SWEEP_QUERIES = 500
+SWEEP_SEED = 42
+
+# the players of the searches.sh scripts, and a seeded sample of the others
+BENCHMARK_PLAYERS = ['aaronha01', 'jeterde01', 'henderi01', 'blombro01', 'guidrro01', 'rosepe01']
+BENCHMARK_QUERIES = 200
+BENCHMARK_BACKENDS = ['exact', 'ivf', 'hnsw']
+
+
+def print_options(msg):
+    print(msg)
+    arguments = docopt(__doc__, version='1.0.0')
+    print(arguments)
+
+def documents_file():
+    return '../data/wrangled/documents.jsonl'
+
+def embeddings_file():
+    return '../data/wrangled/embeddings.f32'
+
+def ivf_index_file(num_lists):
+    return 'tmp/indexes/ivf_{}.npz'.format(num_lists)
+
+def hnsw_index_file(m, ef_construction):
+    return 'tmp/indexes/hnsw_{}_{}.bin'.format(m, ef_construction)
+
+def neighbor_table_file():
+    return '../data/wrangled/neighbors.bin'
+
+def benchmark_queries_file():
+    return 'tmp/benchmark_queries.txt'
+
+def load_index() -> ExactIndex:
+    t1 = time.perf_counter()
+    index = ExactIndex.from_store(EmbeddingStore(embeddings_file()))
+    print('loaded {} vectors of {} dims in {:.3f}s'.format(index.count, index.dims, time.perf_counter() - t1))
+    return index
+
+def read_players(pids: set) -> dict:
+    """ Return the documents of the given playerIDs, keyed by playerID. """
+    players = {}
+    for doc in FS.read_jsonl(documents_file()):
+        if doc['playerID'] in pids:
+            players[doc['playerID']] = doc
+    return players
+
+def load_ivf_index(num_lists=IVF_NUM_LISTS) -> IVFIndex:
+    infile = ivf_index_file(num_lists)
+    if not os.path.exists(infile):
+        return build_ivf_index(num_lists)
+    t1 = time.perf_counter()
+    ivf = IVFIndex.load(infile)
+    print('loaded {} in {:.3f}s'.format(infile, time.perf_counter() - t1))
+    return ivf
+
+def load_hnsw_index(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION) -> HNSWIndex:
+    infile = hnsw_index_file(m, ef_construction)
+    if not os.path.exists(infile):
+        return build_hnsw_index(m, ef_construction)
+    t1 = time.perf_counter()
+    hnsw = HNSWIndex.load(infile)
+    print('loaded {} in {:.3f}s'.format(infile, time.perf_counter() - t1))
+    return hnsw
+
+def local_search(index: ExactIndex, method: str, rows: np.ndarray, k: int, setting: int = None,
+                 num_lists=IVF_NUM_LISTS, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    """
+    Search for the k vectors most similar to each of the given rows with the
+    given method: 'exact', 'ivf' with num_lists lists probing setting lists,
+    'hnsw' built with m and ef_construction with an efSearch of setting, or 'table' to read the precomputed neighbors of each row from
+    the NeighborTable built by bb_wrangle.py.  Return the row indexes, the
+    scores, and a description of the search.
+    """
+    queries = index.matrix[rows]
+    if method == 'table':
+        table = NeighborTable(neighbor_table_file())
+        indexes = np.full((len(rows), k), -1, dtype=np.int64)
+        scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+        for q, row in enumerate(rows.tolist()):
+            # the player itself is the first result, as with the vector searches
+            found = [(index.ids[row], 1.0)] + (table.lookup(index.ids[row], k - 1) or [])
+            found = [(index.row(id), score) for id, score in found if index.row(id) is not None]
+            indexes[q, :len(found)] = [idx for idx, _ in found]
+            scores[q, :len(found)] = [score for _, score in found]
+        return indexes, scores, {'neighbor_table': {'k': k, 'path': neighbor_table_file()}}
+    if method == 'ivf':
+        ivf = load_ivf_index(num_lists)
+        nprobe = setting or IVF_NPROBE
+        indexes, scores = ivf.search(queries, k, nprobe)
+        return indexes, scores, {'local_ivf': {'k': k, 'numLists': ivf.num_lists, 'nprobe': nprobe,
+                                               'path': ivf_index_file(ivf.num_lists)}}
+    if method == 'hnsw':
+        hnsw = load_hnsw_index(m, ef_construction)
+        ef_search = setting or HNSW_EF_SEARCH
+        indexes, scores = hnsw.search(queries, k, ef_search)
+        # the hnsw rows are in the order of the embeddings store, as with the exact index
+        return indexes, scores, {'local_hnsw': {'k': k, 'm': hnsw.m, 'efConstruction': hnsw.ef_construction,
+                                                'efSearch': ef_search, 'path': hnsw_index_file(hnsw.m, hnsw.ef_construction)}}
+    indexes, scores = index.search(queries, k)
+    return indexes, scores, {'local_exact': {'k': k, 'path': embeddings_file()}}
+
+def search_player_like(pid, k=SEARCH_K):
+    search_players_like([pid], k)
+
+def search_players_like(pids: list[str], k=SEARCH_K, method='exact', setting=None, num_lists=IVF_NUM_LISTS,
+                        m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    """
+    Search for the k players most similar to each of the given players, with
+    all of the query vectors in one batch, and write the results of each in
+    the same form as the search_player_like function of cosmos_vcore/main.py,
+    to file tmp/search_player_like_<pid>.json.  The search is exact, or uses
+    the persisted IVF or HNSW index; see local_search.
+    """
+    index = load_index()
+    rows = [index.row(pid) for pid in pids]
+    for pid, row in zip(pids, rows):
+        if row is None:
+            print(f'player not found: {pid}')
+    pids = [pid for pid, row in zip(pids, rows) if row is not None]
+    rows = np.array([row for row in rows if row is not None], dtype=np.int64)
+    if len(rows) == 0:
+        return
+    t1 = time.perf_counter()
+    indexes, scores, pipeline = local_search(index, method, rows, k, setting, num_lists, m, ef_construction)
+    seconds = time.perf_counter() - t1
+    print('searched {} queries in {:.3f}ms'.format(len(rows), seconds * 1000.0))
+    result_pids = set(pids)
+    for result_rows in indexes.tolist():
+        result_pids.update([index.ids[idx] for idx in result_rows if idx >= 0])
+    players = read_players(result_pids)
+
+    os.makedirs('tmp', exist_ok=True)
+    for pid, result_rows, result_scores in zip(pids, indexes.tolist(), scores.tolist()):
+        output_doc = {}
+        output_doc['pid'] = pid
+        output_doc['player'] = dict(players.get(pid, {'playerID': pid}))
+        output_doc['pipeline'] = pipeline
+        output_doc['results'] = []
+        player = output_doc['player']
+        print('===')
+        print(f'searching for: {pid}')
+        print('found player: {} {} {} {}'.format(
+            pid, player.get('nameFirst'), player.get('nameLast'), player.get('primary_position')))
+        found = [(idx, score) for idx, score in zip(result_rows, result_scores) if idx >= 0]
+        for result_count, (idx, score) in enumerate(found, start=1):
+            result_doc = dict(players.get(index.ids[idx], {'playerID': index.ids[idx]}))
+            result_doc['score'] = score
+            print('result {}: {} {} {} {} {:.6f}'.format(result_count, result_doc['playerID'],
+                result_doc.get('nameFirst'), result_doc.get('nameLast'), result_doc.get('primary_position'), score))
+            output_doc['results'].append(result_doc)
+        # like the vCore output, without the embeddings
+        output_doc['player']['embeddings'] = 'removed'
+        for result_doc in output_doc['results']:
+            result_doc['embeddings'] = 'removed'
+        print('result_count: {}'.format(len(output_doc['results'])))
+        FS.write_json(output_doc, 'tmp/search_player_like_{}.json'.format(pid))
+
+def random_player_search():
+    print('===')
+    print('random_player_search...')
+    player_ids = EmbeddingStore(embeddings_file()).ids
+    random_pid = random.choice(player_ids)
+    print('random_pid: {}'.format(random_pid))
+    search_player_like(random_pid)
+
+def build_ivf_index(num_lists=IVF_NUM_LISTS) -> IVFIndex:
+    """
+    Build an IVF index of the embeddings with the given number of lists, like
+    the vCore vector-ivf index, and save it to file tmp/indexes/ivf_<num_lists>.npz.
+    """
+    print('=== build_ivf_index')
+    store = EmbeddingStore(embeddings_file())
+    t1 = time.perf_counter()
+    ivf = IVFIndex.build(store.matrix, store.ids, num_lists)
+    seconds = time.perf_counter() - t1
+    sizes = ivf.list_sizes()
+    print('built {} lists of {} vectors in {:.3f}s; list sizes min {} mean {:.1f} max {}'.format(
+        ivf.num_lists, ivf.count, seconds, sizes.min(), sizes.mean(), sizes.max()))
+    os.makedirs('tmp/indexes', exist_ok=True)
+    outfile = ivf_index_file(num_lists)
+    ivf.save(outfile)
+    print('file written: {} {:.1f} MB'.format(outfile, os.path.getsize(outfile) / (1024 * 1024)))
+    return ivf
+
+def ivf_sweep(k=SEARCH_K):
+    """
+    Measure the recall@k and queries per second of IVF indexes with each of
+    the IVF_SWEEP_LISTS numbers of lists, probing each of the IVF_SWEEP_NPROBES
+    numbers of lists, for a seeded sample of players.  The recall is the
+    fraction of the exact k nearest neighbors which the IVF search also finds.
+    The queries are searched one at a time, as the apps do.  The report is
+    written to file tmp/ivf_sweep_report.json.
+    """
+    print('=== ivf_sweep')
+    index = load_index()
+    rng = np.random.default_rng(SWEEP_SEED)
+    rows = np.sort(rng.choice(index.count, size=min(SWEEP_QUERIES, index.count), replace=False))
+    queries = index.matrix[rows]
+    truth, _ = index.search(queries, k)
+    t1 = time.perf_counter()
+    for query in queries:
+        index.search(query, k)
+    exact_qps = len(queries) / (time.perf_counter() - t1)
+    print('exact: {:.1f} queries/sec'.format(exact_qps))
+
+    report = {}
+    report['k'] = k
+    report['queries'] = len(queries)
+    report['vectors'] = index.count
+    report['dims'] = index.dims
+    report['exact_queries_per_sec'] = exact_qps
+    report['indexes'] = []
+    for num_lists in IVF_SWEEP_LISTS:
+        t1 = time.perf_counter()
+        ivf = IVFIndex.build(index.matrix, index.ids, num_lists)
+        build_seconds = time.perf_counter() - t1
+        sizes = ivf.list_sizes()
+        index_report = {}
+        index_report['num_lists'] = ivf.num_lists
+        index_report['build_seconds'] = build_seconds
+        index_report['list_sizes'] = {'min': int(sizes.min()), 'mean': float(sizes.mean()), 'max': int(sizes.max())}
+        index_report['settings'] = []
+        for nprobe in IVF_SWEEP_NPROBES:
+            if nprobe > ivf.num_lists:
+                continue
+            t1 = time.perf_counter()
+            found = np.stack([ivf.search(query, k, nprobe)[0][0] for query in queries])
+            seconds = time.perf_counter() - t1
+            recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found.tolist(), truth.tolist())])
+            setting = {}
+            setting['nprobe'] = nprobe
+            setting['recall_at_k'] = float(recall)
+            setting['queries_per_sec'] = len(queries) / seconds
+            setting['mean_vectors_scanned'] = ivf.scanned(queries, nprobe)
+            index_report['settings'].append(setting)
+            print('numLists {:4d} nprobe {:3d}: recall@{} {:.3f}, {:8.1f} queries/sec, {:8.1f} vectors scanned'.format(
+                ivf.num_lists, nprobe, k, recall, setting['queries_per_sec'], setting['mean_vectors_scanned']))
+        report['indexes'].append(index_report)
+    FS.write_json(report, 'tmp/ivf_sweep_report.json')
+
+def build_hnsw_index(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION) -> HNSWIndex:
+    """
+    Build an HNSW index of the embeddings, inserting the players one at a time,
+    and save it to file tmp/indexes/hnsw_<m>_<ef_construction>.bin.
+    """
+    print('=== build_hnsw_index')
+    store = EmbeddingStore(embeddings_file())
+    hnsw = HNSWIndex(store.dims, m, ef_construction, HNSW_EF_SEARCH)
+    t1 = time.perf_counter()
+    for start in range(0, store.count, 1000):
+        hnsw.add(store.matrix[start:start + 1000], store.ids[start:start + 1000])
+        print('inserted {} of {} vectors in {:.1f}s'.format(hnsw.count, store.count, time.perf_counter() - t1))
+    print('built m {} efConstruction {} with {} layers in {:.3f}s'.format(
+        m, ef_construction, hnsw.max_level + 1, time.perf_counter() - t1))
+    os.makedirs('tmp/indexes', exist_ok=True)
+    outfile = hnsw_index_file(m, ef_construction)
+    hnsw.save(outfile)
+    print('file written: {} {:.1f} MB'.format(outfile, os.path.getsize(outfile) / (1024 * 1024)))
+    return hnsw
+
+def hnsw_report(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION, k=SEARCH_K):
+    """
+    Measure the recall@k and the per-query latency of the persisted HNSW index
+    built with the given m and ef_construction,
+    with each of the HNSW_REPORT_EF_SEARCH efSearch values, and of the exact
+    search, for a seeded sample of players searched one at a time.  The
+    report is written to file tmp/hnsw_report.json.
+    """
+    print('=== hnsw_report')
+    index = load_index()
+    hnsw = load_hnsw_index(m, ef_construction)
+    rng = np.random.default_rng(SWEEP_SEED)
+    rows = np.sort(rng.choice(index.count, size=min(SWEEP_QUERIES, index.count), replace=False))
+    queries = index.matrix[rows]
+    truth, _ = index.search(queries, k)
+
+    report = {}
+    report['k'] = k
+    report['queries'] = len(queries)
+    report['vectors'] = index.count
+    report['dims'] = index.dims
+    report['m'] = hnsw.m
+    report['ef_construction'] = hnsw.ef_construction
+    report['layers'] = hnsw.max_level + 1
+    report['file_bytes'] = os.path.getsize(hnsw_index_file(hnsw.m, hnsw.ef_construction))
+    report['exact'] = latency_summary([timed(index.search, query, k) for query in queries])
+    print('exact: mean {:.3f}ms, p50 {:.3f}ms, p95 {:.3f}ms'.format(
+        report['exact']['mean_ms'], report['exact']['p50_ms'], report['exact']['p95_ms']))
+    report['settings'] = []
+    for ef_search in HNSW_REPORT_EF_SEARCH:
+        latencies, found = [], []
+        for query in queries:
+            t1 = time.perf_counter()
+            indexes, _ = hnsw.search(query, k, ef_search)
+            latencies.append(time.perf_counter() - t1)
+            found.append(indexes[0].tolist())
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(found, truth.tolist())])
+        setting = latency_summary(latencies)
+        setting['ef_search'] = ef_search
+        setting['recall_at_k'] = float(recall)
+        report['settings'].append(setting)
+        print('efSearch {:4d}: recall@{} {:.3f}, mean {:.3f}ms, p50 {:.3f}ms, p95 {:.3f}ms'.format(
+            ef_search, k, recall, setting['mean_ms'], setting['p50_ms'], setting['p95_ms']))
+    FS.write_json(report, 'tmp/hnsw_report.json')
+
+def timed(func, *args) -> float:
+    """ Return the seconds taken to call the given function. """
+    t1 = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t1
+
+def create_benchmark_queries(count=BENCHMARK_QUERIES):
+    """
+    Write the fixed set of benchmark query playerIDs to file tmp/benchmark_queries.txt;
+    the BENCHMARK_PLAYERS, and a seeded sample of the other players.
+    """
+    print('=== create_benchmark_queries')
+    player_ids = sorted(EmbeddingStore(embeddings_file()).ids)
+    pids = [pid for pid in BENCHMARK_PLAYERS if pid in set(player_ids)]
+    others = [pid for pid in player_ids if pid not in set(pids)]
+    rng = np.random.default_rng(SWEEP_SEED)
+    sample = rng.choice(len(others), size=min(max(count - len(pids), 0), len(others)), replace=False)
+    pids.extend([others[idx] for idx in sorted(sample.tolist())])
+    os.makedirs('tmp', exist_ok=True)
+    FS.write_lines(pids, benchmark_queries_file())
+    return pids
+
+def read_benchmark_queries() -> list[str]:
+    if not os.path.exists(benchmark_queries_file()):
+        return create_benchmark_queries()
+    return [line.strip() for line in FS.read_lines(benchmark_queries_file()) if len(line.strip()) > 0]
+
+def create_backend(name: str, index: ExactIndex):
+    """
+    Return the named benchmark backend; the local indexes 'exact', 'ivf', and
+    'hnsw', or the databases 'vcore', 'pg', and 'cogsearch', configured with the
+    same environment variables as the cosmos_vcore, cosmos_pg, and
+    cognitive_search apps.  The ivf backend may be given as 'ivf:<numLists>' or
+    'ivf:<numLists>:<nprobe>', and the hnsw backend as 'hnsw:<m>:<efConstruction>'
+    or 'hnsw:<m>:<efConstruction>:<efSearch>'.
+    """
+    if name == 'exact':
+        return LocalBackend('exact', index, {'path': embeddings_file()})
+    if name == 'ivf' or name.startswith('ivf:'):
+        settings = [int(value) for value in name.split(':')[1:]]
+        num_lists = settings[0] if len(settings) > 0 else IVF_NUM_LISTS
+        nprobe = settings[1] if len(settings) > 1 else IVF_NPROBE
+        ivf = load_ivf_index(num_lists)
+        return LocalBackend('ivf', ivf, {'numLists': ivf.num_lists, 'nprobe': nprobe}, nprobe)
+    if name == 'hnsw' or name.startswith('hnsw:'):
+        settings = [int(value) for value in name.split(':')[1:]]
+        if len(settings) == 1:
+            raise ValueError(f'invalid backend: {name}, use hnsw:<m>:<efConstruction>[:<efSearch>]')
+        m = settings[0] if len(settings) > 0 else HNSW_M
+        ef_construction = settings[1] if len(settings) > 1 else HNSW_EF_CONSTRUCTION
+        ef_search = settings[2] if len(settings) > 2 else HNSW_EF_SEARCH
+        hnsw = load_hnsw_index(m, ef_construction)
+        return LocalBackend('hnsw', hnsw,
+            {'m': hnsw.m, 'efConstruction': hnsw.ef_construction, 'efSearch': ef_search}, ef_search)
+    if name == 'table':
+        return NeighborTableBackend(NeighborTable(neighbor_table_file()))
+    if name == 'vcore':
+        return VCoreBackend(os.environ['AZURE_COSMOSDB_MONGO_VCORE_CONN_STR'])
+    if name == 'pg':
+        dbname = Env.var('AZURE_COSMOSDB_PG_DATABASE', 'citus')
+        conn_string = 'host={} user={} dbname={} password={} sslmode=require'.format(
+            os.environ['AZURE_COSMOSDB_PG_SERVER_FULL_NAME'], os.environ['AZURE_COSMOSDB_PG_ADMIN_ID'],
+            dbname, os.environ['AZURE_COSMOSDB_PG_ADMIN_PW'])
+        return PGBackend(conn_string, dbname)
+    if name == 'cogsearch':
+        opts = {}
+        opts['name'] = os.environ['AZURE_SEARCH_NAME']
+        opts['url'] = os.environ['AZURE_SEARCH_URL']
+        opts['admin_key'] = os.environ['AZURE_SEARCH_ADMIN_KEY']
+        opts['query_key'] = os.environ['AZURE_SEARCH_QUERY_KEY']
+        return CogSearchBackend(CogSearchClient(opts))
+    raise ValueError(f'invalid backend: {name}')
+
+def benchmark(backend_names: list[str], k=SEARCH_K):
+    """
+    Search for each of the benchmark query players with each of the given
+    backends, and write the recall@k, nDCG@k, and latency percentiles of
+    each, versus the exact local search, to file tmp/benchmark_report.json.
+    """
+    print('=== benchmark')
+    index = load_index()
+    pids = read_benchmark_queries()
+    bench = SearchBenchmark(index, pids, k)
+    for pid in bench.missing:
+        print(f'player not found: {pid}')
+    # the stored embeddings, as loaded into the databases, rather than the normalized rows
+    vectors = np.asarray(EmbeddingStore(embeddings_file()).matrix[bench.rows], dtype=np.float32)
+
+    report = {}
+    report['k'] = k
+    report['queries_file'] = benchmark_queries_file()
+    report['queries'] = len(bench.pids)
+    report['embeddings_file'] = embeddings_file()
+    report['backends'] = []
+    for name in backend_names:
+        try:
+            backend = create_backend(name, index)
+        except Exception as e:
+            print('backend {} is not available: {} {}'.format(name, type(e).__name__, e))
+            report['backends'].append({'backend': name, 'error': '{} {}'.format(type(e).__name__, e)})
+            continue
+        try:
+            result = bench.run(backend, vectors)
+        finally:
+            backend.close()
+        report['backends'].append(result)
+        if result['queries'] == 0:
+            print('{:10s} all {} queries failed'.format(name, result['errors']))
+            continue
+        print('{:10s} recall@{} {:.3f}  nDCG@{} {:.3f}  p50 {:.3f}ms  p95 {:.3f}ms  p99 {:.3f}ms  errors {}'.format(
+            name, k, result['recall_at_k'], k, result['ndcg_at_k'], result['latency']['p50_ms'],
+            result['latency']['p95_ms'], result['latency']['p99_ms'], result['errors']))
+    FS.write_json(report, 'tmp/benchmark_report.json')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        try:
+            func = sys.argv[1].lower()
+            args = [arg for arg in sys.argv[2:] if not arg.startswith('--')]
+            method = 'table' if Env.boolean_arg('--neighbors') else 'exact'
+            if func == 'search_player_like':
+                pid = args[0]
+                k = int(args[1]) if len(args) > 1 else SEARCH_K
+                search_players_like([pid], k, method)
+            elif func == 'search_players_like':
+                search_players_like(args, SEARCH_K, method)
+            elif func == 'random_player_search':
+                random_player_search()
+            elif func == 'build_ivf_index':
+                num_lists = int(sys.argv[2]) if len(sys.argv) > 2 else IVF_NUM_LISTS
+                build_ivf_index(num_lists)
+            elif func == 'ivf_search_player_like':
+                pid = sys.argv[2]
+                nprobe = int(sys.argv[3]) if len(sys.argv) > 3 else IVF_NPROBE
+                num_lists = int(sys.argv[4]) if len(sys.argv) > 4 else IVF_NUM_LISTS
+                search_players_like([pid], SEARCH_K, 'ivf', nprobe, num_lists)
+            elif func == 'ivf_sweep':
+                ivf_sweep()
+            elif func == 'build_hnsw_index':
+                m = int(sys.argv[2]) if len(sys.argv) > 2 else HNSW_M
+                ef_construction = int(sys.argv[3]) if len(sys.argv) > 3 else HNSW_EF_CONSTRUCTION
+                build_hnsw_index(m, ef_construction)
+            elif func == 'hnsw_search_player_like':
+                pid = sys.argv[2]
+                ef_search = int(sys.argv[3]) if len(sys.argv) > 3 else HNSW_EF_SEARCH
+                m = int(sys.argv[4]) if len(sys.argv) > 4 else HNSW_M
+                ef_construction = int(sys.argv[5]) if len(sys.argv) > 5 else HNSW_EF_CONSTRUCTION
+                search_players_like([pid], SEARCH_K, 'hnsw', ef_search, IVF_NUM_LISTS, m, ef_construction)
+            elif func == 'hnsw_report':
+                m = int(sys.argv[2]) if len(sys.argv) > 2 else HNSW_M
+                ef_construction = int(sys.argv[3]) if len(sys.argv) > 3 else HNSW_EF_CONSTRUCTION
+                hnsw_report(m, ef_construction)
+            elif func == 'create_benchmark_queries':
+                count = int(sys.argv[2]) if len(sys.argv) > 2 else BENCHMARK_QUERIES
+                create_benchmark_queries(count)
+            elif func == 'benchmark':
+                backend_names = sys.argv[2:] if len(sys.argv) > 2 else BENCHMARK_BACKENDS
+                benchmark(backend_names)
+            else:
+                print_options('Error: invalid function: {}'.format(func))
+        except Exception as e:
+            print(str(e))
+            print(traceback.format_exc())
+    else:
+        print_options('Error: no command-line function specified')
@@ -5,18 +5,56 @@ Usage:
   python bb_wrangle.py prune_player_teams
   python bb_wrangle.py prune_batters
   python bb_wrangle.py prune_pitchers
+  python bb_wrangle.py prune_parallel
   -
   python bb_wrangle.py calc_player_positions
   python bb_wrangle.py calc_player_teams
   python bb_wrangle.py calc_batters_stats
   python bb_wrangle.py calc_pitchers_stats
+  python bb_wrangle.py calc_player_positions --columnar
+  python bb_wrangle.py calc_player_teams --columnar
+  python bb_wrangle.py calc_batters_stats --columnar
+  python bb_wrangle.py calc_pitchers_stats --columnar
+  python bb_wrangle.py calc_timings
   -
   python bb_wrangle.py build_documents
   -
+  python bb_wrangle.py run_all
+  python bb_wrangle.py run_all --write-tmp
+  -
+  python bb_wrangle.py make
+  python bb_wrangle.py make --dry-run
+  python bb_wrangle.py make --embed
+  python bb_wrangle.py make --embed --offline
+  python bb_wrangle.py make --reduce
+  python bb_wrangle.py make --neighbors
+  python bb_wrangle.py make --force
+  -
+  python bb_wrangle.py ingestion_report
+  -
   python bb_wrangle.py add_embeddings_to_documents
+  python bb_wrangle.py add_embeddings_to_documents --sequential
+  python bb_wrangle.py add_embeddings_to_documents --unbatched
+  python bb_wrangle.py add_embeddings_to_documents --no-embedding-cache
+  python bb_wrangle.py add_embeddings_to_documents --resume
+  python bb_wrangle.py add_embeddings_to_documents --force
+  python bb_wrangle.py add_embeddings_to_documents --offline
   -
   python bb_wrangle.py scan_embeddings
   -
+  python bb_wrangle.py reduce_embeddings
+  python bb_wrangle.py reduce_embeddings <pca|random> <dims>
+  python bb_wrangle.py reduction_report
+  -
+  python bb_wrangle.py quantize_embeddings <float16|int8|pq>
+  python bb_wrangle.py quantization_report
+  -
+  python bb_wrangle.py build_neighbor_table
+  python bb_wrangle.py build_neighbor_table --parallel
+  -
+  python bb_wrangle.py add_feature_vectors
+  python bb_wrangle.py feature_neighbors_report
+  -
   python bb_wrangle.py csv_reports
 Options:
   -h --help     Show this screen.
@@ -25,20 +63,111 @@ Options:
 
 # Chris Joakim, Microsoft, 2023
 
+import gc
 import json
 import os
 import sys
+import time
+import tracemalloc
 import traceback
 
+import numpy as np
 import pandas as pd
 
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from docopt import docopt
 
-from pysrc.aibundle import Bytes, CogSvcsClient, Counter, Env, FS, Mongo, OpenAIClient, Storage, System
+from pysrc.aibundle import Bytes, CogSvcsClient, Counter, EmbeddingStore, Env, FS, Mongo, NeighborTable, OpenAIClient, Storage, System
+from pysrc.allpairs import all_pairs_top_k
+from pysrc.embeddingcache import EmbeddingCache
+from pysrc.embeddingcheckpoint import EmbeddingCheckpoint
+from pysrc.embeddingpipeline import EmbeddingPipeline
+from pysrc.embeddingprovider import HashedNgramEmbeddings
+from pysrc.embeddingreduction import EmbeddingReduction
+from pysrc.embeddingscan import EmbeddingScan
+from pysrc.featurevectors import FeatureVectors
+from pysrc.quantization import CODECS, cluster_means, create_codec
+from pysrc.sourcecache import SourceCache
+from pysrc.stagecache import Stage, StageCache
+from pysrc.textencoding import TextEncodings
+from pysrc.vectorsearch import ExactIndex
 
 EXPECTED_EMBEDDINGS_ARRAY_LENGTH = 1536
 ALGORITHM_RAW_NUMBERS =  'raw-numbers'
 ALGORITHM_BINNED_TEXT =  'binned-text'
+EMBEDDINGS_ALGORITHM  = ALGORITHM_BINNED_TEXT
+EMBEDDING_MODEL = 'text-embedding-ada-002'
+SOURCE_DATA_DIR = '../data/seanhahman-baseballdatabank-2023.1/core'
+STAGE_CACHE_FILE = 'tmp/stage_cache/stages.json'
+DOCUMENTS_CHUNK_SIZE = 1000
+EMBEDDINGS_CHUNK_SIZE = 256  # distinct texts requested between checkpoint syncs
+EMBEDDINGS_CHECKPOINT_FILE = 'tmp/embeddings_checkpoint.log'
+EMBEDDINGS_RPM = 1440    # the default Azure OpenAI text-embedding-ada-002 quota
+EMBEDDINGS_TPM = 240000
+EMBEDDINGS_MAX_CONCURRENCY = 16
+EMBEDDING_CACHE_FILE = 'tmp/embedding_cache/embeddings.db'
+EMBEDDING_CACHE_MAX_ENTRIES = 1000000
+EMBEDDING_CACHE_MAX_AGE_DAYS = 365
+FEATURES_MODEL = 'player-features-v1'
+NEIGHBORS_K = 10
+NEIGHBORS_REPORT_QUERIES = 500
+NEIGHBORS_REPORT_SEED = 42
+REDUCTION_METHOD = 'pca'
+REDUCED_DIMS = 256
+REDUCTION_REPORT_DIMS = [32, 64, 128, 256, 512]
+QUANTIZATION_CODEC = 'int8'
+NEIGHBOR_TABLE_K = 50
+NEIGHBOR_TABLE_BLOCK_ROWS = 1024
+SOURCE_CACHE_DIR = 'tmp/source_cache'
+
+# The columns read from each source csv file, and their kind of value.
+# Appearances.csv declares all of its columns since appearances_df drops
+# the rows having any missing value, including in the unused columns.
+SOURCE_SCHEMAS = {
+    'Appearances.csv': {
+        'yearID': 'count', 'teamID': 'category', 'lgID': 'category', 'playerID': 'text',
+        'G_all': 'count', 'GS': 'count', 'G_batting': 'count', 'G_defense': 'count',
+        'G_p': 'count', 'G_c': 'count', 'G_1b': 'count', 'G_2b': 'count', 'G_3b': 'count',
+        'G_ss': 'count', 'G_lf': 'count', 'G_cf': 'count', 'G_rf': 'count', 'G_of': 'count',
+        'G_dh': 'count', 'G_ph': 'count', 'G_pr': 'count'
+    },
+    'People.csv': {
+        'playerID': 'text', 'birthYear': 'count', 'birthCountry': 'category',
+        'deathYear': 'count', 'nameFirst': 'text', 'nameLast': 'text',
+        'weight': 'count', 'height': 'count', 'bats': 'category', 'throws': 'category',
+        'debut': 'text', 'finalGame': 'text'
+    },
+    'Batting.csv': {
+        'playerID': 'text', 'G': 'count', 'AB': 'count', 'R': 'count', 'H': 'count',
+        '2B': 'count', '3B': 'count', 'HR': 'count', 'RBI': 'count', 'SB': 'count',
+        'CS': 'count', 'BB': 'count', 'SO': 'count', 'IBB': 'count', 'HBP': 'count',
+        'SF': 'count'
+    },
+    'Pitching.csv': {
+        'playerID': 'text', 'W': 'count', 'L': 'count', 'G': 'count', 'GS': 'count',
+        'CG': 'count', 'SHO': 'count', 'SV': 'count', 'IPouts': 'count', 'H': 'count',
+        'ER': 'count', 'HR': 'count', 'BB': 'count', 'SO': 'count', 'BAOpp': 'rate',
+        'ERA': 'rate', 'IBB': 'count', 'WP': 'count', 'HBP': 'count', 'BK': 'count'
+    }
+}
+SOURCE_KIND_DTYPES = {'text': 'object', 'category': 'category', 'count': 'float32', 'rate': 'float64'}
+
+POSITION_COLS = 'G_p,G_c,G_1b,G_2b,G_3b,G_ss,G_lf,G_cf,G_rf,G_dh'.split(',')
+
+# (calculated attribute, numerator column) pairs; each is divided by AB.
+BATTER_RATE_COLS = [
+    ('runs_per_ab', 'R'),
+    ('batting_avg', 'H'),
+    ('2b_avg', '2B'),
+    ('3b_avg', '3B'),
+    ('hr_avg', 'HR'),
+    ('rbi_avg', 'RBI'),
+    ('bb_avg', 'BB'),
+    ('so_avg', 'SO'),
+    ('ibb_avg', 'IBB'),
+    ('hbp_avg', 'HBP')
+]
 
 def print_options(msg):
     print(msg)
@@ -47,42 +176,34 @@ def print_options(msg):
 
 def prune_people():
     print('=== prune_people')
-    df = people_df()
-    include_cols = 'playerID,birthYear,birthCountry,deathYear,nameFirst,nameLast,weight,height,bats,throws,debut,finalGame'.split(',')
-    df2 = include_only_cols(df, include_cols)
-    df2.sort_values(by=['playerID'])
+    df2 = pruned_people_df(people_df())
     write_df(df2, 'tmp/people.csv')
     rows = FS.read_csv_as_dicts('tmp/people.csv')
     FS.write_json(rows, 'tmp/people.json')
 
-def prune_player_positions():
+def prune_player_positions(appearances=None):
     print('=== prune_player_positions')
-    df = appearances_df()
-    include_cols = 'playerID,G_all,G_p,G_c,G_1b,G_2b,G_3b,G_ss,G_lf,G_cf,G_rf,G_dh'.split(',')
-    df2 = include_only_cols(df, include_cols)
-    df2.sort_values(by=['playerID'])
+    if appearances is None:
+        appearances = appearances_df()
+    df2 = pruned_player_positions_df(appearances)
     write_df(df2, 'tmp/player_positions_pruned.csv')
     grouped = df2.groupby(['playerID'])
     grouped.sum().to_csv('tmp/player_positions.csv')
     rows = FS.read_csv_as_dicts('tmp/player_positions.csv')
     FS.write_json(rows, 'tmp/player_positions.json')
 
-def prune_player_teams():
+def prune_player_teams(appearances=None):
     print('=== prune_player_teams')
-    df = appearances_df()
-    include_cols = 'yearID,teamID,playerID,G_all'.split(',')
-    df2 = include_only_cols(df, include_cols)
-    df2.sort_values(by=['playerID'])
+    if appearances is None:
+        appearances = appearances_df()
+    df2 = pruned_player_teams_df(appearances)
     write_df(df2, 'tmp/player_teams.csv')
     rows = FS.read_csv_as_dicts('tmp/player_teams.csv')
     FS.write_json(rows, 'tmp/player_teams.json')
 
 def prune_batters():
     print('=== prune_batters')
-    df = batters_df()
-    include_cols = 'playerID,G,AB,R,H,2B,3B,HR,RBI,SB,CS,BB,SO,IBB,HBP,SF'.split(',')
-    df2 = include_only_cols(df, include_cols)
-    df2.sort_values(by=['playerID'])
+    df2 = pruned_batters_df(batters_df())
     write_df(df2, 'tmp/batters_pruned.csv')
     grouped = df2.groupby(['playerID'])
     grouped.sum().to_csv('tmp/batters.csv')
@@ -91,25 +212,100 @@ def prune_batters():
 
 def prune_pitchers():
     print('=== prune_pitchers')
-    df = pitchers_df()
-    # playerID,yearID,stint,teamID,lgID,W,L,G,GS,CG,SHO,SV,IPouts,H,ER,HR,BB,SO,BAOpp,ERA,IBB,WP,HBP,BK,BFP,GF,R,SH,SF,GIDP
-    include_cols = 'playerID,W,L,G,GS,CG,SHO,SV,IPouts,H,ER,HR,BB,SO,BAOpp,ERA,IBB,WP,HBP,BK'.split(',')
-    df2 = include_only_cols(df, include_cols)
-    df2.sort_values(by=['playerID'])
+    df2 = pruned_pitchers_df(pitchers_df())
     write_df(df2, 'tmp/pitchers_pruned.csv')
     grouped = df2.groupby(['playerID'])
     grouped.sum().to_csv('tmp/pitchers.csv')
     rows = FS.read_csv_as_dicts('tmp/pitchers.csv')
     FS.write_json(rows, 'tmp/pitchers.json')
 
+def pruned_people_df(df):
+    include_cols = 'playerID,birthYear,birthCountry,deathYear,nameFirst,nameLast,weight,height,bats,throws,debut,finalGame'.split(',')
+    df2 = include_only_cols(df, include_cols)
+    df2.sort_values(by=['playerID'])
+    return df2
+
+def pruned_player_positions_df(df):
+    include_cols = 'playerID,G_all,G_p,G_c,G_1b,G_2b,G_3b,G_ss,G_lf,G_cf,G_rf,G_dh'.split(',')
+    df2 = include_only_cols(df, include_cols)
+    df2.sort_values(by=['playerID'])
+    return df2
+
+def pruned_player_teams_df(df):
+    include_cols = 'yearID,teamID,playerID,G_all'.split(',')
+    df2 = include_only_cols(df, include_cols)
+    df2.sort_values(by=['playerID'])
+    return df2
+
+def pruned_batters_df(df):
+    include_cols = 'playerID,G,AB,R,H,2B,3B,HR,RBI,SB,CS,BB,SO,IBB,HBP,SF'.split(',')
+    df2 = include_only_cols(df, include_cols)
+    df2.sort_values(by=['playerID'])
+    return df2
+
+def pruned_pitchers_df(df):
+    # playerID,yearID,stint,teamID,lgID,W,L,G,GS,CG,SHO,SV,IPouts,H,ER,HR,BB,SO,BAOpp,ERA,IBB,WP,HBP,BK,BFP,GF,R,SH,SF,GIDP
+    include_cols = 'playerID,W,L,G,GS,CG,SHO,SV,IPouts,H,ER,HR,BB,SO,BAOpp,ERA,IBB,WP,HBP,BK'.split(',')
+    df2 = include_only_cols(df, include_cols)
+    df2.sort_values(by=['playerID'])
+    return df2
+
+def prune_parallel():
+    """
+    Run the five independent prune steps concurrently in a process pool.
+    Appearances.csv is parsed once and the frame is shared by the
+    prune_player_positions and prune_player_teams steps, which run in the
+    same worker.  Per-step timings are displayed at the end.
+    """
+    print('=== prune_parallel')
+    jobs = [prune_people_job, prune_appearances_job, prune_batters_job, prune_pitchers_job]
+    t1 = time.perf_counter()
+    timings = []
+    with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as executor:
+        futures = [executor.submit(job) for job in jobs]
+        for future in futures:
+            timings.extend(future.result())
+    elapsed = time.perf_counter() - t1
+    for timing in timings:
+        print('{:<28} {:.3f}s'.format(timing['stage'], timing['seconds']))
+    print('{:<28} {:.3f}s'.format('sum of steps', sum(t['seconds'] for t in timings)))
+    print('{:<28} {:.3f}s'.format('elapsed', elapsed))
+
+def prune_people_job():
+    return [timed('prune_people', prune_people)]
+
+def prune_appearances_job():
+    t1 = time.perf_counter()
+    appearances = appearances_df()
+    timings = [{'stage': 'appearances_df', 'seconds': time.perf_counter() - t1}]
+    timings.append(timed('prune_player_positions', prune_player_positions, appearances))
+    timings.append(timed('prune_player_teams', prune_player_teams, appearances))
+    return timings
+
+def prune_batters_job():
+    return [timed('prune_batters', prune_batters)]
+
+def prune_pitchers_job():
+    return [timed('prune_pitchers', prune_pitchers)]
+
+def timed(name, func, *args):
+    """ Call the given function with the given args; return a timing dict. """
+    t1 = time.perf_counter()
+    func(*args)
+    return {'stage': name, 'seconds': time.perf_counter() - t1}
+
 def calc_player_positions():
     print('=== calc_player_positions')
+    if columnar():
+        return calc_player_positions_columnar()
     infile = 'tmp/player_positions.csv'
     outfile = 'tmp/player_positions.json'
     rows = FS.read_csv_as_dicts(infile)
-    player_dict = {}
+    FS.write_json(player_positions_calc(rows), outfile)
 
-    position_cols = 'G_p,G_c,G_1b,G_2b,G_3b,G_ss,G_lf,G_cf,G_rf,G_dh'.split(',')
+def player_positions_calc(rows):
+    player_dict = {}
+    position_cols = POSITION_COLS
     for row_idx, player in enumerate(rows):
         player['primary_position'] = '?'
         pid = player['playerID']
@@ -126,14 +322,18 @@ def calc_player_positions():
                 player['primary_position'] = position.upper()
         if verbose():
             print(json.dumps(player, sort_keys=False, indent=2))
-
-    FS.write_json(player_dict, outfile)
+    return player_dict
 
 def calc_player_teams():
     print('=== calc_player_teams')
+    if columnar():
+        return calc_player_teams_columnar()
     infile = 'tmp/player_teams.csv'
     outfile = 'tmp/player_teams_calc.json'
     rows = FS.read_csv_as_dicts(infile)
+    FS.write_json(player_teams_calc(rows), outfile)
+
+def player_teams_calc(rows):
     player_dict = {}
 
     # First collect the playerDict
@@ -163,14 +363,141 @@ def calc_player_teams():
             if games > highest:
                 highest = games
                 player_info['primary_team'] = tid
+    return player_dict
+
+def calc_player_positions_columnar():
+    infile = 'tmp/player_positions.csv'
+    outfile = 'tmp/player_positions.json'
+    FS.write_json(player_positions_calc_columnar(read_text_df(infile)), outfile)
+
+def calc_player_teams_columnar():
+    infile = 'tmp/player_teams.csv'
+    outfile = 'tmp/player_teams_calc.json'
+    FS.write_json(player_teams_calc_columnar(read_text_df(infile)), outfile)
+
+def player_positions_calc_columnar(df):
+    """
+    Whole-column equivalent of player_positions_calc.  The given df is the
+    grouped player positions csv as text, per read_text_df; the output rows
+    are its records and the calculations run over its numeric_col values.
+    The primary position
+    is the first position column with the greatest positive game count, per
+    an argmax over the position columns.
+    """
+    position_cols = POSITION_COLS
+    positions = [col.split('_')[1] for col in position_cols]
+    games = numeric_col(df, 'G_all')
+    counts = np.column_stack([numeric_col(df, col) for col in position_cols])
+    percents = np.divide(counts, games[:, None], out=np.zeros_like(counts), where=games[:, None] > 0.0)
+    greatest_idx = counts.argmax(axis=1)
+    has_games = counts.max(axis=1) > 0.0
+    labels = np.array([position.upper() for position in positions], dtype=object)
+    primary = np.where(has_games, labels[greatest_idx], '?')
+
+    player_dict = {}
+    percent_keys = [f"{position}_percent" for position in positions]
+    for player, primary_position, percent_row in zip(
+            records(df), primary.tolist(), percents.tolist()):
+        player['primary_position'] = primary_position
+        player.update(zip(percent_keys, percent_row))
+        player_dict[player['playerID']] = player
+    return player_dict
+
+def player_teams_calc_columnar(df):
+    """
+    Whole-column equivalent of player_teams_calc.  The players, teams, and
+    player/team pairs are factorized in order of first appearance, and the
+    games of each pair summed with bincount.  The pairs are then stably
+    sorted by player, so each player's teams are one slice, and the total
+    and highest games of every player are computed at once with reduceat.
+    The primary team is the first team with the player's greatest positive
+    game count.
+    """
+    players, pids = pd.factorize(df['playerID'])
+    teams, tids = pd.factorize(df['teamID'])
+    pairs, first_pairs = pd.factorize(players.astype('int64') * len(tids) + teams)
+    if len(first_pairs) == 0:
+        return {}
+    row_games = numeric_col(df, 'G_all').astype('int64')
+    pair_games = np.bincount(pairs, weights=row_games, minlength=len(first_pairs)).astype('int64')
+    pair_players = first_pairs // len(tids)
+    order = np.argsort(pair_players, kind='stable')
+    counts = np.bincount(pair_players, minlength=len(pids))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    games = pair_games[order]
+    totals = np.add.reduceat(games, starts)
+    highest = np.maximum.reduceat(games, starts)
+    firsts = np.flatnonzero(games == np.repeat(highest, counts))
+    primary = firsts[np.searchsorted(firsts, starts)]
+
+    team_ids = np.asarray(tids, dtype=object)[(first_pairs % len(tids))[order]].tolist()
+    games = games.tolist()
+    player_dict = {}
+    for pid, start, end, total, high, prim in zip(pids.tolist(), starts.tolist(), ends.tolist(),
+                                                  totals.tolist(), highest.tolist(), primary.tolist()):
+        player_info = {}
+        player_info['total_games'] = total
+        player_info['teams'] = dict(zip(team_ids[start:end], games[start:end]))
+        if high > 0:
+            player_info['primary_team'] = team_ids[prim]
+        player_dict[pid] = player_info
+    return player_dict
 
-    FS.write_json(player_dict, outfile)
+def calc_timings():
+    """
+    Time the row-wise and the columnar implementations of the four calc
+    steps over the current tmp/ prune outputs, and verify that both produce
+    identical output.
+    """
+    print('=== calc_timings')
+    steps = [
+        ('calc_player_positions', 'tmp/player_positions.csv',
+            player_positions_calc, player_positions_calc_columnar),
+        ('calc_player_teams', 'tmp/player_teams.csv',
+            player_teams_calc, player_teams_calc_columnar),
+        ('calc_batters_stats', 'tmp/batters.csv',
+            lambda rows: batters_calc(rows)[0],
+            lambda df: batters_calc_columnar(df)[0]),
+        ('calc_pitchers_stats', 'tmp/pitchers.csv',
+            lambda rows: pitchers_calc(rows)[0],
+            lambda df: pitchers_calc_columnar(df)[0])
+    ]
+    report = []
+    for name, infile, rowwise_func, columnar_func in steps:
+        t1 = time.perf_counter()
+        rows = FS.read_csv_as_dicts(infile)
+        rowwise = rowwise_func(rows)
+        rowwise_seconds = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        columnar_result = columnar_func(read_text_df(infile))
+        columnar_seconds = time.perf_counter() - t1
+        identical = json.dumps(rowwise) == json.dumps(columnar_result)
+        entry = {}
+        entry['step'] = name
+        entry['rows'] = len(rows)
+        entry['rowwise_seconds'] = rowwise_seconds
+        entry['columnar_seconds'] = columnar_seconds
+        entry['speedup'] = rowwise_seconds / max(columnar_seconds, 1e-9)
+        entry['identical'] = identical
+        report.append(entry)
+        print('{:<24} rows: {:>7} rowwise: {:.4f}s columnar: {:.4f}s speedup: {:6.1f}x identical: {}'.format(
+            name, len(rows), rowwise_seconds, columnar_seconds, entry['speedup'], identical))
+    FS.write_json(report, 'tmp/calc_timings.json')
 
 def calc_batters_stats():
     print('=== calc_batters_stats')
+    if columnar():
+        return calc_batters_stats_columnar()
     infile  = 'tmp/batters.json'
     outfile = 'tmp/batters_calc.json'
     batters_list = FS.read_json(infile)
+    output_dict, calculated_count = batters_calc(batters_list)
+    print(f'batters count:    {len(batters_list)}')
+    print(f'calculated count: {calculated_count}')
+    FS.write_json(output_dict, outfile)
+
+def batters_calc(batters_list):
     output_dict = {}
     calculated_count = 0
 
@@ -199,16 +526,21 @@ def calc_batters_stats():
             print(traceback.format_exc())
         if verbose():
             print(json.dumps(batter, sort_keys=False, indent=2))
-
-    print(f'batters count:    {len(batters_list)}')
-    print(f'calculated count: {calculated_count}')
-    FS.write_json(output_dict, outfile)
+    return output_dict, calculated_count
 
 def calc_pitchers_stats():
     print('=== calc_pitchers_stats')
+    if columnar():
+        return calc_pitchers_stats_columnar()
     infile  = 'tmp/pitchers.json'
     outfile = 'tmp/pitchers_calc.json'
     pitchers_list = FS.read_json(infile)
+    output_dict, calculated_count = pitchers_calc(pitchers_list)
+    print(f'pitcher count:    {len(pitchers_list)}')
+    print(f'calculated count: {calculated_count}')
+    FS.write_json(output_dict, outfile)
+
+def pitchers_calc(pitchers_list):
     calculated_count = 0
     output_dict = {}
 
@@ -258,11 +590,118 @@ def calc_pitchers_stats():
         except Exception as e:
             print(f"Exception on pitcher: {pitcher}")
             print(traceback.format_exc())
+    return output_dict, calculated_count
 
-    print(f'pitcher count:    {len(pitchers_list)}')
+def calc_batters_stats_columnar():
+    infile  = 'tmp/batters.csv'
+    outfile = 'tmp/batters_calc.json'
+    df = read_text_df(infile)
+    output_dict, calculated_count = batters_calc_columnar(df)
+    print(f'batters count:    {len(df)}')
+    print(f'calculated count: {calculated_count}')
+    FS.write_json(output_dict, outfile)
+
+def batters_calc_columnar(df):
+    """
+    Whole-column equivalent of the calc_batters_stats loop.  The given df is
+    the grouped batters csv as text, per read_text_df, which is parsed once
+    for both the output rows and the numeric columns.  Return a tuple of
+    (output_dict, calculated_count) where
+    output_dict is identical to the tmp/batters_calc.json content produced
+    by the row-wise loop.
+    """
+    ab = numeric_col(df, 'AB')
+    mask = ab > 0.0
+    calculated = {}
+    for name, col in BATTER_RATE_COLS:
+        calculated[name] = masked_divide(numeric_col(df, col), ab, mask)
+    return calculated_output_dict(df, calculated, mask), int(mask.sum())
+
+def calc_pitchers_stats_columnar():
+    infile  = 'tmp/pitchers.csv'
+    outfile = 'tmp/pitchers_calc.json'
+    df = read_text_df(infile)
+    output_dict, calculated_count = pitchers_calc_columnar(df)
+    print(f'pitcher count:    {len(df)}')
     print(f'calculated count: {calculated_count}')
     FS.write_json(output_dict, outfile)
 
+def pitchers_calc_columnar(df):
+    """
+    Whole-column equivalent of the calc_pitchers_stats loop; see
+    batters_calc_columnar.  Rows with zero IPouts get an empty calculated
+    dict, and the win/shutout/complete-game percentages are 0.0 where
+    their denominators are zero, as in the row-wise loop.
+    """
+    w    = numeric_col(df, 'W')
+    l    = numeric_col(df, 'L')
+    er   = numeric_col(df, 'ER')
+    gs   = numeric_col(df, 'GS')
+    cg   = numeric_col(df, 'CG')
+    sho  = numeric_col(df, 'SHO')
+    hits = numeric_col(df, 'H')
+    bb   = numeric_col(df, 'BB')
+    so   = numeric_col(df, 'SO')
+    ipo  = numeric_col(df, 'IPouts')
+    hr   = numeric_col(df, 'HR')
+    hbp  = numeric_col(df, 'HBP')
+    mask = ipo > 0.0
+    fge = ipo / 27.0
+    official_at_bats = ipo + hits
+    all_at_bats = official_at_bats + bb + hbp
+    decisions = w + l
+
+    calculated = {}
+    calculated['full_games_pitched_equiv'] = fge
+    calculated['era'] = masked_divide(er, fge, mask)
+    calculated['opp_batting_avg'] = masked_divide(hits, official_at_bats, mask)
+    calculated['bb_pct']  = masked_divide(bb, all_at_bats, mask)
+    calculated['so_pct']  = masked_divide(so, all_at_bats, mask)
+    calculated['hbp_pct'] = masked_divide(hbp, all_at_bats, mask)
+    calculated['hr_pct']  = masked_divide(hr, all_at_bats, mask)
+    calculated['win_pct'] = masked_divide(w, decisions, decisions > 0.0)
+    calculated['sho_pct'] = masked_divide(sho, decisions, decisions > 0.0)
+    calculated['cg_pct']  = masked_divide(cg, gs, gs > 0.0)
+    return calculated_output_dict(df, calculated, mask), int(mask.sum())
+
+def calculated_output_dict(df, calculated, mask):
+    """
+    Return a dict of playerID -> row dict of the given text df, with a
+    'calculated' dict of the given calculated columns for the rows where
+    mask is True, else {}.
+    """
+    names = list(calculated.keys())
+    calc_rows = zip(*[calculated[name].tolist() for name in names])
+    cols = list(df.columns) + ['calculated']
+    values = [df[col].tolist() for col in df.columns]
+    with gc_paused():
+        calcs = [dict(zip(names, calc_row)) if is_calculated else {}
+                 for calc_row, is_calculated in zip(calc_rows, mask.tolist())]
+        return dict(zip(df['playerID'].tolist(),
+                        [dict(zip(cols, row)) for row in zip(*values, calcs)]))
+
+def numeric_col(df, col):
+    """
+    Return the given column as a float64 array, with missing or unparsable
+    values as 0.0; the columnar equivalent of float_value(row, col, 0.0).
+    Text columns, per read_text_df, are converted directly when every value
+    parses, and only fall back to the much slower pd.to_numeric otherwise.
+    """
+    if col not in df.columns:
+        return np.zeros(len(df), dtype='float64')
+    if not pd.api.types.is_numeric_dtype(df[col]):
+        values = df[col].to_numpy(dtype=object)
+        try:
+            values = np.where(values == '', '0', values).astype('float64')
+            return np.where(np.isnan(values), 0.0, values)
+        except (TypeError, ValueError):
+            pass
+    return pd.to_numeric(df[col], errors='coerce').fillna(0.0).to_numpy(dtype='float64')
+
+def masked_divide(numerator, denominator, mask):
+    """ Return numerator / denominator where mask is True, else 0.0. """
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=mask)
+
 def build_documents():
     print('=== build_documents')
     players_list  = FS.read_json('tmp/people.json')
@@ -270,62 +709,220 @@ def build_documents():
     pitchers_dict = FS.read_json('tmp/pitchers_calc.json')
     player_teams_dict = FS.read_json('tmp/player_teams_calc.json')
     player_positions_dict = FS.read_json('tmp/player_positions.json')
+    documents = documents_iter(
+        players_list, batters_dict, pitchers_dict, player_teams_dict, player_positions_dict)
+    FS.write_jsonl(documents, documents_file())
+
+def documents_iter(players_list, batters_dict, pitchers_dict, player_teams_dict, player_positions_dict):
+    """
+    Yield the player documents in playerID order.  The documents are built
+    and given their embeddings_str in chunks of DOCUMENTS_CHUNK_SIZE players,
+    so only one chunk of documents is in memory while the file is written.
+    """
     print(f'players count:      {len(players_list)}')
     print(f'batters count:      {len(batters_dict.keys())}')
     print(f'pitchers count:     {len(pitchers_dict.keys())}')
     print(f'player teams count: {len(player_teams_dict.keys())}')
-    documents = {}
-    outfile = '../data/wrangled/documents.json'
+    players = [p for p in players_list if p['playerID'] in player_teams_dict.keys()]
+    players.sort(key=lambda p: p['playerID'])
+    count = 0
+    for start in range(0, len(players), DOCUMENTS_CHUNK_SIZE):
+        documents = []
+        for player in players[start:start + DOCUMENTS_CHUNK_SIZE]:
+            documents.append(player_document(
+                player, batters_dict, pitchers_dict, player_teams_dict, player_positions_dict))
+        embeddings_strings = TextEncodings.encode(EMBEDDINGS_ALGORITHM, documents)
+        for doc, embeddings_str in zip(documents, embeddings_strings):
+            if embeddings_str is not None:
+                doc['embeddings_str'] = embeddings_str
+        count += len(documents)
+        yield from documents
+    print(f'documents count: {count}')
+
+def player_document(player, batters_dict, pitchers_dict, player_teams_dict, player_positions_dict):
     pruned_player_attrs  = 'x'.split(',')
     pruned_pitcher_attrs = 'playerID,dog'.split(',')
     pruned_batter_attrs  = 'playerID,cat'.split(',')
+    pid = player['playerID']
+    player = dict(player)
+    player['teams'] = player_teams_dict[pid]
+    pitching_ipo, batting_hits = 0, 0
 
-    for player in players_list:
-        pid = player['playerID']
-        if pid in player_teams_dict.keys():
-            documents[pid] = player
-            player['teams'] = player_teams_dict[pid]
-            pitching_ipo, batting_hits = 0, 0
-
-            if pid in pitchers_dict.keys():
-                player['pitching'] = pitchers_dict[pid]
-                pitching_ipo = int(float(player['pitching']['IPouts']))
-                player['category'] = 'pitcher'
-                for attr in pruned_pitcher_attrs:
-                     if attr in player['pitching'].keys():
-                        del player['pitching'][attr]
+    if pid in pitchers_dict.keys():
+        player['pitching'] = pitchers_dict[pid]
+        pitching_ipo = int(float(player['pitching']['IPouts']))
+        player['category'] = 'pitcher'
+        for attr in pruned_pitcher_attrs:
+             if attr in player['pitching'].keys():
+                del player['pitching'][attr]
 
-            if pid in player_positions_dict.keys():
-                pp = player_positions_dict[pid]
-                player['primary_position'] = pp['primary_position']
-            else:
-                player['primary_position'] = '?'
+    if pid in player_positions_dict.keys():
+        pp = player_positions_dict[pid]
+        player['primary_position'] = pp['primary_position']
+    else:
+        player['primary_position'] = '?'
 
-            if pid in batters_dict.keys():
-                player['batting'] = batters_dict[pid]
-                batting_hits = int(float(player['batting']['H']))
+    if pid in batters_dict.keys():
+        player['batting'] = batters_dict[pid]
+        batting_hits = int(float(player['batting']['H']))
+        player['category'] = 'fielder'
+        for attr in pruned_batter_attrs:
+            if attr in player['batting'].keys():
+                del player['batting'][attr]
+
+    if 'pitching' in player.keys():
+        if 'batting' in player.keys():
+            # compare the primary metric for each category if the player
+            # is BOTH a pitcher and a batter/fielder.  see aardsda01.
+            if pitching_ipo > batting_hits:  
+                player['category'] = 'pitcher'
+            else:
                 player['category'] = 'fielder'
-                for attr in pruned_batter_attrs:
-                    if attr in player['batting'].keys():
-                        del player['batting'][attr]
-
-            if 'pitching' in player.keys():
-                if 'batting' in player.keys():
-                    # compare the primary metric for each category if the player
-                    # is BOTH a pitcher and a batter/fielder.  see aardsda01.
-                    if pitching_ipo > batting_hits:  
-                        player['category'] = 'pitcher'
-                    else:
-                        player['category'] = 'fielder'
-            for attr in pruned_player_attrs:
-                if attr in player.keys():
-                    del player[attr]
-
-            refine_values(player)
-            calculate_embeddings_string_value(player, ALGORITHM_BINNED_TEXT)
-
-    print(f'documents count: {len(documents.keys())}')
-    FS.write_json(documents, outfile)
+    for attr in pruned_player_attrs:
+        if attr in player.keys():
+            del player[attr]
+
+    refine_values(player)
+    return player
+
+def run_all():
+    """
+    Execute the prune, calc, and build_documents steps in one process,
+    passing the intermediate frames and dicts in memory rather than through
+    the tmp/ csv and json files.  Only the documents file is written, unless
+    --write-tmp is given to also write the same intermediate files as the
+    individual steps, for debugging.
+    """
+    print('=== run_all')
+    people = pruned_people_df(people_df())
+    appearances = appearances_df()
+    positions = pruned_player_positions_df(appearances)
+    teams = pruned_player_teams_df(appearances)
+    batters = pruned_batters_df(batters_df())
+    pitchers = pruned_pitchers_df(pitchers_df())
+    positions_grouped = positions.groupby(['playerID']).sum().reset_index()
+    batters_grouped = batters.groupby(['playerID']).sum().reset_index()
+    pitchers_grouped = pitchers.groupby(['playerID']).sum().reset_index()
+
+    people_rows = records(text_df(people))
+    batters_text = text_df(batters_grouped)
+    pitchers_text = text_df(pitchers_grouped)
+    if write_tmp():
+        write_df(people, 'tmp/people.csv')
+        FS.write_json(people_rows, 'tmp/people.json')
+        write_df(positions, 'tmp/player_positions_pruned.csv')
+        write_df(positions_grouped, 'tmp/player_positions.csv')
+        write_df(teams, 'tmp/player_teams.csv')
+        FS.write_json(records(text_df(teams)), 'tmp/player_teams.json')
+        write_df(batters, 'tmp/batters_pruned.csv')
+        write_df(batters_grouped, 'tmp/batters.csv')
+        FS.write_json(records(batters_text), 'tmp/batters.json')
+        write_df(pitchers, 'tmp/pitchers_pruned.csv')
+        write_df(pitchers_grouped, 'tmp/pitchers.csv')
+        FS.write_json(records(pitchers_text), 'tmp/pitchers.json')
+
+    player_positions_dict = player_positions_calc_columnar(text_df(positions_grouped))
+    player_teams_dict = player_teams_calc_columnar(teams)
+    batters_dict, batters_count = batters_calc_columnar(batters_text)
+    pitchers_dict, pitchers_count = pitchers_calc_columnar(pitchers_text)
+    print(f'batters calculated count:  {batters_count}')
+    print(f'pitchers calculated count: {pitchers_count}')
+
+    if write_tmp():
+        FS.write_json(player_positions_dict, 'tmp/player_positions.json')
+        FS.write_json(player_teams_dict, 'tmp/player_teams_calc.json')
+        FS.write_json(batters_dict, 'tmp/batters_calc.json')
+        FS.write_json(pitchers_dict, 'tmp/pitchers_calc.json')
+
+    documents = documents_iter(
+        people_rows,
+        batters_dict, pitchers_dict, player_teams_dict, player_positions_dict)
+    FS.write_jsonl(documents, documents_file())
+
+def make():
+    """
+    Run the prune, calc, build_documents, and optionally the add_embeddings
+    (--embed), reduce_embeddings (--reduce), and build_neighbor_table (--neighbors)
+    stages, skipping each stage whose input files, code,
+    and parameters are unchanged since it last produced its outputs.
+    A stage's code is its functions in this module and its source modules,
+    so an edit to one stage reruns only that stage and those downstream.
+    --force reruns every stage; --dry-run only lists the stale stages.
+    """
+    print('=== make')
+    os.makedirs('tmp', exist_ok=True)
+    code_version = StageCache.sources_sha256(['pysrc/aibundle.py'])
+    cache = StageCache(STAGE_CACHE_FILE, code_version)
+    results = cache.run(
+        wrangling_stages(Env.boolean_arg('--embed'), Env.boolean_arg('--reduce'), Env.boolean_arg('--neighbors')),
+        force=Env.boolean_arg('--force'),
+        dry_run=Env.boolean_arg('--dry-run'))
+    for result in results:
+        print('{:<28} {:<8} {:.3f}s'.format(result['stage'], result['status'], result['seconds']))
+
+def wrangling_stages(embed: bool, reduce: bool = False, neighbors: bool = False) -> list:
+    """ Return the dependency graph of the wrangling stages, per their files. """
+    stages = [
+        Stage('prune_people', prune_people,
+            [source_file('People.csv')],
+            ['tmp/people.csv', 'tmp/people.json'],
+            sources=['pysrc/sourcecache.py']),
+        Stage('prune_player_positions', prune_player_positions,
+            [source_file('Appearances.csv')],
+            ['tmp/player_positions_pruned.csv', 'tmp/player_positions.csv'],
+            sources=['pysrc/sourcecache.py']),
+        Stage('prune_player_teams', prune_player_teams,
+            [source_file('Appearances.csv')],
+            ['tmp/player_teams.csv'],
+            sources=['pysrc/sourcecache.py']),
+        Stage('prune_batters', prune_batters,
+            [source_file('Batting.csv')],
+            ['tmp/batters_pruned.csv', 'tmp/batters.csv'],
+            sources=['pysrc/sourcecache.py']),
+        Stage('prune_pitchers', prune_pitchers,
+            [source_file('Pitching.csv')],
+            ['tmp/pitchers_pruned.csv', 'tmp/pitchers.csv'],
+            sources=['pysrc/sourcecache.py']),
+        Stage('calc_player_positions', calc_player_positions_columnar,
+            ['tmp/player_positions.csv'],
+            ['tmp/player_positions.json']),
+        Stage('calc_player_teams', calc_player_teams_columnar,
+            ['tmp/player_teams.csv'],
+            ['tmp/player_teams_calc.json']),
+        Stage('calc_batters_stats', calc_batters_stats_columnar,
+            ['tmp/batters.csv'],
+            ['tmp/batters_calc.json']),
+        Stage('calc_pitchers_stats', calc_pitchers_stats_columnar,
+            ['tmp/pitchers.csv'],
+            ['tmp/pitchers_calc.json']),
+        Stage('build_documents', build_documents,
+            ['tmp/people.json', 'tmp/batters_calc.json', 'tmp/pitchers_calc.json',
+             'tmp/player_teams_calc.json', 'tmp/player_positions.json'],
+            [documents_file()],
+            {'embeddings_algorithm': EMBEDDINGS_ALGORITHM},
+            ['pysrc/textencoding.py'])
+    ]
+    if embed:
+        stages.append(Stage('add_embeddings', add_embeddings,
+            [documents_file()],
+            [embeddings_file(), EmbeddingStore.ids_file(embeddings_file())],
+            {'embedding_model': embedding_model()},
+            ['pysrc/embeddingpipeline.py', 'pysrc/embeddingcache.py',
+             'pysrc/embeddingcheckpoint.py', 'pysrc/embeddingprovider.py']))
+    if reduce:
+        reduced_file = reduced_embeddings_file(REDUCTION_METHOD, REDUCED_DIMS)
+        stages.append(Stage('reduce_embeddings', reduce_embeddings,
+            [embeddings_file(), EmbeddingStore.ids_file(embeddings_file())],
+            [reduction_file(REDUCTION_METHOD, REDUCED_DIMS), reduced_file, EmbeddingStore.ids_file(reduced_file)],
+            {'method': REDUCTION_METHOD, 'dims': REDUCED_DIMS},
+            ['pysrc/embeddingreduction.py']))
+    if neighbors:
+        stages.append(Stage('build_neighbor_table', build_neighbor_table,
+            [embeddings_file(), EmbeddingStore.ids_file(embeddings_file())],
+            [neighbor_table_file(), NeighborTable.ids_file(neighbor_table_file())],
+            {'k': NEIGHBOR_TABLE_K},
+            ['pysrc/allpairs.py', 'pysrc/vectorsearch.py']))
+    return stages
 
 def refine_values(player):
     try:
@@ -339,179 +936,155 @@ def refine_values(player):
     except:
         pass
 
-def calculate_embeddings_string_value(player, algorithm):
-    if algorithm == ALGORITHM_BINNED_TEXT:
-        calculate_embeddings_string_value_with_binned_text(player)
+def add_embeddings():
+    """
+    Write the embedding of each document's embeddings_str to the binary
+    EmbeddingStore file, rather than adding the floats to the JSON documents.
+    By default the embeddings are requested in batches, concurrently, within
+    the deployment's requests-per-minute and tokens-per-minute quota given by
+    the AZURE_OPENAI_EMBEDDINGS_RPM and AZURE_OPENAI_EMBEDDINGS_TPM environment
+    variables.  --sequential requests the batches one at a time, and
+    --unbatched requests one embedding at a time.  Embeddings of texts
+    already in the persistent embedding cache are not requested again,
+    unless --no-embedding-cache is given.  Documents with identical
+    embeddings_str values share one embedding request.
+    Each embedding is appended to a checkpoint log as soon as its batch is
+    received, and the log is synced to disk after each chunk of texts.
+    --resume continues an interrupted run from its checkpoint, requesting only
+    the texts without a valid embedding.  An existing checkpoint is only
+    discarded, and started afresh, with --force.  The checkpoint is removed
+    once every text has been embedded.
+    --offline computes the embeddings locally, with no network, using the
+    deterministic HashedNgramEmbeddings provider rather than Azure OpenAI,
+    and without the rpm and tpm limits.
+    """
+    print(f'=== add_embeddings')
+    if Env.boolean_arg('--offline'):
+        oaic = create_offline_oai_client()
     else:
-        calculate_embeddings_string_value_with_raw_numbers(player)
+        oaic = create_azure_oai_client()
+    print(json.dumps(oaic.get_config(), sort_keys=False, indent=2))
+    if Env.boolean_arg('--no-embedding-cache') is False:
+        oaic.embedding_cache = EmbeddingCache(
+            EMBEDDING_CACHE_FILE, EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_MAX_AGE_DAYS)
+    pipeline = None
+    if Env.boolean_arg('--unbatched') is False and Env.boolean_arg('--sequential') is False:
+        rpm = int(Env.var('AZURE_OPENAI_EMBEDDINGS_RPM', EMBEDDINGS_RPM))
+        tpm = int(Env.var('AZURE_OPENAI_EMBEDDINGS_TPM', EMBEDDINGS_TPM))
+        pipeline = EmbeddingPipeline(oaic, rpm, tpm, EMBEDDINGS_MAX_CONCURRENCY)
+        if pipeline.bucket is None:
+            rpm, tpm = 'unlimited', 'unlimited'
+        print(f'embedding pipeline rpm: {rpm}, tpm: {tpm}, max concurrency: {EMBEDDINGS_MAX_CONCURRENCY}')
 
-def calculate_embeddings_string_value_with_binned_text(player):
-    try:
-        values = []
-        category = player['category']
-        player['embeddings_str'] = ''
-        values.append(category)
-        values.append(labeled_text_value('primary_position', player['primary_position']))
-        values.append(labeled_text_value('total_games', player['teams']['total_games']))
-        values.append(labeled_text_value('bats', player['bats']))
-        values.append(labeled_text_value('throws', player['throws']))
-
-        if category == 'pitcher':
-            values.append(labeled_text_value('wins', player['pitching']['W']))
-            values.append(labeled_text_value('losses', player['pitching']['L']))
-            calculated = player['pitching']['calculated']
-            values.append(labeled_floating_text_value('full_games_pitched_equiv', calculated['full_games_pitched_equiv'], 1)) 
-            values.append(labeled_floating_text_value('era', calculated['era'], 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'opp_batting_avg', 1000))
-            values.append(labeled_binned_pct_text_value(calculated, 'so_pct', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'bb_pct', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'hbp_pct', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'hr_pct', 1000))
-            values.append(labeled_binned_pct_text_value(calculated, 'win_pct', 100)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'sho_pct', 100)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'cg_pct', 100)) 
-        else:
-            values.append(labeled_text_value('hits', player['batting']['H']))
-            values.append(labeled_text_value('hr', player['batting']['HR']))
-            calculated = player['batting']['calculated']
-            values.append(labeled_binned_pct_text_value(calculated, 'batting_avg', 1000))
-            values.append(labeled_binned_pct_text_value(calculated, 'runs_per_ab', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, '2b_avg', 1000))
-            values.append(labeled_binned_pct_text_value(calculated, '3b_avg', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'hr_avg', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'rbi_avg', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'bb_avg', 1000))
-            values.append(labeled_binned_pct_text_value(calculated, 'so_avg', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'ibb_avg', 1000)) 
-            values.append(labeled_binned_pct_text_value(calculated, 'hbp_avg', 1000)) 
-
-        player['embeddings_str'] = ' '.join(values)
-    except Exception as e:
-        print(f"Exception on player: {player}")
-        print(traceback.format_exc())
-        return None
-
-def labeled_text_value(stat, value):
-    try:
-        s = str(stat).strip()
-        v = str(value).strip()
-        return f'{s}_{v}'.lower()
-    except Exception as e:
-        print(f"Exception in labeled_text_value: {stat} {value}")
-        print(traceback.format_exc())
-        return ''
-
-def labeled_floating_text_value(stat, value, multiplier):
-    """ 
-    for a given set of args 'era', '4.27299703264095', and multiplier 1000
-    return 'era_4273'
-    """
-    try:
-        s = str(stat).strip()
-        int_value = int(round(float(value) * float(multiplier)))  
-        return f'{s}_{int_value}'.strip().lower()
-    except Exception as e:
-        print(f"Exception in labeled_floating_text_value: {stat} {value} {multiplier}")
-        print(traceback.format_exc())
-        return ''
-
-def labeled_binned_pct_text_value(values_dict, stat, bin_factor):
-    """
-    for a values dict with stat/key "so_pct" with value 0.22576361221779548 and bin factor 100
-    return the string 'so_pct_23' by binning the rounded percent value.
-    bin_factor value is expected to be 10, 100, 1000, etc.
-    """
-    s = str(stat).strip()
-    bin_range = range(bin_factor - 1)
-    try:
-        if stat not in values_dict.keys():
-            return ''
-        int_value = int(round(float(values_dict[stat]) * float(bin_factor)))
-        tier_name = '?'
-        for tier in bin_range:
-            if int_value >= tier:
-                tier_name = str(tier)
-        return f'{s}_{tier_name}'.strip().lower()
-    except Exception as e:
-        print(f"Exception in labeled_binned_pct_text_value: {values_dict} {stat}")
-        print(traceback.format_exc())
-        return f'{s}_??'.lower()
-
-def calculate_embeddings_string_value_with_raw_numbers(player):
+    inputs = embedding_inputs()  # (playerID, embeddings_str) tuples
+    texts = list(dict.fromkeys(estr for pid, estr in inputs))
+    dedupe = {}
+    dedupe['inputs'] = len(inputs)
+    dedupe['distinct_texts'] = len(texts)
+    dedupe['duplicates'] = len(inputs) - len(texts)
+    dedupe['dedupe_ratio'] = (dedupe['duplicates'] / len(inputs)) if len(inputs) > 0 else 0.0
+    print(json.dumps(dedupe, sort_keys=False, indent=2))
+
+    # embed each distinct text once, into the checkpoint log keyed by text hash,
+    # then fan the vectors out to the documents, in document order.
+    resume = Env.boolean_arg('--resume')
+    if resume is False and Env.boolean_arg('--force') is False:
+        if EmbeddingCheckpoint.has_records(EMBEDDINGS_CHECKPOINT_FILE):
+            raise ValueError(f'checkpoint {EMBEDDINGS_CHECKPOINT_FILE} has embeddings of a previous run; '
+                'rerun with --resume to keep them, or with --force to discard them')
+    checkpoint = EmbeddingCheckpoint(EMBEDDINGS_CHECKPOINT_FILE,
+        EXPECTED_EMBEDDINGS_ARRAY_LENGTH, oaic.embedding_model, resume)
+    todo = [estr for estr in texts if not checkpoint.contains(estr)]
+    print(f'checkpoint: {checkpoint.path}, resumed: {len(texts) - len(todo)}, invalid: {checkpoint.invalid}, to embed: {len(todo)}')
+    t1 = time.perf_counter()
+    embeddings = stream_embeddings(oaic, pipeline, todo)
     try:
-        values = []
-        category = player['category']
-        player['embeddings_str'] = ''
-        values.append(category)
-        if category == 'pitcher':
-            values.append('0')
-        else:
-            values.append('1')
-        values.append(str(player['primary_position'])) 
-        values.append(str(player['teams']['total_games']))
-        values.append(player['bats'].lower())
-        values.append(player['throws'].lower())
-
-        if category == 'pitcher':
-            # values.append(str(player['pitching']['G']))
-            values.append(str(player['pitching']['W']))
-            values.append(str(player['pitching']['L']))
-            calculated = player['pitching']['calculated']
-            values.append(str(calculated['full_games_pitched_equiv']))
-            values.append(str(calculated['era']))
-            values.append(str(calculated['opp_batting_avg']))
-            values.append(str(calculated['so_pct']))
-            values.append(str(calculated['bb_pct']))
-            values.append(str(calculated['hbp_pct']))
-            values.append(str(calculated['hr_pct']))
-            values.append(str(calculated['win_pct']))
-            values.append(str(calculated['sho_pct']))
-            values.append(str(calculated['cg_pct']))
-        else:
-            values.append(str(player['batting']['H']))
-            values.append(str(player['batting']['HR']))
-            calculated = player['batting']['calculated']
-            values.append(str(calculated['batting_avg']))
-            values.append(str(calculated['runs_per_ab']))
-            values.append(str(calculated['2b_avg']))
-            values.append(str(calculated['3b_avg']))
-            values.append(str(calculated['hr_avg']))
-            values.append(str(calculated['rbi_avg']))
-            values.append(str(calculated['bb_avg']))
-            values.append(str(calculated['so_avg']))
-            values.append(str(calculated['ibb_avg']))
-            values.append(str(calculated['hbp_avg']))
-        player['embeddings_str'] = ' '.join(values)
-    except Exception as e:
-        print(f"Exception on player: {player}")
-        print(traceback.format_exc())
-        return None
+        for done, (idx, embed) in enumerate(embeddings, start=1):
+            estr = todo[idx]
+            if embed is None:
+                print(f'no embedding for: {estr}')
+            elif checkpoint.append(estr, embed) is False:
+                print(f'invalid embedding of length {len(embed)} for: {estr}')
+            if done % EMBEDDINGS_CHUNK_SIZE == 0 or done == len(todo):
+                checkpoint.sync()
+                print(embedding_progress(done, len(todo),
+                    checkpoint.count(), len(texts), time.perf_counter() - t1))
+    except KeyboardInterrupt:
+        embeddings.close()
+        checkpoint.sync()
+        print(f'interrupted; {checkpoint.count()} of {len(texts)} distinct texts are checkpointed, rerun with --resume')
+        raise
 
-def add_embeddings():
-    print(f'=== add_embeddings')
-    infile  = '../data/wrangled/documents.json'
-    outfile = '../data/wrangled/documents_with_embeddings.json'
-    oaic = create_azure_oai_client()
-    print(json.dumps(oaic.get_config(), sort_keys=False, indent=2))
+    vectors = checkpoint.vectors()
+    with EmbeddingStore.writer(embeddings_file(), EXPECTED_EMBEDDINGS_ARRAY_LENGTH, oaic.embedding_model) as store:
+        for pid, estr in inputs:
+            row = checkpoint.row(estr)
+            if row is None:
+                print(f'no embedding for: {pid}')
+            else:
+                store.add(pid, vectors[row])
+    del vectors
+    if checkpoint.count() == len(texts):
+        checkpoint.remove()
+    else:
+        checkpoint.close()
+        print(f'{len(texts) - checkpoint.count()} distinct texts have no embedding, rerun with --resume')
+    print(f'file written: {embeddings_file()}, rows: {len(store.ids)}')
+    if pipeline is not None:
+        print(json.dumps(pipeline.get_stats(), sort_keys=False, indent=2))
+    if oaic.embedding_cache is not None:
+        oaic.embedding_cache.evict()
+        print(json.dumps(oaic.embedding_cache.get_stats(), sort_keys=False, indent=2))
+        oaic.embedding_cache.close()
 
-    documents = FS.read_json(infile)
-    for idx, pid in enumerate(sorted(documents.keys())):
+def embedding_inputs():
+    """ Return the (playerID, embeddings_str) tuples of the documents with an embeddings_str. """
+    inputs = []
+    for idx, doc in enumerate(FS.read_jsonl(documents_file())):
         if idx < 100_000:
-            print(f'adding embedding for: {pid}')
-            doc = documents[pid]
             try:
-                doc['embeddings'] = []
-                doc = documents[pid]
                 estr = doc['embeddings_str']
                 if len(estr) > 0:
-                    embed = oaic.get_embedding(estr)
-                    if embed is not None:
-                        doc['embeddings'] = embed
+                    inputs.append((doc['playerID'], estr))
             except Exception as e:
                 print(f"Exception on doc: {doc}")
                 print(traceback.format_exc())
+    return inputs
 
-    FS.write_json(documents, outfile)
+def stream_embeddings(oaic, pipeline, texts):
+    """
+    Yield the (index, embedding) of each of the given texts as it is received,
+    with None for those which failed.  The pipeline yields each batch as it
+    completes; otherwise the texts are requested a chunk at a time.
+    """
+    if pipeline is not None:
+        yield from pipeline.stream_embeddings(texts)
+        return
+    for start in range(0, len(texts), EMBEDDINGS_CHUNK_SIZE):
+        chunk = texts[start:start + EMBEDDINGS_CHUNK_SIZE]
+        for idx, embed in enumerate(request_embeddings(oaic, chunk), start=start):
+            yield idx, embed
+
+def request_embeddings(oaic, texts):
+    """ Return the embeddings of the given texts, with None for those which failed. """
+    if Env.boolean_arg('--unbatched') is False:
+        return oaic.get_embeddings(texts)
+    embeddings = []
+    for estr in texts:
+        try:
+            embeddings.append(oaic.get_embedding(estr))
+        except Exception as e:
+            print(f"Exception on embeddings_str: {estr}")
+            print(traceback.format_exc())
+            embeddings.append(None)
+    return embeddings
+
+def embedding_progress(done: int, todo: int, checkpointed: int, total: int, seconds: float) -> str:
+    """ Return a progress line with the rate and estimated time remaining of this run. """
+    rate = (done / seconds) if seconds > 0 else 0.0
+    eta = ((todo - done) / rate) if rate > 0 else 0.0
+    return 'embedded {} of {} this run, checkpointed {} of {} ({:.1f}%), {:.1f} texts/sec, eta {:.0f} seconds'.format(
+        done, todo, checkpointed, total, (100.0 * checkpointed / total) if total > 0 else 100.0, rate, eta)
 
 def create_azure_oai_client():
     config = {}
@@ -519,32 +1092,334 @@ def create_azure_oai_client():
     config['url']  = os.environ['AZURE_OPENAI_URL']
     config['key']  = os.environ['AZURE_OPENAI_KEY1']
     config['api_version'] = '2023-05-15'  # <-- subject to change
+    config['embedding_model'] = EMBEDDING_MODEL
     print('create_azure_oai_client, config: {}'.format(json.dumps(config)))
     return OpenAIClient(config)
 
+def create_offline_oai_client():
+    """ Return an OpenAIClient which computes embeddings locally, with no network. """
+    provider = HashedNgramEmbeddings(EXPECTED_EMBEDDINGS_ARRAY_LENGTH)
+    config = {}
+    config['type'] = 'azure'
+    config['url']  = 'https://offline.invalid/'
+    config['key']  = 'offline'
+    config['embedding_model'] = provider.model
+    config['embeddings_sleep_seconds'] = 0.0
+    print('create_offline_oai_client, config: {}'.format(json.dumps(config)))
+    oaic = OpenAIClient(config)
+    oaic.embedding_provider = provider
+    return oaic
+
+def embedding_model() -> str:
+    """ Return the name of the embedding model add_embeddings uses, per --offline. """
+    if Env.boolean_arg('--offline'):
+        return HashedNgramEmbeddings(EXPECTED_EMBEDDINGS_ARRAY_LENGTH).model
+    return EMBEDDING_MODEL
+
 def scan_embeddings():
+    """
+    Validate the embedding store in bulk and write the summary report to
+    tmp/scan_embeddings_report.json.  Only the anomalies are displayed: a dims
+    mismatch, documents without an embedding and embeddings without a document,
+    non-finite and zero vectors, outlying norms, and duplicate or
+    near-duplicate vectors of different embeddings_str values.
+    """
     print(f'=== scan_embeddings')
-    infile = '../data/wrangled/documents_with_embeddings.json'
-    documents = FS.read_json(infile)
-    count = len(documents.keys())
-    with_count, without_count = 0, 0
-    for pid in sorted(documents.keys()):
-        doc = documents[pid]
-        embeddings = doc['embeddings']
-        if len(embeddings) == EXPECTED_EMBEDDINGS_ARRAY_LENGTH:
-            with_count += 1
-            print(f'{pid}: present {len(embeddings)}')
-        else:
-            without_count += 1
-            print(f'{pid}: absent {len(embeddings)}')
-    print(f'documents count: {count}')
-    print(f'with_count: {with_count}')
-    print(f'without_count: {without_count}')
+    t1 = time.perf_counter()
+    store = EmbeddingStore(embeddings_file())
+    texts = {}
+    for doc in FS.read_jsonl(documents_file()):
+        if len(doc.get('embeddings_str') or '') > 0:
+            texts[doc['playerID']] = doc['embeddings_str']
+    report = EmbeddingScan(store, EXPECTED_EMBEDDINGS_ARRAY_LENGTH).run(texts)
+    missing = [pid for pid in texts.keys() if store.row(pid) is None]
+    orphans = [pid for pid in store.ids if pid not in texts]
+    report['documents'] = len(texts)
+    report['documents_without_embedding'] = {'count': len(missing), 'ids': missing[:100]}
+    report['embeddings_without_document'] = {'count': len(orphans), 'ids': orphans[:100]}
+    report['seconds'] = time.perf_counter() - t1
+
+    print(f'embedding store: {store.path}, model: {store.model}, dims: {store.dims}, rows: {store.count}')
+    if report['dims_mismatch']:
+        print(f'anomaly: dims {store.dims}, expected {EXPECTED_EMBEDDINGS_ARRAY_LENGTH}')
+    for name in ('documents_without_embedding', 'embeddings_without_document',
+                 'non_finite', 'zero_vectors', 'outlying_norms'):
+        if report[name]['count'] > 0:
+            print('anomaly: {} {}: {}'.format(report[name]['count'], name, ' '.join(report[name]['ids'][:10])))
+    for name in ('exact_duplicates', 'near_duplicates'):
+        for ids in report[name]['listed'][:10]:
+            print('anomaly: {} of different texts: {}'.format(name, ' '.join(ids[:10])))
+    print('norms: {}'.format(json.dumps(report['norms'])))
+    print('exact duplicate groups: {}, of different texts: {}; near-duplicate clusters: {}, of different texts: {}'.format(
+        report['exact_duplicates']['groups'], report['exact_duplicates']['different_texts_groups'],
+        report['near_duplicates']['groups'], report['near_duplicates']['different_texts_groups']))
+    print('documents: {}, scanned in {:.3f}s'.format(len(texts), report['seconds']))
+    FS.write_json(report, 'tmp/scan_embeddings_report.json')
+
+def reduce_embeddings(method=REDUCTION_METHOD, dims=REDUCED_DIMS):
+    """
+    Project the embeddings to fewer dims, with PCA fitted to the corpus or a
+    seeded random projection, and write the reduced vectors to another
+    EmbeddingStore file.  The projection is saved, so that query vectors
+    can be transformed in the same way.
+    """
+    print(f'=== reduce_embeddings, method: {method}, dims: {dims}')
+    store = EmbeddingStore(embeddings_file())
+    t1 = time.perf_counter()
+    reduction = EmbeddingReduction.create(method, store.matrix, dims)
+    reduction.save(reduction_file(method, dims))
+    print('file written: {}, fitted in {:.3f}s'.format(reduction_file(method, dims), time.perf_counter() - t1))
+    if reduction.explained_variance_ratio is not None:
+        print('explained variance: {:.4f}'.format(float(reduction.explained_variance_ratio.sum())))
+    outfile = reduced_embeddings_file(method, dims)
+    with EmbeddingStore.writer(outfile, dims, f'{store.model}/{method}-{dims}') as reduced:
+        for start in range(0, store.count, EMBEDDINGS_CHUNK_SIZE):
+            vectors = reduction.transform(store.matrix[start:start + EMBEDDINGS_CHUNK_SIZE])
+            for pid, vector in zip(store.ids[start:start + EMBEDDINGS_CHUNK_SIZE], vectors):
+                reduced.add(pid, vector)
+    print(f'file written: {outfile}, rows: {len(reduced.ids)}, dims: {dims}')
+
+def reduction_report():
+    """
+    Report the recall@10 of exact search over the PCA and random projections
+    of the embeddings, at each of REDUCTION_REPORT_DIMS, against exact search
+    over the full embeddings, for a sample of query players.
+    """
+    print('=== reduction_report')
+    store = EmbeddingStore(embeddings_file())
+    matrix = np.asarray(store.matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    matrix = matrix / np.where(norms > 0, norms, 1.0)
+    rng = np.random.default_rng(NEIGHBORS_REPORT_SEED)
+    queries = rng.choice(len(matrix), size=min(NEIGHBORS_REPORT_QUERIES, len(matrix)), replace=False)
+    exact = top_k_neighbors(matrix, queries, NEIGHBORS_K)
+    report = {}
+    report['model'] = store.model
+    report['rows'] = store.count
+    report['dims'] = store.dims
+    report['queries'] = len(queries)
+    report['k'] = NEIGHBORS_K
+    report['results'] = []
+    max_dims = min(max(REDUCTION_REPORT_DIMS), store.dims)
+    for method in ('pca', 'random'):
+        t1 = time.perf_counter()
+        fitted = EmbeddingReduction.create(method, matrix, max_dims, NEIGHBORS_REPORT_SEED)
+        fit_seconds = time.perf_counter() - t1
+        for dims in [d for d in REDUCTION_REPORT_DIMS if d <= max_dims]:
+            reduction = fitted.truncated(dims)
+            reduced = reduction.transform(matrix)
+            neighbors = top_k_neighbors(reduced, queries, NEIGHBORS_K)
+            hits = [len(set(a) & set(b)) for a, b in zip(exact.tolist(), neighbors.tolist())]
+            entry = {}
+            entry['method'] = method
+            entry['dims'] = dims
+            entry['recall_at_k'] = float(np.mean(hits)) / NEIGHBORS_K
+            entry['bytes_per_vector'] = dims * 4
+            entry['size_ratio'] = dims / store.dims
+            entry['fit_seconds'] = fit_seconds
+            if reduction.explained_variance_ratio is not None:
+                entry['explained_variance'] = float(reduction.explained_variance_ratio.sum())
+            report['results'].append(entry)
+            print('{:<8} dims: {:>5}  recall@{}: {:.4f}  bytes/vector: {:>6}'.format(
+                method, dims, NEIGHBORS_K, entry['recall_at_k'], entry['bytes_per_vector']))
+    FS.write_json(report, 'tmp/reduction_report.json')
+
+def quantize_embeddings(codec_name=QUANTIZATION_CODEC):
+    """
+    Encode the embeddings with the given codec, and save the fitted codec and
+    the codes, in the row order of the embedding store, to an .npz file.
+    """
+    print(f'=== quantize_embeddings, codec: {codec_name}')
+    store = EmbeddingStore(embeddings_file())
+    t1 = time.perf_counter()
+    codec = create_codec(codec_name).fit(store.matrix)
+    codes = codec.encode(store.matrix)
+    codec.save(quantized_embeddings_file(codec_name), codes)
+    print('file written: {}, rows: {}, bytes per vector: {} of {}, encoded in {:.3f}s'.format(
+        quantized_embeddings_file(codec_name), len(codes), codec.bytes_per_vector(store.dims),
+        store.dims * 4, time.perf_counter() - t1))
+
+def quantization_report():
+    """
+    Report the size, reconstruction error, and the recall@10 of search by the
+    codec scores, against exact search over the float32 embeddings, of each
+    codec, for a sample of query players.
+    """
+    print('=== quantization_report')
+    store = EmbeddingStore(embeddings_file())
+    matrix = np.asarray(store.matrix, dtype=np.float32)
+    rng = np.random.default_rng(NEIGHBORS_REPORT_SEED)
+    queries = rng.choice(len(matrix), size=min(NEIGHBORS_REPORT_QUERIES, len(matrix)), replace=False)
+    exact = top_k_neighbors(matrix, queries, NEIGHBORS_K)
+    report = {}
+    report['model'] = store.model
+    report['rows'] = store.count
+    report['dims'] = store.dims
+    report['queries'] = len(queries)
+    report['k'] = NEIGHBORS_K
+    report['float32_mb'] = Bytes.as_megabytes(matrix.nbytes)
+    report['cluster_means_identical'] = cluster_means_check()
+    print(f"cluster_means identical to np.add.at: {report['cluster_means_identical']}")
+    report['results'] = []
+    for codec_name in CODECS:
+        t1 = time.perf_counter()
+        codec = create_codec(codec_name).fit(matrix)
+        codes = codec.encode(matrix)
+        encode_seconds = time.perf_counter() - t1
+        t1 = time.perf_counter()
+        scores = codec.scores(matrix[queries], codes)
+        search_seconds = time.perf_counter() - t1
+        scores[np.arange(len(queries)), queries] = -np.inf
+        top = np.argpartition(-scores, NEIGHBORS_K - 1, axis=1)[:, :NEIGHBORS_K]
+        hits = [len(set(a) & set(b)) for a, b in zip(exact.tolist(), top.tolist())]
+        errors = matrix[queries] - codec.decode(codes[queries])
+        entry = {}
+        entry['codec'] = codec_name
+        entry['bytes_per_vector'] = codec.bytes_per_vector(store.dims)
+        entry['compression'] = (store.dims * 4) / entry['bytes_per_vector']
+        entry['codes_mb'] = Bytes.as_megabytes(codes.nbytes)
+        entry['recall_at_k'] = float(np.mean(hits)) / NEIGHBORS_K
+        entry['reconstruction_mse'] = float(np.mean(errors * errors))
+        entry['encode_seconds'] = encode_seconds
+        entry['search_ms_per_query'] = 1000.0 * search_seconds / max(1, len(queries))
+        report['results'].append(entry)
+        print('{:<8} bytes/vector: {:>5} ({:>4.0f}x)  recall@{}: {:.4f}  mse: {:.3e}  search: {:.3f}ms/query'.format(
+            codec_name, entry['bytes_per_vector'], entry['compression'], NEIGHBORS_K,
+            entry['recall_at_k'], entry['reconstruction_mse'], entry['search_ms_per_query']))
+    FS.write_json(report, 'tmp/quantization_report.json')
+
+def cluster_means_check() -> bool:
+    """
+    Verify the k-means center update of pysrc/quantization.py against an
+    np.add.at reference, with empty clusters, including trailing ones, as
+    the duplicate embeddings of identical embeddings_str values produce.
+    """
+    rows = np.array([[0.0], [0.0], [1.0], [1.0], [10.0], [11.0]], dtype=np.float32)
+    rng = np.random.default_rng(NEIGHBORS_REPORT_SEED)
+    random_rows = rng.standard_normal((1000, 8)).astype(np.float32)
+    cases = [
+        (rows, np.array([0, 0, 1, 1, 1, 1]), 3),
+        (rows, np.array([1, 1, 3, 3, 3, 1]), 6),
+        (random_rows, rng.integers(0, 40, len(random_rows)), 48)]
+    for case_rows, clusters, count in cases:
+        expected = np.zeros((count, case_rows.shape[1]), dtype=np.float64)
+        np.add.at(expected, clusters, case_rows)
+        expected /= np.maximum(np.bincount(clusters, minlength=count), 1)[:, None]
+        means, _ = cluster_means(case_rows, clusters, count)
+        if not np.allclose(means, expected, atol=1e-6):
+            return False
+    return True
+
+def build_neighbor_table(k=NEIGHBOR_TABLE_K):
+    """
+    Compute the k nearest neighbors of every player, by cosine similarity of
+    their embeddings, in blocks of rows, and write them to a NeighborTable file
+    of int32 row indexes and float16 scores, so that the search CLIs can look
+    up the players like a given player without a vector search.  --parallel
+    computes the blocks in a process pool.
+    """
+    print(f'=== build_neighbor_table, k: {k}')
+    store = EmbeddingStore(embeddings_file())
+    workers = (os.cpu_count() or 1) if Env.boolean_arg('--parallel') else 1
+    t1 = time.perf_counter()
+    neighbors, scores = all_pairs_top_k(
+        embeddings_file(), k, NEIGHBOR_TABLE_BLOCK_ROWS, workers=workers, progress=neighbor_table_progress)
+    NeighborTable.write(neighbor_table_file(), store.ids, neighbors, scores, store.model)
+    print('file written: {}, rows: {}, k: {}, {:.1f} MB, workers: {}, in {:.3f}s'.format(
+        neighbor_table_file(), len(neighbors), neighbors.shape[1],
+        Bytes.as_megabytes(neighbors.nbytes + scores.nbytes), workers, time.perf_counter() - t1))
+
+def neighbor_table_progress(done, count, seconds):
+    print('neighbors computed: {} of {} rows, {:.1f}s'.format(done, count, seconds))
+
+def add_feature_vectors():
+    """
+    Write a standardized numeric feature vector of each document with an
+    embeddings_str to an EmbeddingStore file, as a compact alternative to the
+    text embeddings, and the fitted feature scaling to a JSON file.
+    """
+    print('=== add_feature_vectors')
+    players = [doc for doc in FS.read_jsonl(documents_file()) if len(doc.get('embeddings_str') or '') > 0]
+    t1 = time.perf_counter()
+    features = FeatureVectors.fit(players)
+    matrix = features.transform(players)
+    seconds = time.perf_counter() - t1
+    with EmbeddingStore.writer(features_file(), features.dims, FEATURES_MODEL) as store:
+        for player, vector in zip(players, matrix):
+            store.add(player['playerID'], vector)
+    FS.write_json(features.to_dict(), features_scaling_file())
+    print('file written: {}, rows: {}, dims: {}, vectorized in {:.3f}s'.format(
+        features_file(), len(store.ids), features.dims, seconds))
+
+def feature_neighbors_report():
+    """
+    Compare the nearest neighbors of a sample of players by their text
+    embeddings and by their feature vectors: the overlap of the two neighbor
+    lists, how often the neighbors share the player's category and position,
+    the difference of their primary rate stat (era or batting_avg, for the
+    neighbors of the same category), and the storage and exact
+    search cost of each.
+    """
+    print('=== feature_neighbors_report')
+    stores = {'embeddings': EmbeddingStore(embeddings_file()), 'features': EmbeddingStore(features_file())}
+    ids = [pid for pid in stores['features'].ids if stores['embeddings'].row(pid) is not None]
+    pid_set = set(ids)
+    players = {doc['playerID']: doc for doc in FS.read_jsonl(documents_file()) if doc['playerID'] in pid_set}
+    rng = np.random.default_rng(NEIGHBORS_REPORT_SEED)
+    queries = rng.choice(len(ids), size=min(NEIGHBORS_REPORT_QUERIES, len(ids)), replace=False)
+    categories = np.array([players[pid].get('category') or '' for pid in ids])
+    positions = np.array([players[pid].get('primary_position') or '' for pid in ids])
+    rates = np.array([primary_rate(players[pid]) for pid in ids])
+
+    report, neighbors = {}, {}
+    report['players'] = len(ids)
+    report['queries'] = len(queries)
+    report['k'] = NEIGHBORS_K
+    for name, store in stores.items():
+        matrix = np.asarray(store.matrix[[store.row(pid) for pid in ids]], dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms > 0, norms, 1.0)
+        t1 = time.perf_counter()
+        neighbors[name] = top_k_neighbors(matrix, queries, NEIGHBORS_K)
+        seconds = time.perf_counter() - t1
+        same_category = categories[neighbors[name]] == categories[queries][:, None]
+        gaps = np.where(same_category, np.abs(rates[neighbors[name]] - rates[queries][:, None]), np.nan)
+        entry = {}
+        entry['model'] = store.model
+        entry['dims'] = store.dims
+        entry['bytes_per_vector'] = store.dims * 4
+        entry['store_mb'] = Bytes.as_megabytes(os.path.getsize(store.path))
+        entry['search_ms_per_query'] = 1000.0 * seconds / max(1, len(queries))
+        entry['same_category'] = float(np.mean(same_category))
+        entry['same_position'] = float(np.mean(positions[neighbors[name]] == positions[queries][:, None]))
+        entry['mean_rate_gap'] = float(np.nanmean(gaps)) if np.any(np.isfinite(gaps)) else None
+        report[name] = entry
+    overlap = [len(set(a) & set(b)) for a, b in zip(neighbors['embeddings'].tolist(), neighbors['features'].tolist())]
+    report['neighbor_overlap'] = float(np.mean(overlap)) / NEIGHBORS_K if len(overlap) > 0 else 0.0
+    print(json.dumps(report, sort_keys=False, indent=2))
+    for q, query in enumerate(queries[:3]):
+        print(f'neighbors of {player_label(players[ids[query]])}:')
+        for name in stores.keys():
+            print('  {:<10} {}'.format(name, ', '.join(
+                [player_label(players[ids[idx]]) for idx in neighbors[name][q][:5]])))
+    FS.write_json(report, 'tmp/feature_neighbors_report.json')
+
+def top_k_neighbors(matrix: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """ Return the row indexes of the k rows most similar to each query row, excluding itself. """
+    index = ExactIndex(matrix, range(len(matrix)))
+    return index.search(index.matrix[queries], k, exclude=queries)[0]
+
+def primary_rate(player: dict) -> float:
+    """ Return the era of a pitcher or the batting_avg of a fielder, or nan. """
+    if player.get('category') == 'pitcher':
+        return float_value(player.get('pitching', {}).get('calculated', {}), 'era', np.nan)
+    return float_value(player.get('batting', {}).get('calculated', {}), 'batting_avg', np.nan)
+
+def player_label(player: dict) -> str:
+    return '{} {} ({})'.format(player.get('nameFirst', ''), player.get('nameLast', ''), player['playerID'])
 
 def csv_reports():
     print(f'=== csv_reports')
-    infile = '../data/wrangled/documents_with_embeddings.json'
-    documents = FS.read_json(infile)
     pitcher_rows = []
     fielder_rows = []
 
@@ -555,8 +1430,7 @@ def csv_reports():
     pitcher_rows.append(f'{common_cols},{pitcher_cols}')
     fielder_rows.append(f'{common_cols},{fielder_cols}')
 
-    for pid in sorted(documents.keys()):
-        player = documents[pid]
+    for player in FS.read_jsonl(documents_file()):
         cat = player['category']
         if cat == 'pitcher':
             pitcher_rows.append(player['embeddings_str'])
@@ -573,8 +1447,8 @@ def float_value(dictionary: dict, key: str, default_value: float) -> float:
         return float(default_value)
 
 def appearances_df():
-    infile = '../data/seanhahman-baseballdatabank-2023.1/core/Appearances.csv'
-    df = pd.read_csv(infile)
+    infile = source_file('Appearances.csv')
+    df = read_source(infile, SOURCE_SCHEMAS['Appearances.csv'])
     df = df.dropna()
     if verbose():
         cols = list(df.columns.values)
@@ -584,8 +1458,8 @@ def appearances_df():
     return df
 
 def people_df():
-    infile = '../data/seanhahman-baseballdatabank-2023.1/core/People.csv'
-    df = pd.read_csv(infile)
+    infile = source_file('People.csv')
+    df = read_source(infile, SOURCE_SCHEMAS['People.csv'])
     if verbose():
         cols = list(df.columns.values)
         cols_str = ",".join(cols)
@@ -594,8 +1468,8 @@ def people_df():
     return df
 
 def batters_df():
-    infile = '../data/seanhahman-baseballdatabank-2023.1/core/Batting.csv'
-    df = pd.read_csv(infile)
+    infile = source_file('Batting.csv')
+    df = read_source(infile, SOURCE_SCHEMAS['Batting.csv'])
     if verbose():
         cols = list(df.columns.values)
         cols_str = ",".join(cols)
@@ -604,8 +1478,8 @@ def batters_df():
     return df
 
 def pitchers_df():
-    infile = '../data/seanhahman-baseballdatabank-2023.1/core/Pitching.csv'
-    df = pd.read_csv(infile)
+    infile = source_file('Pitching.csv')
+    df = read_source(infile, SOURCE_SCHEMAS['Pitching.csv'])
     if verbose():
         cols = list(df.columns.values)
         cols_str = ",".join(cols)
@@ -613,6 +1487,137 @@ def pitchers_df():
         print(f"pitchers_df columns: {cols_str}")
     return df
 
+def read_source(infile, schema):
+    """
+    Return the typed DataFrame of the given source csv file, memory-mapped
+    from the Arrow source cache when the csv is unchanged since it was
+    cached.  --no-source-cache always parses the csv.
+    """
+    if Env.boolean_arg('--no-source-cache'):
+        return read_source_csv(infile, schema)
+    cache = SourceCache(SOURCE_CACHE_DIR, verbose())
+    return cache.read(infile, schema, lambda: read_source_csv(infile, schema))
+
+def read_source_csv(infile, schema):
+    """
+    Read only the columns declared in the given schema, with compact dtypes.
+    Count columns are parsed as float32, then narrowed to int32 if they have
+    no missing values; this matches the int64/float64 inference of a plain
+    read_csv, so the text written downstream is unchanged.
+    """
+    dtypes = {col: SOURCE_KIND_DTYPES[kind] for col, kind in schema.items()}
+    df = pd.read_csv(infile, usecols=list(schema.keys()), dtype=dtypes)
+    for col, kind in schema.items():
+        if kind == 'count' and not df[col].isna().any():
+            df[col] = df[col].astype('int32')
+    return df[list(schema.keys())]
+
+def ingestion_report():
+    """
+    Compare the parse time and peak memory of a plain read_csv of each source
+    file with the typed, column-pruned read_source_csv ingestion, and with a
+    read of the memory-mapped Arrow source cache.
+    """
+    print('=== ingestion_report')
+    report = []
+    for basename in SOURCE_SCHEMAS.keys():
+        infile = source_file(basename)
+        if not os.path.isfile(infile):
+            print(f'source file not found: {infile}')
+            continue
+        readers = {}
+        readers['untyped'] = lambda: pd.read_csv(infile)
+        readers['typed'] = lambda: read_source_csv(infile, SOURCE_SCHEMAS[basename])
+        readers['cached'] = lambda: read_source(infile, SOURCE_SCHEMAS[basename])
+        read_source(infile, SOURCE_SCHEMAS[basename])  # populate the source cache
+        for name, reader in readers.items():
+            t1 = time.perf_counter()
+            df = reader()
+            seconds = time.perf_counter() - t1
+            del df
+            tracemalloc.start()
+            df = reader()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            entry = {}
+            entry['file'] = basename
+            entry['reader'] = name
+            entry['rows'] = len(df)
+            entry['cols'] = len(df.columns)
+            entry['seconds'] = seconds
+            entry['peak_mb'] = Bytes.as_megabytes(peak)
+            entry['frame_mb'] = Bytes.as_megabytes(int(df.memory_usage(deep=True).sum()))
+            report.append(entry)
+            print('{:<16} {:<8} rows: {:>7} cols: {:>3} parse: {:.3f}s peak: {:8.2f}MB frame: {:8.2f}MB'.format(
+                basename, name, entry['rows'], entry['cols'], seconds, entry['peak_mb'], entry['frame_mb']))
+    FS.write_json(report, 'tmp/ingestion_report.json')
+
+def text_df(df):
+    """
+    Return a copy of the given df with every value as the text that
+    write_df would write for it, and missing values as ''.  The in-memory
+    equivalent of writing the df to csv and reading it back as text.
+    """
+    return df.astype(str).where(df.notna(), '')
+
+def read_text_df(infile):
+    """
+    Return the given csv file as a df of text values, with empty fields as
+    '' rather than NaN; the same values FS.read_csv_as_dicts would return.
+    """
+    return pd.read_csv(infile, dtype=object, keep_default_na=False)
+
+def records(df):
+    """
+    Return the rows of the given df as a list of dicts; a faster equivalent
+    of df.to_dict(orient='records') for frames of text values.
+    """
+    cols = list(df.columns)
+    with gc_paused():
+        return [dict(zip(cols, values)) for values in zip(*[df[col].tolist() for col in cols])]
+
+@contextmanager
+def gc_paused():
+    """
+    Pause the cyclic garbage collector while building many small dicts,
+    none of which can be part of a reference cycle; otherwise repeated
+    collections over the growing list take about as long as the build.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def source_file(basename):
+    return f'{SOURCE_DATA_DIR}/{basename}'
+
+def documents_file():
+    return '../data/wrangled/documents.jsonl'
+
+def embeddings_file():
+    return '../data/wrangled/embeddings.f32'
+
+def reduction_file(method: str, dims: int) -> str:
+    return f'../data/wrangled/reduction_{method}_{dims}.npz'
+
+def neighbor_table_file():
+    return '../data/wrangled/neighbors.bin'
+
+def reduced_embeddings_file(method: str, dims: int) -> str:
+    return f'../data/wrangled/embeddings_{method}_{dims}.f32'
+
+def quantized_embeddings_file(codec_name: str) -> str:
+    return f'../data/wrangled/embeddings_{codec_name}.npz'
+
+def features_file():
+    return '../data/wrangled/features.f32'
+
+def features_scaling_file():
+    return '../data/wrangled/features.json'
+
 def include_only_cols(df, cols_to_keep):
     col_names = list(df.columns.values)
     cols_to_delete = []
@@ -635,6 +1640,18 @@ def verbose():
             return True
     return False
 
+def write_tmp():
+    for arg in sys.argv:
+        if arg == '--write-tmp':
+            return True
+    return False
+
+def columnar():
+    for arg in sys.argv:
+        if arg == '--columnar':
+            return True
+    return False
+
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
@@ -650,20 +1667,50 @@ if __name__ == "__main__":
                 prune_batters()
             elif func == 'prune_pitchers':
                 prune_pitchers()
+            elif func == 'prune_parallel':
+                prune_parallel()
             elif func == 'calc_player_positions':
                 calc_player_positions()
             elif func == 'calc_player_teams':
                 calc_player_teams()
+            elif func == 'calc_timings':
+                calc_timings()
             elif func == 'calc_batters_stats':
                 calc_batters_stats()
             elif func == 'calc_pitchers_stats':
                 calc_pitchers_stats()
             elif func == 'build_documents':
                 build_documents()
+            elif func == 'run_all':
+                run_all()
+            elif func == 'make':
+                make()
+            elif func == 'ingestion_report':
+                ingestion_report()
             elif func == 'add_embeddings_to_documents':
                 add_embeddings()
             elif func == 'scan_embeddings':
                 scan_embeddings()
+            elif func == 'reduce_embeddings':
+                if len(sys.argv) > 3:
+                    reduce_embeddings(sys.argv[2], int(sys.argv[3]))
+                else:
+                    reduce_embeddings()
+            elif func == 'reduction_report':
+                reduction_report()
+            elif func == 'quantize_embeddings':
+                if len(sys.argv) > 2:
+                    quantize_embeddings(sys.argv[2])
+                else:
+                    quantize_embeddings()
+            elif func == 'quantization_report':
+                quantization_report()
+            elif func == 'build_neighbor_table':
+                build_neighbor_table()
+            elif func == 'add_feature_vectors':
+                add_feature_vectors()
+            elif func == 'feature_neighbors_report':
+                feature_neighbors_report()
             elif func == 'csv_reports':
                 csv_reports()
             else:
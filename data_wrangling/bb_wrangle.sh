@@ -15,10 +15,10 @@ python bb_wrangle.py prune_batters
 python bb_wrangle.py prune_pitchers
 
 # Read the pruned CSV files, produce JSON files with calculated attributes.
-python bb_wrangle.py calc_player_positions
-python bb_wrangle.py calc_player_teams
-python bb_wrangle.py calc_batters_stats
-python bb_wrangle.py calc_pitchers_stats
+python bb_wrangle.py calc_player_positions --columnar
+python bb_wrangle.py calc_player_teams --columnar
+python bb_wrangle.py calc_batters_stats --columnar
+python bb_wrangle.py calc_pitchers_stats --columnar
 
 # Build/assemble the three document types from the joined data.
 # The output JSON files are saved in GitHub for end-user/customer processing.
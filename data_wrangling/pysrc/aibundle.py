@@ -3,7 +3,7 @@ Module aibundle.py - bundled standard codebase.
 Copyright (c) 2023 Chris Joakim, MIT License
 Timestamp: 2023-08-10 13:28
 
-Usage:  from pysrc.aibundle import Bytes, CogSearchClient, CogSvcsClient, Counter, Env, FS, Mongo, OpenAIClient, Storage, System
+Usage:  from pysrc.aibundle import Bytes, CogSearchClient, CogSvcsClient, Counter, EmbeddingStore, EmbeddingStoreWriter, Env, FS, Mongo, NeighborTable, OpenAIClient, Storage, System
 """
 
 import csv
@@ -11,6 +11,7 @@ import json
 import os
 import platform
 import socket
+import struct
 import sys
 import time
 import traceback
@@ -18,6 +19,7 @@ import uuid
 
 import certifi
 import matplotlib
+import numpy as np
 import openai
 import pandas as pd
 import psutil
@@ -25,7 +27,7 @@ import requests
 import tiktoken
 
 from numbers import Number
-from typing import Iterator
+from typing import Iterable, Iterator
 
 from azure.storage.blob import BlobServiceClient
 from bson.objectid import ObjectId
@@ -787,6 +789,214 @@ class Counter():
         return self.data
 # ==============================================================================
 
+class EmbeddingStore():
+    """
+    A float32 matrix of embeddings in a binary file, one row per document,
+    after a 64-byte header with the dims, row count, and embedding model.
+    The sidecar '<file>.ids' text file has the document id of each row.
+    The matrix is opened with numpy.memmap, so vectors are read zero-copy
+    from the page cache rather than parsed from JSON text.
+    """
+    MAGIC = b'EMBSTORE'
+    VERSION = 1
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sIIQ40s'  # magic, version, dims, count, model
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(file=path, mode='rb') as file:
+            header = file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise ValueError(f'truncated embedding store header: {path}')
+        magic, version, dims, count, model = struct.unpack(self.HEADER_FORMAT, header)
+        if magic != self.MAGIC:
+            raise ValueError(f'not an embedding store file: {path}')
+        if version != self.VERSION:
+            raise ValueError(f'unsupported embedding store version {version}: {path}')
+        self.dims = dims
+        self.count = count
+        self.model = model.rstrip(b'\0').decode('utf-8')
+        if count > 0:
+            self.matrix = np.memmap(path, dtype='<f4', mode='r',
+                offset=self.HEADER_SIZE, shape=(count, dims))
+        else:
+            self.matrix = np.zeros((0, dims), dtype='<f4')
+        with open(file=self.ids_file(path), encoding='utf-8', mode='rt') as file:
+            self.ids = [line.strip() for line in file if len(line.strip()) > 0]
+        if len(self.ids) != count:
+            raise ValueError(f'embedding store has {count} rows but {len(self.ids)} ids: {path}')
+        self.rows = {id: idx for idx, id in enumerate(self.ids)}
+
+    @classmethod
+    def ids_file(cls, path: str) -> str:
+        return f'{path}.ids'
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.isfile(path) and os.path.isfile(cls.ids_file(path))
+
+    @classmethod
+    def writer(cls, path: str, dims: int, model: str) -> 'EmbeddingStoreWriter':
+        return EmbeddingStoreWriter(path, dims, model)
+
+    def row(self, id: str) -> int | None:
+        """ Return the matrix row index of the given document id, or None. """
+        return self.rows.get(id)
+
+    def vector(self, id: str) -> np.ndarray | None:
+        """ Return the read-only, memory-mapped vector of the given document id, or None. """
+        idx = self.rows.get(id)
+        if idx is None:
+            return None
+        return self.matrix[idx]
+
+    def close(self) -> None:
+        """ Release the memory map; vectors returned by vector() are invalid after this. """
+        if isinstance(self.matrix, np.memmap):
+            self.matrix._mmap.close()
+        self.matrix = None
+
+
+class EmbeddingStoreWriter():
+    """
+    Appends vectors to a new EmbeddingStore file.  The file and its ids file
+    are written under temporary names, and are renamed into place, with the
+    final row count in the header, by close().  Use as a context manager.
+    """
+    def __init__(self, path: str, dims: int, model: str):
+        self.path = path
+        self.dims = dims
+        self.model = model
+        self.ids = []
+        self.tmp_file = f'{path}.{os.getpid()}.tmp'
+        self.file = open(file=self.tmp_file, mode='wb')
+        self.file.write(self.header(0))
+
+    def header(self, count: int) -> bytes:
+        model = self.model.encode('utf-8')[:40]
+        return struct.pack(EmbeddingStore.HEADER_FORMAT,
+            EmbeddingStore.MAGIC, EmbeddingStore.VERSION, self.dims, count, model)
+
+    def add(self, id: str, vector) -> bool:
+        """ Append the given vector; return False, and skip it, if it has the wrong dims. """
+        values = np.asarray(vector, dtype='<f4')
+        if values.shape != (self.dims,):
+            return False
+        self.file.write(values.tobytes())
+        self.ids.append(id)
+        return True
+
+    def close(self) -> None:
+        self.file.seek(0)
+        self.file.write(self.header(len(self.ids)))
+        self.file.close()
+        ids_tmp_file = f'{EmbeddingStore.ids_file(self.path)}.{os.getpid()}.tmp'
+        with open(file=ids_tmp_file, encoding='utf-8', mode='w') as file:
+            for id in self.ids:
+                file.write(id + "\n")
+        os.replace(self.tmp_file, self.path)
+        os.replace(ids_tmp_file, EmbeddingStore.ids_file(self.path))
+
+    def abort(self) -> None:
+        """ Discard the vectors written so far, leaving any existing store as it was. """
+        self.file.close()
+        os.remove(self.tmp_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# ==============================================================================
+
+class NeighborTable():
+    """
+    The precomputed k nearest neighbors of every document in a binary file,
+    after a 64-byte header with k, the row count, and the embedding model:
+    a (count, k) int32 matrix of neighbor row indexes, nearest first, then a
+    (count, k) float16 matrix of their cosine similarities.  The sidecar
+    '<file>.ids' text file has the document id of each row.  The matrices
+    are opened with numpy.memmap, so a lookup reads one row of each.
+    """
+    MAGIC = b'NBRTABLE'
+    VERSION = 1
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sIIQ40s'  # magic, version, k, count, model
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(file=path, mode='rb') as file:
+            header = file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise ValueError(f'truncated neighbor table header: {path}')
+        magic, version, k, count, model = struct.unpack(self.HEADER_FORMAT, header)
+        if magic != self.MAGIC:
+            raise ValueError(f'not a neighbor table file: {path}')
+        if version != self.VERSION:
+            raise ValueError(f'unsupported neighbor table version {version}: {path}')
+        self.k = k
+        self.count = count
+        self.model = model.rstrip(b'\0').decode('utf-8')
+        if count > 0 and k > 0:
+            self.neighbors = np.memmap(path, dtype='<i4', mode='r',
+                offset=self.HEADER_SIZE, shape=(count, k))
+            self.scores = np.memmap(path, dtype='<f2', mode='r',
+                offset=self.HEADER_SIZE + count * k * 4, shape=(count, k))
+        else:
+            self.neighbors = np.zeros((count, k), dtype='<i4')
+            self.scores = np.zeros((count, k), dtype='<f2')
+        with open(file=self.ids_file(path), encoding='utf-8', mode='rt') as file:
+            self.ids = [line.strip() for line in file if len(line.strip()) > 0]
+        if len(self.ids) != count:
+            raise ValueError(f'neighbor table has {count} rows but {len(self.ids)} ids: {path}')
+        self.rows = {id: idx for idx, id in enumerate(self.ids)}
+
+    @classmethod
+    def ids_file(cls, path: str) -> str:
+        return f'{path}.ids'
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        return os.path.isfile(path) and os.path.isfile(cls.ids_file(path))
+
+    @classmethod
+    def write(cls, path: str, ids: list[str], neighbors: np.ndarray, scores: np.ndarray, model: str) -> None:
+        """ Write a neighbor table file, and its ids file, under temporary names renamed into place. """
+        count, k = neighbors.shape
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(file=tmp_file, mode='wb') as file:
+            file.write(struct.pack(cls.HEADER_FORMAT, cls.MAGIC, cls.VERSION, k, count, model.encode('utf-8')[:40]))
+            file.write(np.ascontiguousarray(neighbors, dtype='<i4').tobytes())
+            file.write(np.ascontiguousarray(scores, dtype='<f2').tobytes())
+        ids_tmp_file = f'{cls.ids_file(path)}.{os.getpid()}.tmp'
+        with open(file=ids_tmp_file, encoding='utf-8', mode='w') as file:
+            for id in ids:
+                file.write(id + "\n")
+        os.replace(tmp_file, path)
+        os.replace(ids_tmp_file, cls.ids_file(path))
+
+    def lookup(self, id: str, k: int = None) -> list[tuple[str, float]] | None:
+        """ Return the ids and similarities of the k nearest neighbors of the given document id, or None. """
+        idx = self.rows.get(id)
+        if idx is None:
+            return None
+        k = self.k if k is None else min(k, self.k)
+        return [(self.ids[n], float(s)) for n, s in zip(self.neighbors[idx, :k].tolist(), self.scores[idx, :k].tolist())]
+
+    def close(self) -> None:
+        """ Release the memory maps. """
+        for matrix in (self.neighbors, self.scores):
+            if isinstance(matrix, np.memmap):
+                matrix._mmap.close()
+        self.neighbors = self.scores = None
+
+# ==============================================================================
+
 class Env():
     """
     This class is used to read the host environment, such as username and
@@ -975,6 +1185,36 @@ class FS():
                 if verbose is True:
                     print(f'file written: {outfile}')
 
+    @classmethod
+    def read_jsonl(cls, infile: str) -> Iterator[dict] | None:
+        """
+        Return a generator of the objects in the given JSON Lines file, parsed
+        one line at a time so that the whole file is never held in memory.
+        """
+        if os.path.isfile(infile):
+            with open(file=infile, encoding='utf-8', mode='rt') as file:
+                for line in file:
+                    if len(line.strip()) > 0:
+                        yield json.loads(line)
+
+    @classmethod
+    def write_jsonl(cls, objects: Iterable, outfile: str, verbose=True) -> int:
+        """
+        Write each of the given objects, which may be a generator, to the given
+        file as one line of JSON.  The file is written under a temporary name
+        and renamed when complete.  Return the number of objects written.
+        """
+        count, tmp_file = 0, f'{outfile}.{os.getpid()}.tmp'
+        with open(file=tmp_file, encoding='utf-8', mode='w') as file:
+            for obj in objects:
+                file.write(json.dumps(obj))
+                file.write("\n")
+                count += 1
+        os.replace(tmp_file, outfile)
+        if verbose is True:
+            print(f'file written: {outfile}, lines: {count}')
+        return count
+
     @classmethod
     def text_file_iterator(cls, infile: str) -> Iterator[str] | None:
         """ Return a line generator that can be iterated with iterate() """
@@ -1300,6 +1540,21 @@ class OpenAIClient(object):
         self.embeddings_pause_seconds = 150.0
         self.retry_count = 5
 
+        # batched embedding requests; Azure OpenAI accepts at most 16 inputs
+        # per request, and each input is limited to 8191 tokens.
+        self.embeddings_batch_size = 16 if self.type == 'azure' else 2048
+        self.embeddings_batch_tokens = 8191
+        self.embeddings_max_input_tokens = 8191
+
+        # an optional persistent cache of embeddings, with get_many(model, texts)
+        # and put_many(model, texts, embeddings) methods; see embeddingcache.py
+        self.embedding_cache = None
+
+        # an optional local embedding provider, with model and dims attributes
+        # and a create_embeddings(texts) method, which is called instead of
+        # the OpenAI API; see embeddingprovider.py
+        self.embedding_provider = None
+
         # override default embedding and encoding values
 
         if 'encoding_model' in opts.keys():
@@ -1312,8 +1567,18 @@ class OpenAIClient(object):
             self.embeddings_pause_seconds = float(opts['embeddings_pause_seconds'])
         if 'retry_count' in opts.keys():
             self.retry_count = int(opts['retry_count'])
+        if 'embeddings_batch_size' in opts.keys():
+            self.embeddings_batch_size = int(opts['embeddings_batch_size'])
+        if 'embeddings_batch_tokens' in opts.keys():
+            self.embeddings_batch_tokens = int(opts['embeddings_batch_tokens'])
 
-        self.encoding = tiktoken.get_encoding(self.encoding_model)
+        try:
+            self.encoding = tiktoken.get_encoding(self.encoding_model)
+        except Exception as e:
+            # tiktoken downloads the encoding on first use; without a network,
+            # get_token_count estimates the count instead.
+            print("tiktoken encoding {} unavailable: {}".format(self.encoding_model, str(e)))
+            self.encoding = None
 
     def get_config(self) -> dict:
         """ return a dict containing the config values for this client """
@@ -1330,6 +1595,11 @@ class OpenAIClient(object):
         config['embeddings_sleep_seconds'] = self.embeddings_sleep_seconds
         config['embeddings_pause_seconds'] = self.embeddings_pause_seconds
         config['retry_count'] = self.retry_count
+        config['embeddings_batch_size'] = self.embeddings_batch_size
+        config['embeddings_batch_tokens'] = self.embeddings_batch_tokens
+        config['embedding_provider'] = None
+        if self.embedding_provider is not None:
+            config['embedding_provider'] = self.embedding_provider.model
         return config
 
     def list_deployments(self) -> None:
@@ -1358,10 +1628,15 @@ class OpenAIClient(object):
     def get_embedding(self, text):
         # This method implements limited retry logic with linear backoff
         # to handle possible OpenAI API rate limiting.
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.get_many(self.embedding_model, [text])[0]
+            if cached is not None:
+                return cached
         for n in range(self.retry_count):
             #print('get_embedding for text: {}'.format(text))
             e = self.try_get_embedding(text)
             if e != None:
+                self.cache_embeddings([text], [e])
                 return e
         raise Exception('unable to get embedding for text: {}'.format(text))
 
@@ -1373,6 +1648,8 @@ class OpenAIClient(object):
         try:
             time.sleep(self.embeddings_sleep_seconds)
             text = text.replace("\n", ' ')
+            if self.embedding_provider is not None:
+                return self.embedding_provider.create_embeddings([text])[0]
             e = openai.Embedding.create(input=[text], engine=self.embedding_model)
             return e['data'][0]['embedding']  # returns a list of 1536 floats!
         except Exception as e:
@@ -1384,7 +1661,105 @@ class OpenAIClient(object):
             time.sleep(self.embeddings_pause_seconds)
             return None
 
+    def get_embeddings(self, texts: list[str]) -> list[list[float] | None]:
+        """
+        Return the embeddings of the given texts, in the same order, requesting
+        them in batches of several texts per HTTP request.  Each batch is retried
+        like get_embedding; the embeddings of a batch which still fails are None.
+        Texts found in the embedding_cache, if any, are not requested.
+        """
+        results, misses = self.cached_embeddings(texts)
+        texts = [texts[idx].replace("\n", ' ') for idx in misses]
+        for batch in self.embedding_batches(texts):
+            batch_texts = [texts[idx] for idx in batch]
+            embeddings = None
+            for n in range(self.retry_count):
+                embeddings = self.try_get_embeddings(batch_texts)
+                if embeddings != None:
+                    break
+            if embeddings == None:
+                print('unable to get embeddings for batch of {} texts'.format(len(batch)))
+                continue
+            self.cache_embeddings(batch_texts, embeddings)
+            for idx, embedding in zip(batch, embeddings):
+                results[misses[idx]] = embedding
+        return results
+
+    def cached_embeddings(self, texts: list[str]) -> tuple[list, list[int]]:
+        """
+        Return a list of the embedding_cache embeddings of the given texts, with
+        None for those not cached, and the list of the indexes not cached.
+        """
+        if self.embedding_cache is None:
+            return [None] * len(texts), list(range(len(texts)))
+        results = self.embedding_cache.get_many(self.embedding_model, texts)
+        return results, [idx for idx, embedding in enumerate(results) if embedding is None]
+
+    def cache_embeddings(self, texts: list[str], embeddings: list) -> None:
+        if self.embedding_cache is not None:
+            self.embedding_cache.put_many(self.embedding_model, texts, embeddings)
+
+    def embedding_batches(self, texts: list[str]) -> list[list[int]]:
+        """
+        Return lists of indexes into the given texts, in order, where each list
+        has at most embeddings_batch_size texts with at most embeddings_batch_tokens
+        tokens in total.  A text over the per-input token limit is sent alone.
+        """
+        batches, batch, batch_tokens = [], [], 0
+        for idx, text in enumerate(texts):
+            tokens = self.get_token_count(text)
+            if tokens > self.embeddings_max_input_tokens:
+                print('text at index {} has {} tokens, over the input limit of {}'.format(
+                    idx, tokens, self.embeddings_max_input_tokens))
+                if len(batch) > 0:
+                    batches.append(batch)
+                batches.append([idx])
+                batch, batch_tokens = [], 0
+                continue
+            full = len(batch) >= self.embeddings_batch_size
+            if len(batch) > 0 and (full or batch_tokens + tokens > self.embeddings_batch_tokens):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(idx)
+            batch_tokens += tokens
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    def try_get_embeddings(self, texts: list[str]) -> list[list[float]] | None:
+        try:
+            time.sleep(self.embeddings_sleep_seconds)
+            return self.create_embeddings(texts)
+        except Exception as e:
+            print("try_get_embeddings exception: {}".format(str(e)))
+            traceback.print_exc()
+            self.embeddings_sleep_seconds = (self.embeddings_sleep_seconds) * 1.5
+            print('new embeddings_sleep_seconds is {}'.format(self.embeddings_sleep_seconds))
+            print('pausing for {} seconds'.format(self.embeddings_pause_seconds))
+            time.sleep(self.embeddings_pause_seconds)
+            return None
+
+    def create_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """
+        Return the embeddings of the given texts from a single Embedding.create
+        request, with no sleep or retry; exceptions are raised to the caller.
+        The response data items carry the index of their input text, and are
+        not guaranteed to be in input order.  If an embedding_provider is set,
+        it is called instead.
+        """
+        if self.embedding_provider is not None:
+            return self.embedding_provider.create_embeddings(texts)
+        e = openai.Embedding.create(input=texts, engine=self.embedding_model)
+        embeddings = [None] * len(texts)
+        for item in e['data']:
+            embeddings[item['index']] = item['embedding']
+        if any(embedding is None for embedding in embeddings):
+            raise Exception('response is missing embeddings for some of the inputs')
+        return embeddings
+
     def get_token_count(self, text: str) -> int:
+        if self.encoding is None:
+            return (len(text.encode('utf-8')) // 4) + 1  # about 4 bytes per token
         try:
             return len(self.encoding.encode(text))
         except Exception as e:
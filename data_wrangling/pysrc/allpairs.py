@@ -0,0 +1,118 @@
+"""
+Module allpairs.py - the top k neighbors of every vector, by blocked matrix multiplies.
+
+The cosine similarities of every pair of vectors are computed a block of
+rows by a block of columns at a time, so the memory used is bounded by
+block_rows * block_cols floats rather than count * count.  The top k of
+each block of columns are merged into the running top k of each row, and
+a vector is never its own neighbor.  The vectors are normalized once, a
+block at a time, into a temporary memory-mapped .npy file beside the
+EmbeddingStore.  The blocks of rows are independent, so they can be
+computed by a pool of worker processes, each of which memory-maps the
+normalized file once rather than receiving the matrix.
+
+The neighbors are returned as int32 row indexes and the similarities as
+float16, the format of the NeighborTable file.
+
+Usage:
+  from pysrc.allpairs import all_pairs_top_k
+  neighbors, scores = all_pairs_top_k('../data/wrangled/embeddings.f32', 50, workers=4)
+"""
+
+import os
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pysrc.aibundle import EmbeddingStore
+from pysrc.vectorsearch import normalized, top_k
+
+_normalized_matrix = None  # the normalized matrix of a worker process
+
+
+def all_pairs_top_k(path: str, k: int, block_rows=1024, block_cols=16384, workers=1,
+                    progress=None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the (count, k) int32 row indexes and float16 cosine similarities
+    of the k nearest neighbors of each vector of the given EmbeddingStore file,
+    nearest first.  The optional progress function is called with the rows
+    done, the row count, and the elapsed seconds after each block of rows.
+    """
+    fd, normalized_path = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    try:
+        count = write_normalized(path, normalized_path, block_cols)
+        k = max(0, min(k, count - 1))
+        neighbors = np.zeros((count, k), dtype=np.int32)
+        scores = np.zeros((count, k), dtype=np.float16)
+        blocks = [(start, min(start + block_rows, count)) for start in range(0, count, block_rows)]
+        t1 = time.perf_counter()
+        done = 0
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers, initializer=open_normalized,
+                                     initargs=(normalized_path,)) as executor:
+                futures = [executor.submit(top_k_worker_block, start, stop, k, block_cols) for start, stop in blocks]
+                for (start, stop), future in zip(blocks, futures):
+                    neighbors[start:stop], scores[start:stop] = future.result()
+                    done += stop - start
+                    if progress is not None:
+                        progress(done, count, time.perf_counter() - t1)
+        else:
+            matrix = np.load(normalized_path, mmap_mode='r')
+            for start, stop in blocks:
+                neighbors[start:stop], scores[start:stop] = top_k_block(matrix, start, stop, k, block_cols)
+                done += stop - start
+                if progress is not None:
+                    progress(done, count, time.perf_counter() - t1)
+            del matrix
+    finally:
+        os.remove(normalized_path)
+    return neighbors, scores
+
+def write_normalized(path: str, normalized_path: str, block_rows: int) -> int:
+    """
+    Write the unit-length float32 vectors of the given EmbeddingStore file to
+    the given .npy file, a block of rows at a time, and return the row count.
+    """
+    store = EmbeddingStore(path)
+    matrix = np.lib.format.open_memmap(normalized_path, mode='w+', dtype=np.float32,
+                                       shape=(store.count, store.dims))
+    for start in range(0, store.count, block_rows):
+        stop = min(start + block_rows, store.count)
+        matrix[start:stop] = normalized(np.asarray(store.matrix[start:stop], dtype=np.float32))
+    matrix.flush()
+    del matrix
+    count = store.count
+    store.close()
+    return count
+
+def open_normalized(normalized_path: str) -> None:
+    """ The worker process initializer; memory-map the normalized matrix. """
+    global _normalized_matrix
+    _normalized_matrix = np.load(normalized_path, mmap_mode='r')
+
+def top_k_worker_block(start: int, stop: int, k: int, block_cols: int) -> tuple[np.ndarray, np.ndarray]:
+    return top_k_block(_normalized_matrix, start, stop, k, block_cols)
+
+def top_k_block(matrix: np.ndarray, start: int, stop: int, k: int,
+                block_cols: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Return the top k neighbors of rows start to stop of the given normalized matrix. """
+    count = len(matrix)
+    rows = np.asarray(matrix[start:stop])
+    self_rows = np.arange(stop - start)
+    best = np.zeros((stop - start, 0), dtype=np.int64)
+    best_scores = np.zeros((stop - start, 0), dtype=np.float32)
+    for col_start in range(0, count, block_cols):
+        col_stop = min(col_start + block_cols, count)
+        sims = rows @ np.asarray(matrix[col_start:col_stop]).T
+        own = (self_rows + start >= col_start) & (self_rows + start < col_stop)
+        sims[self_rows[own], self_rows[own] + start - col_start] = -np.inf
+        top, top_scores = top_k(sims, min(k, col_stop - col_start))
+        merged = np.concatenate([best, top + col_start], axis=1)
+        merged_scores = np.concatenate([best_scores, top_scores], axis=1)
+        order, best_scores = top_k(merged_scores, min(k, merged_scores.shape[1]))
+        best = np.take_along_axis(merged, order, axis=1)
+    return best.astype(np.int32), best_scores.astype(np.float16)
@@ -0,0 +1,141 @@
+"""
+Module embeddingcache.py - a persistent, content-addressed cache of embeddings.
+
+Embeddings are kept in a SQLite database, keyed by the sha256 of the model
+name and the text exactly as sent to the embeddings API, with each vector
+stored as float32 bytes.  An OpenAIClient given an EmbeddingCache looks up
+each text before requesting it, so a rerun after a small data change only
+requests the new or changed texts.  Entries not used within max_age_days,
+and the least recently used entries beyond max_entries, are evicted.
+
+Usage:
+  from pysrc.embeddingcache import EmbeddingCache
+  cache = EmbeddingCache('tmp/embedding_cache/embeddings.db')
+  oaic.embedding_cache = cache
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+
+class EmbeddingCache():
+
+    def __init__(self, db_file: str, max_entries: int = None, max_age_days: float = None):
+        self.db_file = db_file
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evicted = 0
+        db_dir = os.path.dirname(db_file)
+        if len(db_dir) > 0:
+            os.makedirs(db_dir, exist_ok=True)
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('pragma journal_mode=wal')
+        self.conn.execute("""
+            create table if not exists embeddings (
+                key      text primary key,
+                model    text not null,
+                dims     integer not null,
+                vector   blob not null,
+                created  real not null,
+                accessed real not null)""")
+        self.conn.execute('create index if not exists embeddings_accessed on embeddings(accessed)')
+        self.conn.commit()
+
+    @classmethod
+    def normalized_text(cls, text: str) -> str:
+        """ Return the text as OpenAIClient sends it to the embeddings API. """
+        return text.replace("\n", ' ')
+
+    @classmethod
+    def key(cls, model: str, text: str) -> str:
+        h = hashlib.sha256()
+        h.update(model.encode('utf-8'))
+        h.update(b'\0')
+        h.update(cls.normalized_text(text).encode('utf-8'))
+        return h.hexdigest()
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        """ Return the cached embedding of each of the given texts, or None if not cached. """
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            sql = 'select key, vector from embeddings where key in ({})'.format(','.join('?' * len(chunk)))
+            for key, vector in self.conn.execute(sql, chunk):
+                found[key] = vector
+        results = []
+        for key in keys:
+            if key in found:
+                results.append(np.frombuffer(found[key], dtype='<f4').tolist())
+            else:
+                results.append(None)
+        hit_keys = list(found.keys())
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        if len(hit_keys) > 0:
+            now = time.time()
+            self.conn.executemany(
+                'update embeddings set accessed = ? where key = ?', [(now, key) for key in hit_keys])
+            self.conn.commit()
+        return results
+
+    def put_many(self, model: str, texts: list[str], embeddings: list) -> None:
+        """ Cache the given embeddings of the given texts; None embeddings are skipped. """
+        now, rows = time.time(), []
+        for text, embedding in zip(texts, embeddings):
+            if embedding is not None:
+                vector = np.asarray(embedding, dtype='<f4')
+                rows.append((self.key(model, text), model, len(vector), vector.tobytes(), now, now))
+        if len(rows) > 0:
+            self.conn.executemany(
+                'insert or replace into embeddings values (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+            self.puts += len(rows)
+
+    def evict(self) -> int:
+        """
+        Delete the entries not accessed within max_age_days, then the least
+        recently accessed entries beyond max_entries.  Return the number deleted.
+        """
+        deleted = 0
+        if self.max_age_days is not None:
+            cutoff = time.time() - (float(self.max_age_days) * 86400.0)
+            deleted += self.conn.execute('delete from embeddings where accessed < ?', (cutoff,)).rowcount
+        if self.max_entries is not None:
+            excess = self.count() - int(self.max_entries)
+            if excess > 0:
+                deleted += self.conn.execute("""
+                    delete from embeddings where key in (
+                        select key from embeddings order by accessed limit ?)""", (excess,)).rowcount
+        self.conn.commit()
+        self.evicted += deleted
+        return deleted
+
+    def count(self) -> int:
+        return self.conn.execute('select count(*) from embeddings').fetchone()[0]
+
+    def get_stats(self) -> dict:
+        stats = {}
+        stats['db_file'] = self.db_file
+        stats['entries'] = self.count()
+        stats['hits'] = self.hits
+        stats['misses'] = self.misses
+        lookups = self.hits + self.misses
+        stats['hit_ratio'] = (self.hits / lookups) if lookups > 0 else 0.0
+        stats['puts'] = self.puts
+        stats['evicted'] = self.evicted
+        stats['max_entries'] = self.max_entries
+        stats['max_age_days'] = self.max_age_days
+        if os.path.isfile(self.db_file):
+            stats['db_mb'] = os.path.getsize(self.db_file) / (1024 * 1024)
+        return stats
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,123 @@
+"""
+Module embeddingcheckpoint.py - a durable, append-only log of embeddings.
+
+Each record is the 32-byte sha256 digest of an embedded text followed by its
+float32 vector, after a 64-byte header with the dims and embedding model.
+Records are appended as embeddings are received and flushed to disk with
+sync(), so a run which crashes or is interrupted loses at most the unsynced
+records.  Reopening the log with resume=True keeps its complete, valid
+records and truncates a partially written last record.
+
+Usage:
+  from pysrc.embeddingcheckpoint import EmbeddingCheckpoint
+  checkpoint = EmbeddingCheckpoint('tmp/embeddings_checkpoint.log', 1536, model, resume=True)
+"""
+
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+
+class EmbeddingCheckpoint():
+
+    MAGIC = b'EMBCKPT1'
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sI52s'  # magic, dims, model
+
+    def __init__(self, path: str, dims: int, model: str, resume=False):
+        self.path = path
+        self.dims = dims
+        self.model = model
+        self.record_size = 32 + (4 * dims)
+        self.rows = {}  # digest -> record index
+        self.invalid = 0
+        if resume and os.path.isfile(path):
+            self.load()
+        else:
+            checkpoint_dir = os.path.dirname(path)
+            if len(checkpoint_dir) > 0:
+                os.makedirs(checkpoint_dir, exist_ok=True)
+            with open(file=path, mode='wb') as file:
+                file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, dims, model.encode('utf-8')[:52]))
+        self.file = open(file=path, mode='ab')
+
+    @classmethod
+    def has_records(cls, path: str) -> bool:
+        """ Return True if the given checkpoint file exists and holds at least one record. """
+        return os.path.isfile(path) and os.path.getsize(path) > cls.HEADER_SIZE
+
+    @classmethod
+    def digest(cls, text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def load(self) -> None:
+        with open(file=self.path, mode='rb') as file:
+            header = file.read(self.HEADER_SIZE)
+        if len(header) < self.HEADER_SIZE:
+            raise ValueError(f'truncated checkpoint header: {self.path}')
+        magic, dims, model = struct.unpack(self.HEADER_FORMAT, header)
+        model = model.rstrip(b'\0').decode('utf-8')
+        if magic != self.MAGIC:
+            raise ValueError(f'not an embedding checkpoint file: {self.path}')
+        if dims != self.dims or model != self.model[:52]:
+            raise ValueError(f'checkpoint {self.path} has dims {dims} and model {model}, '
+                f'not {self.dims} and {self.model}; rerun without --resume')
+        count = (os.path.getsize(self.path) - self.HEADER_SIZE) // self.record_size
+        with open(file=self.path, mode='r+b') as file:
+            file.truncate(self.HEADER_SIZE + (count * self.record_size))
+        for idx, record in enumerate(self.records()):
+            vector = record['vector']
+            if np.all(np.isfinite(vector)) and np.any(vector != 0):
+                self.rows[record['digest'].tobytes()] = idx
+            else:
+                self.invalid += 1
+
+    def records(self) -> np.ndarray:
+        """ Return the memory-mapped records, a structured array of digest and vector. """
+        count = (os.path.getsize(self.path) - self.HEADER_SIZE) // self.record_size
+        dtype = np.dtype([('digest', 'u1', (32,)), ('vector', '<f4', (self.dims,))])
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(self.path, dtype=dtype, mode='r', offset=self.HEADER_SIZE, shape=(count,))
+
+    def contains(self, text: str) -> bool:
+        return self.digest(text) in self.rows
+
+    def count(self) -> int:
+        return len(self.rows)
+
+    def append(self, text: str, embedding) -> bool:
+        """
+        Append the given text's embedding; return False, and skip it, if it
+        is not a finite, non-zero vector of the expected dims.
+        """
+        vector = np.asarray(embedding, dtype='<f4')
+        if vector.shape != (self.dims,) or not np.all(np.isfinite(vector)) or not np.any(vector != 0):
+            return False
+        digest = self.digest(text)
+        self.file.write(digest)
+        self.file.write(vector.tobytes())
+        self.rows[digest] = len(self.rows) + self.invalid
+        return True
+
+    def sync(self) -> None:
+        """ Flush the appended records to disk. """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def row(self, text: str) -> int | None:
+        """ Return the record index of the given text's embedding, or None. """
+        return self.rows.get(self.digest(text))
+
+    def vectors(self) -> np.ndarray:
+        """ Return the memory-mapped vectors of the records; call sync() first. """
+        return self.records()['vector']
+
+    def close(self) -> None:
+        self.file.close()
+
+    def remove(self) -> None:
+        self.close()
+        os.remove(self.path)
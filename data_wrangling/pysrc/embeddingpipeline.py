@@ -0,0 +1,277 @@
+"""
+Module embeddingpipeline.py - concurrent, rate-limited embedding requests.
+
+The EmbeddingPipeline sends batches of texts to an OpenAIClient from a pool
+of worker threads.  Each request first takes its request and tokens from a
+TokenBucket sized to the deployment's requests-per-minute and tokens-per-minute
+quota, so the request rate approaches the quota without exceeding it.  The
+number of requests in flight is an AdaptiveConcurrency limit which is halved
+when the service throttles and grows by one after a window of successes.
+Throttled requests wait for the Retry-After time given by the service, else
+for a jittered exponential backoff, and the whole bucket pauses with them.
+A client with an embedding_provider computes its embeddings locally, with
+no quota, so its requests bypass the TokenBucket.
+
+Usage:
+  from pysrc.embeddingpipeline import EmbeddingPipeline
+  pipeline = EmbeddingPipeline(oaic, rpm=1440, tpm=240000, max_concurrency=16)
+  embeddings = pipeline.get_embeddings(texts)
+  for idx, embedding in pipeline.stream_embeddings(texts): ...
+"""
+
+import random
+import threading
+import time
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+
+
+class TokenBucket():
+    """
+    A thread-safe pair of token buckets, one for requests and one for tokens,
+    refilled continuously at the per-minute quota.  Each holds only
+    burst_seconds of quota, and starts full, because Azure OpenAI enforces
+    the quota over windows of a few seconds rather than per minute.
+    """
+    def __init__(self, rpm: int, tpm: int, burst_seconds=1.0):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self.request_capacity = max(1.0, self.rpm * burst_seconds / 60.0)
+        self.token_capacity = max(1.0, self.tpm * burst_seconds / 60.0)
+        self.requests = self.request_capacity
+        self.tokens = self.token_capacity
+        self.paused_until = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self, now: float) -> None:
+        elapsed = now - self.updated
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.rpm / 60.0)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.tpm / 60.0)
+        self.updated = now
+
+    def acquire(self, tokens: int) -> float:
+        """
+        Block until one request and the given number of tokens are available,
+        and take them.  A request with more tokens than the bucket holds waits
+        for a full bucket, and leaves it in debt, so that the following requests
+        wait until the rate is back under the quota.  Return the number of
+        seconds waited.
+        """
+        tokens = float(tokens)
+        needed = min(tokens, self.token_capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    if self.requests >= 1.0 and self.tokens >= needed:
+                        self.requests -= 1.0
+                        self.tokens -= tokens
+                        return waited
+                    wait = max(
+                        (1.0 - self.requests) * 60.0 / self.rpm,
+                        (needed - self.tokens) * 60.0 / self.tpm)
+            wait = max(wait, 0.001)
+            time.sleep(wait)
+            waited += wait
+
+    def pause(self, seconds: float) -> None:
+        """ Take no requests for the given number of seconds, e.g. after a throttle. """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class AdaptiveConcurrency():
+    """
+    A semaphore whose limit follows additive-increase/multiplicative-decrease:
+    the limit grows by one after limit consecutive successes, and is halved
+    on a throttle, at most once per cooldown period.
+    """
+    def __init__(self, initial: int, maximum: int, minimum=1, cooldown_seconds=5.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.cooldown_seconds = cooldown_seconds
+        self.active = 0
+        self.successes = 0
+        self.decreased = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self) -> None:
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def succeeded(self) -> None:
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def throttled(self) -> None:
+        with self.condition:
+            now = time.monotonic()
+            self.successes = 0
+            if now - self.decreased >= self.cooldown_seconds:
+                self.limit = max(self.minimum, self.limit // 2)
+                self.decreased = now
+
+
+class EmbeddingPipeline():
+
+    def __init__(self, oaic, rpm: int, tpm: int, max_concurrency=16, initial_concurrency=4,
+                 base_backoff_seconds=1.0, max_backoff_seconds=60.0, burst_seconds=1.0):
+        self.oaic = oaic
+        self.bucket = None
+        if getattr(oaic, 'embedding_provider', None) is None:
+            self.bucket = TokenBucket(rpm, tpm, burst_seconds)
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.stats_lock = threading.Lock()
+        self.stats = {'requests': 0, 'texts': 0, 'tokens': 0, 'throttled': 0,
+                      'retried': 0, 'failed_batches': 0, 'bucket_wait_seconds': 0.0}
+
+    def get_embeddings(self, texts: list[str]) -> list[list[float] | None]:
+        """
+        Return the embeddings of the given texts, in the same order, requesting
+        the batches of OpenAIClient.embedding_batches concurrently.  The
+        embeddings of a batch which fails after retry_count attempts are None.
+        Texts found in the client's embedding_cache, if any, are not requested.
+        """
+        results = [None] * len(texts)
+        for idx, embedding in self.stream_embeddings(texts):
+            results[idx] = embedding
+        return results
+
+    def stream_embeddings(self, texts: list[str]):
+        """
+        Yield the (index, embedding) of each of the given texts as soon as its
+        batch is received, in completion order, so the caller can persist them
+        as they arrive.  The cached texts are yielded first, and the embeddings
+        of a failed batch are None.  All of the batches share one pool of
+        threads, so the concurrency limit holds across the whole run; closing
+        the generator early cancels the batches which haven't started.
+        """
+        results, misses = self.oaic.cached_embeddings(texts)
+        for idx, embedding in enumerate(results):
+            if embedding is not None:
+                yield idx, embedding
+        texts = [texts[idx].replace("\n", ' ') for idx in misses]
+        batches = self.oaic.embedding_batches(texts)
+        t1 = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = {executor.submit(self.embed_batch, [texts[idx] for idx in batch]): batch for batch in batches}
+            for future in as_completed(futures):
+                batch, embeddings = futures[future], future.result()
+                if embeddings is None:
+                    embeddings = [None] * len(batch)
+                else:
+                    self.oaic.cache_embeddings([texts[idx] for idx in batch], embeddings)
+                for idx, embedding in zip(batch, embeddings):
+                    yield misses[idx], embedding
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        else:
+            executor.shutdown()
+        finally:
+            self.increment('seconds', time.perf_counter() - t1)
+
+    def embed_batch(self, texts: list[str]) -> list[list[float]] | None:
+        tokens = sum(max(0, self.oaic.get_token_count(text)) for text in texts)
+        for attempt in range(self.oaic.retry_count):
+            if self.bucket is not None:
+                self.increment('bucket_wait_seconds', self.bucket.acquire(tokens))
+            self.concurrency.acquire()
+            try:
+                embeddings = self.oaic.create_embeddings(texts)
+                self.concurrency.succeeded()
+                self.increment('requests', 1)
+                self.increment('texts', len(texts))
+                self.increment('tokens', tokens)
+                return embeddings
+            except Exception as e:
+                if not self.is_retryable(e):
+                    print("embed_batch exception: {}".format(str(e)))
+                    traceback.print_exc()
+                    break
+                wait = self.backoff_seconds(attempt)
+                if self.is_throttle(e):
+                    self.increment('throttled', 1)
+                    self.concurrency.throttled()
+                    retry_after = self.retry_after_seconds(e)
+                    if retry_after is not None:
+                        wait = retry_after * random.uniform(1.0, 1.2)
+                    if self.bucket is not None:
+                        self.bucket.pause(wait)
+                print('embed_batch {}: {}, retrying in {:.2f} seconds'.format(
+                    type(e).__name__, str(e)[:120], wait))
+                self.increment('retried', 1)
+            finally:
+                self.concurrency.release()
+            time.sleep(wait)
+        self.increment('failed_batches', 1)
+        return None
+
+    def backoff_seconds(self, attempt: int) -> float:
+        """ Exponential backoff with full jitter: uniform(0, base * 2**attempt), capped. """
+        return random.uniform(0, min(self.max_backoff_seconds, self.base_backoff_seconds * (2 ** attempt)))
+
+    @classmethod
+    def is_throttle(cls, e: Exception) -> bool:
+        return isinstance(e, openai.error.RateLimitError) or getattr(e, 'http_status', None) == 429
+
+    @classmethod
+    def is_retryable(cls, e: Exception) -> bool:
+        if cls.is_throttle(e):
+            return True
+        if isinstance(e, (openai.error.ServiceUnavailableError, openai.error.APIConnectionError,
+                          openai.error.Timeout, openai.error.TryAgain)):
+            return True
+        status = getattr(e, 'http_status', None)
+        return status is not None and status >= 500
+
+    @classmethod
+    def retry_after_seconds(cls, e: Exception) -> float | None:
+        """ Return the wait given by the retry-after-ms or Retry-After response header, or None. """
+        headers = getattr(e, 'headers', None) or {}
+        headers = {str(k).lower(): v for k, v in dict(headers).items()}
+        try:
+            if 'retry-after-ms' in headers:
+                return float(headers['retry-after-ms']) / 1000.0
+            if 'retry-after' in headers:
+                return float(headers['retry-after'])
+        except ValueError:
+            pass  # an HTTP-date Retry-After value; use the backoff instead
+        return None
+
+    def increment(self, name: str, value) -> None:
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def get_stats(self) -> dict:
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats['concurrency_limit'] = self.concurrency.limit
+        seconds = stats.get('seconds', 0.0)
+        if seconds > 0:
+            stats['requests_per_minute'] = stats['requests'] * 60.0 / seconds
+            stats['tokens_per_minute'] = stats['tokens'] * 60.0 / seconds
+        return stats
@@ -0,0 +1,72 @@
+"""
+Module embeddingprovider.py - local, offline embedding providers.
+
+An embedding provider is any object with model and dims attributes and a
+create_embeddings(texts) method which returns one list of floats per text, in
+order, raising an exception on failure.  An OpenAIClient given a provider, in
+its embedding_provider attribute, calls it instead of the OpenAI API, so the
+whole vectorization pipeline can be run and benchmarked with no network.
+
+HashedNgramEmbeddings is a deterministic provider.  Each text is split into
+words, and each word contributes itself and its character n-grams as sparse
+features.  Each feature is hashed, with blake2b rather than the per-process
+salted hash(), to a few signed dimensions of the output vector; this is a
+sparse random projection of the bag of n-grams.  The vectors are normalized
+to unit length, as are the OpenAI embeddings, so texts which share words and
+word fragments, such as 'batting_avg_305' and 'batting_avg_306', have a high
+cosine similarity.
+
+Usage:
+  from pysrc.embeddingprovider import HashedNgramEmbeddings
+  oaic.embedding_provider = HashedNgramEmbeddings(1536)
+"""
+
+import functools
+import hashlib
+
+import numpy as np
+
+
+class HashedNgramEmbeddings():
+
+    def __init__(self, dims=1536, ngram_sizes=(3, 4, 5), projections=8):
+        self.dims = int(dims)
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.projections = int(projections)
+        self.model = f'hashed-ngram-{self.dims}'
+
+    def features(self, text: str) -> dict:
+        """
+        Return the weighted features of the given text: each word with weight
+        1.0, and its character n-grams, within '<' and '>' word boundaries,
+        sharing a total weight of 1.0.
+        """
+        features = {}
+        for word in text.lower().split():
+            features[f'w:{word}'] = features.get(f'w:{word}', 0.0) + 1.0
+            bounded = f'<{word}>'
+            grams = [bounded[i:i + n] for n in self.ngram_sizes for i in range(len(bounded) - n + 1)]
+            for gram in grams:
+                features[f'g:{gram}'] = features.get(f'g:{gram}', 0.0) + (1.0 / len(grams))
+        return features
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dims, dtype=np.float64)
+        for feature, weight in self.features(text).items():
+            indexes, signs = feature_projection(feature, self.dims, self.projections)
+            np.add.at(vector, indexes, signs * weight)
+        norm = np.linalg.norm(vector)
+        return (vector / norm) if norm > 0 else vector
+
+    def create_embeddings(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed(text).astype(np.float32).tolist() for text in texts]
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def feature_projection(feature: str, dims: int, projections: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Return the output dimensions of the given feature and their +1/-1 signs. """
+    digest = hashlib.blake2b(feature.encode('utf-8'), digest_size=4 * projections).digest()
+    values = np.frombuffer(digest, dtype='<u2')
+    indexes = values[:projections].astype(np.int64) % dims
+    signs = np.where(values[projections:] & 1, 1.0, -1.0)
+    return indexes, signs
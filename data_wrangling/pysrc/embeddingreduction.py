@@ -0,0 +1,95 @@
+"""
+Module embeddingreduction.py - linear dimensionality reduction of embeddings.
+
+An EmbeddingReduction is a projection of the embeddings to fewer dims,
+either by PCA fitted to the corpus, or by a seeded Gaussian random
+projection which needs no fitting.  The PCA covariance is accumulated over
+chunks of rows, so the memory-mapped EmbeddingStore matrix is never loaded
+at once.  The projected vectors are normalized to unit length, so cosine
+similarity remains the dot product.
+
+The mean and components are saved to an .npz file, so that query vectors
+are later transformed exactly as the stored vectors were.
+
+Usage:
+  from pysrc.embeddingreduction import EmbeddingReduction
+  reduction = EmbeddingReduction.fit_pca(store.matrix, 256)
+  reduction.save('../data/wrangled/reduction_pca_256.npz')
+  vectors = EmbeddingReduction.load('../data/wrangled/reduction_pca_256.npz').transform(queries)
+"""
+
+import numpy as np
+
+METHODS = ['pca', 'random']
+
+
+class EmbeddingReduction():
+
+    def __init__(self, method: str, mean: np.ndarray, components: np.ndarray, explained_variance_ratio=None):
+        self.method = method
+        self.mean = mean.astype(np.float32)
+        self.components = components.astype(np.float32)  # (dims, input_dims)
+        self.explained_variance_ratio = explained_variance_ratio
+        self.dims, self.input_dims = self.components.shape
+
+    @classmethod
+    def create(cls, method: str, matrix: np.ndarray, dims: int, seed=42) -> 'EmbeddingReduction':
+        if method == 'pca':
+            return cls.fit_pca(matrix, dims)
+        if method == 'random':
+            return cls.random_projection(matrix.shape[1], dims, seed)
+        raise ValueError(f'unknown reduction method: {method}, methods: {METHODS}')
+
+    @classmethod
+    def fit_pca(cls, matrix: np.ndarray, dims: int, chunk_rows=8192) -> 'EmbeddingReduction':
+        """ Fit the top dims principal components of the rows of the given matrix. """
+        count, input_dims = matrix.shape
+        total = np.zeros(input_dims, dtype=np.float64)
+        gram = np.zeros((input_dims, input_dims), dtype=np.float64)
+        for start in range(0, count, chunk_rows):
+            chunk = np.asarray(matrix[start:start + chunk_rows], dtype=np.float64)
+            total += chunk.sum(axis=0)
+            gram += chunk.T @ chunk
+        mean = total / max(1, count)
+        covariance = (gram / max(1, count)) - np.outer(mean, mean)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:dims]
+        variance = np.clip(eigenvalues, 0, None)
+        ratio = variance[order] / variance.sum() if variance.sum() > 0 else np.zeros(len(order))
+        return EmbeddingReduction('pca', mean, eigenvectors[:, order].T, ratio)
+
+    @classmethod
+    def random_projection(cls, input_dims: int, dims: int, seed=42) -> 'EmbeddingReduction':
+        """ Return a Gaussian random projection, which approximately preserves angles. """
+        rng = np.random.default_rng(seed)
+        components = rng.standard_normal((dims, input_dims)) / np.sqrt(dims)
+        return EmbeddingReduction('random', np.zeros(input_dims), components)
+
+    def truncated(self, dims: int) -> 'EmbeddingReduction':
+        """ Return this reduction limited to its first dims components. """
+        ratio = None if self.explained_variance_ratio is None else self.explained_variance_ratio[:dims]
+        return EmbeddingReduction(self.method, self.mean, self.components[:dims], ratio)
+
+    def transform(self, vectors: np.ndarray, chunk_rows=8192) -> np.ndarray:
+        """ Return the unit-length float32 projections of the given vectors, one per row. """
+        vectors = np.atleast_2d(vectors)
+        results = np.zeros((len(vectors), self.dims), dtype=np.float32)
+        for start in range(0, len(vectors), chunk_rows):
+            chunk = np.asarray(vectors[start:start + chunk_rows], dtype=np.float32) - self.mean
+            projected = chunk @ self.components.T
+            norms = np.linalg.norm(projected, axis=1, keepdims=True)
+            results[start:start + len(chunk)] = projected / np.where(norms > 0, norms, 1.0)
+        return results
+
+    def save(self, path: str) -> None:
+        arrays = {'method': np.array(self.method), 'mean': self.mean, 'components': self.components}
+        if self.explained_variance_ratio is not None:
+            arrays['explained_variance_ratio'] = self.explained_variance_ratio
+        with open(file=path, mode='wb') as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path: str) -> 'EmbeddingReduction':
+        with np.load(path) as arrays:
+            ratio = arrays['explained_variance_ratio'] if 'explained_variance_ratio' in arrays else None
+            return EmbeddingReduction(str(arrays['method']), arrays['mean'], arrays['components'], ratio)
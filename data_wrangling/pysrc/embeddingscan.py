@@ -0,0 +1,183 @@
+"""
+Module embeddingscan.py - bulk validation of an EmbeddingStore matrix.
+
+The EmbeddingScan reads the memory-mapped matrix in chunks of rows, with
+numpy operations over each whole chunk, and returns a summary report:
+rows with NaN or infinite values, zero vectors, the distribution of the
+vector norms and the rows with outlying norms, exact duplicate vectors, and
+clusters of near-duplicate vectors.  Only a limited number of the anomalous
+ids of each kind are listed, so the report stays small for large stores.
+
+Exact duplicates are found by grouping rows on a 64-bit fingerprint, a
+random linear hash of the float32 bits of the row, and comparing the bytes
+of the rows in each group.  Near duplicates are found with random-hyperplane locality-sensitive
+hashing: the rows in the same bucket of any of several hash tables are
+compared by cosine similarity, so the cost grows with the number of rows
+rather than with its square.
+
+Usage:
+  from pysrc.embeddingscan import EmbeddingScan
+  report = EmbeddingScan(store, 1536).run(texts)
+"""
+
+import numpy as np
+
+
+class EmbeddingScan():
+
+    def __init__(self, store, expected_dims: int, chunk_rows=8192, max_listed=100,
+                 norm_tolerance=0.01, near_duplicate_threshold=0.999,
+                 lsh_tables=4, lsh_bits=16, max_bucket_rows=4096, seed=42):
+        self.store = store
+        self.expected_dims = expected_dims
+        self.chunk_rows = chunk_rows
+        self.max_listed = max_listed
+        self.norm_tolerance = norm_tolerance
+        self.near_duplicate_threshold = near_duplicate_threshold
+        self.lsh_tables = lsh_tables
+        self.lsh_bits = lsh_bits
+        self.max_bucket_rows = max_bucket_rows
+        self.rng = np.random.default_rng(seed)
+
+    def chunks(self):
+        """ Yield the start row and float32 array of each chunk of the matrix. """
+        for start in range(0, self.store.count, self.chunk_rows):
+            yield start, np.asarray(self.store.matrix[start:start + self.chunk_rows], dtype='<f4')
+
+    def run(self, texts: dict = None) -> dict:
+        """
+        Return the report of the store.  The optional texts dict, of id to the
+        text which was embedded, distinguishes the duplicate vectors of
+        identical texts, which are expected, from those of different texts.
+        """
+        count = self.store.count
+        report = {}
+        report['path'] = self.store.path
+        report['model'] = self.store.model
+        report['dims'] = self.store.dims
+        report['expected_dims'] = self.expected_dims
+        report['dims_mismatch'] = self.store.dims != self.expected_dims
+        report['rows'] = count
+        report['ids'] = len(self.store.ids)
+
+        norms = np.zeros(count, dtype=np.float64)
+        finite = np.ones(count, dtype=bool)
+        fingerprints = np.zeros(count, dtype=np.uint64)
+        multipliers = self.rng.integers(1, 2 ** 63, size=self.store.dims, dtype=np.uint64) | np.uint64(1)
+        for start, chunk in self.chunks():
+            end = start + len(chunk)
+            finite[start:end] = np.all(np.isfinite(chunk), axis=1)
+            clean = np.where(np.isfinite(chunk), chunk, 0.0).astype(np.float64)
+            norms[start:end] = np.linalg.norm(clean, axis=1)
+            bits = chunk.view(np.uint32).astype(np.uint64)
+            fingerprints[start:end] = (bits * multipliers).sum(axis=1, dtype=np.uint64)  # wraps mod 2**64
+        zero = finite & (norms == 0)
+        valid = finite & ~zero
+
+        report['non_finite'] = self.listed(np.flatnonzero(~finite))
+        report['zero_vectors'] = self.listed(np.flatnonzero(zero))
+        report['norms'] = self.distribution(norms[valid])
+        outlying = valid & (np.abs(norms - 1.0) > self.norm_tolerance)
+        report['norm_tolerance'] = self.norm_tolerance
+        report['outlying_norms'] = self.listed(np.flatnonzero(outlying))
+
+        groups = self.exact_duplicate_groups(np.flatnonzero(valid), fingerprints)
+        report['exact_duplicates'] = self.duplicate_summary(groups, texts)
+        representatives = np.flatnonzero(valid)
+        if len(groups) > 0:
+            duplicate_rows = np.concatenate([group[1:] for group in groups])
+            representatives = np.setdiff1d(representatives, duplicate_rows)
+        clusters = self.near_duplicate_clusters(representatives, norms)
+        report['near_duplicate_threshold'] = self.near_duplicate_threshold
+        report['near_duplicates'] = self.duplicate_summary(clusters, texts)
+        return report
+
+    def listed(self, rows: np.ndarray) -> dict:
+        return {'count': int(len(rows)), 'ids': [self.store.ids[row] for row in rows[:self.max_listed].tolist()]}
+
+    @classmethod
+    def distribution(cls, values: np.ndarray) -> dict:
+        if len(values) == 0:
+            return {'count': 0}
+        percentiles = np.percentile(values, [0, 1, 50, 99, 100])
+        return {
+            'count': int(len(values)),
+            'mean': float(values.mean()),
+            'std': float(values.std()),
+            'min': float(percentiles[0]),
+            'p01': float(percentiles[1]),
+            'p50': float(percentiles[2]),
+            'p99': float(percentiles[3]),
+            'max': float(percentiles[4])}
+
+    def exact_duplicate_groups(self, rows: np.ndarray, fingerprints: np.ndarray) -> list[np.ndarray]:
+        """ Return the groups, of two or more rows, of byte-identical vectors. """
+        groups = []
+        for candidates in self.same_key_groups(rows, fingerprints[rows]):
+            by_bytes = {}
+            for row in candidates.tolist():
+                by_bytes.setdefault(self.store.matrix[row].tobytes(), []).append(row)
+            groups.extend([np.array(g) for g in by_bytes.values() if len(g) > 1])
+        return groups
+
+    def near_duplicate_clusters(self, rows: np.ndarray, norms: np.ndarray) -> list[np.ndarray]:
+        """
+        Return the clusters of rows linked by a cosine similarity of at least
+        near_duplicate_threshold, among the rows sharing a bucket of any of
+        the lsh_tables random-hyperplane hash tables.
+        """
+        parent = {}
+        def find(row):
+            while parent.get(row, row) != row:
+                row = parent[row]
+            return row
+        if len(rows) < 2:
+            return []
+        weights = (1 << np.arange(self.lsh_bits)).astype(np.int64)
+        for table in range(self.lsh_tables):
+            planes = self.rng.standard_normal((self.store.dims, self.lsh_bits))
+            signatures = np.zeros(len(rows), dtype=np.int64)
+            for start in range(0, len(rows), self.chunk_rows):
+                chunk = np.asarray(self.store.matrix[rows[start:start + self.chunk_rows]], dtype=np.float64)
+                signatures[start:start + len(chunk)] = ((chunk @ planes) > 0).astype(np.int64) @ weights
+            for bucket in self.same_key_groups(rows, signatures):
+                vectors = np.asarray(self.store.matrix[bucket], dtype=np.float64) / norms[bucket][:, None]
+                for start in range(0, len(bucket), self.max_bucket_rows):
+                    sims = vectors[start:start + self.max_bucket_rows] @ vectors.T
+                    i, j = np.nonzero(sims >= self.near_duplicate_threshold)
+                    i = i + start
+                    for a, b in zip(bucket[i[i < j]].tolist(), bucket[j[i < j]].tolist()):
+                        ra, rb = find(a), find(b)
+                        if ra != rb:
+                            parent[max(ra, rb)] = min(ra, rb)
+        clusters = {}
+        for row in list(parent.keys()):
+            root = find(row)
+            clusters.setdefault(root, [root]).append(row)
+        return [np.array(sorted(set(members))) for members in clusters.values()]
+
+    @classmethod
+    def same_key_groups(cls, rows: np.ndarray, keys: np.ndarray) -> list[np.ndarray]:
+        """ Return the groups, of two or more of the given rows, with equal keys. """
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        boundaries = np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1
+        return [rows[order[g]] for g in np.split(np.arange(len(rows)), boundaries) if len(g) > 1]
+
+    def duplicate_summary(self, groups: list[np.ndarray], texts: dict = None) -> dict:
+        """
+        Summarize the given groups of rows; with texts, the groups whose ids
+        have different texts are the anomalies listed.
+        """
+        summary = {}
+        summary['groups'] = len(groups)
+        summary['rows'] = int(sum(len(group) for group in groups))
+        summary['largest_group'] = int(max([len(group) for group in groups], default=0))
+        anomalies = []
+        for group in groups:
+            ids = [self.store.ids[row] for row in group.tolist()]
+            if texts is None or len(set(texts.get(id) for id in ids)) > 1:
+                anomalies.append(ids)
+        summary['different_texts_groups'] = len(anomalies) if texts is not None else None
+        summary['listed'] = anomalies[:self.max_listed]
+        return summary
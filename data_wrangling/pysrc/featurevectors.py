@@ -0,0 +1,122 @@
+"""
+Module featurevectors.py - standardized numeric feature vectors of players.
+
+An alternative to embedding the embeddings_str text: each player document is
+converted directly to a compact vector of the same statistics.  The vector
+has one-hot blocks for the category, primary position, and handedness, the
+log of the total games, and a category-specific block of pitching or batting
+statistics; the block of the other category is zero.  Counts are log-scaled,
+and each numeric feature is z-scored with the mean and standard deviation
+of the players of its category, clipped, and missing values are set to the
+mean.  Each vector is normalized to unit length, so the cosine similarity is
+the dot product, as with the OpenAI embeddings.
+
+The fitted means and standard deviations are kept with the feature names,
+in a JSON file, so that later documents are vectorized consistently.
+
+Usage:
+  from pysrc.featurevectors import FeatureVectors
+  features = FeatureVectors.fit(players)
+  matrix = features.transform(players)
+"""
+
+import numpy as np
+
+from pysrc.textencoding import lookup, numeric_array
+
+CATEGORIES = ['pitcher', 'fielder']
+POSITIONS  = ['P', 'C', '1B', '2B', '3B', 'SS', 'LF', 'CF', 'RF', 'DH']
+BATS       = ['R', 'L', 'B']
+THROWS     = ['R', 'L']
+
+# (feature name, category or None for all players, key path, log-scaled)
+NUMERIC_FEATURES = [
+    ('total_games', None, ('teams', 'total_games'), True),
+    ('wins', 'pitcher', ('pitching', 'W'), True),
+    ('losses', 'pitcher', ('pitching', 'L'), True),
+    ('full_games_pitched_equiv', 'pitcher', ('pitching', 'calculated', 'full_games_pitched_equiv'), True)] + [
+    (stat, 'pitcher', ('pitching', 'calculated', stat), False) for stat in (
+        'era', 'opp_batting_avg', 'so_pct', 'bb_pct', 'hbp_pct', 'hr_pct',
+        'win_pct', 'sho_pct', 'cg_pct')] + [
+    ('hits', 'fielder', ('batting', 'H'), True),
+    ('hr', 'fielder', ('batting', 'HR'), True)] + [
+    (stat, 'fielder', ('batting', 'calculated', stat), False) for stat in (
+        'batting_avg', 'runs_per_ab', '2b_avg', '3b_avg', 'hr_avg', 'rbi_avg',
+        'bb_avg', 'so_avg', 'ibb_avg', 'hbp_avg')]
+
+Z_CLIP = 4.0
+
+
+class FeatureVectors():
+
+    def __init__(self, means: dict, stds: dict):
+        self.means = means
+        self.stds = stds
+        self.names = feature_names()
+        self.dims = len(self.names)
+
+    @classmethod
+    def fit(cls, players: list[dict]) -> 'FeatureVectors':
+        """ Return the FeatureVectors standardized to the given players. """
+        means, stds = {}, {}
+        categories = np.array([c if isinstance(c, str) else '' for c in lookup(players, 'category')])
+        for name, values, category in numeric_columns(players):
+            applicable = values[np.isfinite(values) & category_mask(categories, category)]
+            means[name] = float(applicable.mean()) if len(applicable) > 0 else 0.0
+            std = float(applicable.std()) if len(applicable) > 1 else 0.0
+            stds[name] = std if std > 0 else 1.0
+        return FeatureVectors(means, stds)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> 'FeatureVectors':
+        features = FeatureVectors(d['means'], d['stds'])
+        if features.names != d['names']:
+            raise ValueError('the feature names differ from those of this version of featurevectors.py')
+        return features
+
+    def to_dict(self) -> dict:
+        return {'names': self.names, 'dims': self.dims, 'means': self.means, 'stds': self.stds}
+
+    def transform(self, players: list[dict]) -> np.ndarray:
+        """ Return the unit-length float32 feature vectors of the given players, one per row. """
+        columns = []
+        categories = np.array([c if isinstance(c, str) else '' for c in lookup(players, 'category')])
+        columns.extend(one_hot_columns(categories, CATEGORIES))
+        columns.extend(one_hot_columns(text_array(lookup(players, 'primary_position')), POSITIONS))
+        columns.extend(one_hot_columns(text_array(lookup(players, 'bats')), BATS))
+        columns.extend(one_hot_columns(text_array(lookup(players, 'throws')), THROWS))
+        for name, values, category in numeric_columns(players):
+            z = (values - self.means[name]) / self.stds[name]
+            z = np.clip(np.where(np.isfinite(z), z, 0.0), -Z_CLIP, Z_CLIP)
+            columns.append(np.where(category_mask(categories, category), z, 0.0))
+        matrix = np.column_stack(columns) if len(players) > 0 else np.zeros((0, self.dims))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return (matrix / np.where(norms > 0, norms, 1.0)).astype(np.float32)
+
+
+def feature_names() -> list[str]:
+    names = [f'category_{c}' for c in CATEGORIES]
+    names.extend([f'primary_position_{p}'.lower() for p in POSITIONS])
+    names.extend([f'bats_{h}'.lower() for h in BATS])
+    names.extend([f'throws_{h}'.lower() for h in THROWS])
+    names.extend([name for name, category, path, log_scaled in NUMERIC_FEATURES])
+    return names
+
+def text_array(values: list) -> np.ndarray:
+    return np.array([str(v).strip().upper() if isinstance(v, str) else '' for v in values])
+
+def one_hot_columns(values: np.ndarray, labels: list[str]) -> list[np.ndarray]:
+    return [(values == label).astype(np.float64) for label in labels]
+
+def category_mask(categories: np.ndarray, category: str | None) -> np.ndarray:
+    if category is None:
+        return categories != ''
+    return categories == category
+
+def numeric_columns(players: list[dict]):
+    """ Yield the name, float64 values (nan if missing), and category of each numeric feature. """
+    for name, category, path, log_scaled in NUMERIC_FEATURES:
+        values = numeric_array(lookup(players, *path))
+        if log_scaled:
+            values = np.log1p(np.where(values >= 0, values, np.nan))
+        yield name, values, category
@@ -0,0 +1,268 @@
+"""
+Module hnswindex.py - a local Hierarchical Navigable Small World (HNSW) graph index.
+
+The HNSWIndex links each vector to about m of its nearest neighbors, 2 * m on
+the bottom layer, in a stack of graph layers; each vector is on the bottom
+layer, and on each higher layer with exponentially decreasing probability.
+A search descends greedily from the entry point on the top layer, and then
+explores the bottom layer with a candidate queue of efSearch vectors, so only
+a small fraction of the vectors are compared with the query.  Vectors are
+inserted incrementally, with efConstruction candidates when linking each one,
+and the neighbors of each vector are chosen with the heuristic of the HNSW
+paper (Malkov and Yashunin), which prefers neighbors in diverse directions.
+
+The similarity is cosine: the vectors are normalized to unit length.  The
+graph and vectors are saved in a compact binary file, after a 64-byte
+header, with the sidecar '<file>.ids' text file having the id of each vector,
+as with the EmbeddingStore.
+
+Usage:
+  from pysrc.hnswindex import HNSWIndex
+  index = HNSWIndex(1536, m=16, ef_construction=64)
+  index.add(store.matrix, store.ids)
+  index.save('tmp/indexes/hnsw_16_64.bin')
+  indexes, scores = HNSWIndex.load('tmp/indexes/hnsw_16_64.bin').search(queries, 10, ef_search=40)
+"""
+
+import heapq
+import math
+import os
+import struct
+
+import numpy as np
+
+from pysrc.vectorsearch import normalized
+
+
+class HNSWIndex():
+
+    MAGIC = b'HNSWINDX'
+    VERSION = 1
+    HEADER_SIZE = 64
+    HEADER_FORMAT = '<8sIIQIIIIq16x'  # magic, version, dims, count, m, ef_construction, ef_search, max_level, entry_point
+
+    def __init__(self, dims: int, m=16, ef_construction=64, ef_search=40, seed=42):
+        self.dims = dims
+        self.m = m
+        self.m0 = 2 * m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.level_mult = 1.0 / math.log(m)
+        self.rng = np.random.default_rng(seed)
+        self.vectors = np.zeros((1024, dims), dtype=np.float32)
+        self.ids = []
+        self.rows = {}
+        self.levels = []         # the top layer of each vector
+        self.links = [{}]        # links[layer] maps a row index to the list of its neighbors
+        self.entry_point = -1
+        self.max_level = 0
+        self.count = 0
+
+    def add(self, vectors: np.ndarray, ids: list[str]) -> None:
+        """ Insert each of the given vectors, in order. """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        for vector, id in zip(vectors, ids):
+            self.insert(vector, id)
+
+    def insert(self, vector: np.ndarray, id: str) -> int:
+        """ Insert the given vector and link it into the graph; return its row index. """
+        if id in self.rows:
+            raise ValueError(f'duplicate id: {id}')
+        vector = normalized(np.asarray(vector, dtype=np.float32).reshape(1, self.dims))[0]
+        node = self.count
+        if node == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros((max(1024, node), self.dims), dtype=np.float32)])
+        self.vectors[node] = vector
+        self.ids.append(id)
+        self.rows[id] = node
+        self.count += 1
+        level = int(-math.log(1.0 - self.rng.random()) * self.level_mult)
+        self.levels.append(level)
+        while len(self.links) <= level:
+            self.links.append({})
+        for layer in range(level + 1):
+            self.links[layer][node] = []
+        if self.entry_point < 0:
+            self.entry_point, self.max_level = node, level
+            return node
+
+        entry_points = [self.entry_point]
+        for layer in range(self.max_level, level, -1):
+            entry_points = [self.search_layer(vector, entry_points, 1, layer)[0][1]]
+        for layer in range(min(level, self.max_level), -1, -1):
+            found = self.search_layer(vector, entry_points, self.ef_construction, layer)
+            max_links = self.m0 if layer == 0 else self.m
+            self.links[layer][node] = self.select_neighbors(found, self.m)
+            for neighbor in self.links[layer][node]:
+                neighbor_links = self.links[layer][neighbor]
+                neighbor_links.append(node)
+                if len(neighbor_links) > max_links:
+                    sims = (self.vectors[neighbor_links] @ self.vectors[neighbor]).tolist()
+                    candidates = sorted(zip(sims, neighbor_links), reverse=True)
+                    self.links[layer][neighbor] = self.select_neighbors(candidates, max_links)
+            entry_points = [n for _, n in found]
+        if level > self.max_level:
+            self.entry_point, self.max_level = node, level
+        return node
+
+    def search_layer(self, query: np.ndarray, entry_points: list[int], ef: int, layer: int) -> list[tuple[float, int]]:
+        """ Return the (similarity, row index) of the ef nearest vectors found on the given layer, nearest first. """
+        links = self.links[layer]
+        visited = set(entry_points)
+        sims = (self.vectors[entry_points] @ query).tolist()
+        candidates = [(-sim, n) for sim, n in zip(sims, entry_points)]
+        found = [(sim, n) for sim, n in zip(sims, entry_points)]
+        heapq.heapify(candidates)
+        heapq.heapify(found)
+        while candidates:
+            neg_sim, current = heapq.heappop(candidates)
+            if -neg_sim < found[0][0] and len(found) >= ef:
+                break
+            neighbors = [n for n in links[current] if n not in visited]
+            if not neighbors:
+                continue
+            visited.update(neighbors)
+            for sim, n in zip((self.vectors[neighbors] @ query).tolist(), neighbors):
+                if len(found) < ef or sim > found[0][0]:
+                    heapq.heappush(candidates, (-sim, n))
+                    heapq.heappush(found, (sim, n))
+                    if len(found) > ef:
+                        heapq.heappop(found)
+        return sorted(found, reverse=True)
+
+    def select_neighbors(self, candidates: list[tuple[float, int]], count: int) -> list[int]:
+        """
+        Choose up to count neighbors from the given (similarity, row index)
+        candidates of a vector, nearest first: a candidate is chosen if it is
+        nearer the vector than to any neighbor already chosen, and the remaining places
+        are filled with the nearest of the others.
+        """
+        selected = []
+        for sim, n in candidates:
+            if len(selected) >= count:
+                break
+            if not selected or float((self.vectors[selected] @ self.vectors[n]).max()) < sim:
+                selected.append(n)
+        if len(selected) < count:
+            chosen = set(selected)
+            selected.extend([n for _, n in candidates if n not in chosen][:count - len(selected)])
+        return selected
+
+    def search(self, queries: np.ndarray, k: int, ef_search: int = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the (queries, k) row indexes and cosine similarities of the k
+        most similar vectors found for each query, most similar first, with
+        a candidate queue of ef_search vectors (at least k); if fewer than k
+        vectors are found the remaining indexes are -1.
+        """
+        queries = normalized(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        ef = max(ef_search or self.ef_search, k)
+        indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        if self.count == 0:
+            return indexes, scores
+        for q, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for layer in range(self.max_level, 0, -1):
+                entry_points = [self.search_layer(query, entry_points, 1, layer)[0][1]]
+            found = self.search_layer(query, entry_points, ef, 0)[:k]
+            indexes[q, :len(found)] = [n for _, n in found]
+            scores[q, :len(found)] = [sim for sim, _ in found]
+        return indexes, scores
+
+    def search_ids(self, query: np.ndarray, k: int, ef_search: int = None) -> tuple[list[str], list[float]]:
+        """ Return the ids and cosine similarities of the k vectors found most similar to the query. """
+        indexes, scores = self.search(query, k, ef_search)
+        found = [(idx, score) for idx, score in zip(indexes[0].tolist(), scores[0].tolist()) if idx >= 0]
+        return [self.ids[idx] for idx, _ in found], [score for _, score in found]
+
+    def row(self, id: str) -> int | None:
+        return self.rows.get(id)
+
+    def vector(self, id: str) -> np.ndarray | None:
+        row = self.rows.get(id)
+        return None if row is None else self.vectors[row]
+
+    def save(self, path: str) -> None:
+        """
+        Write the index to the given file: the header, the top layer of each
+        vector as int8, the float32 vectors, the bottom layer links as a
+        (count, 2 * m) int32 matrix padded with -1, and then for each higher
+        layer its number of vectors, their row indexes, and a (vectors, m)
+        int32 links matrix.  The ids are written to the sidecar ids file.
+        """
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(file=tmp_file, mode='wb') as file:
+            file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, self.dims, self.count,
+                self.m, self.ef_construction, self.ef_search, self.max_level, self.entry_point))
+            file.write(np.asarray(self.levels, dtype=np.int8).tobytes())
+            file.write(self.vectors[:self.count].astype('<f4').tobytes())
+            file.write(self.links_matrix(0, range(self.count), self.m0).tobytes())
+            for layer in range(1, self.max_level + 1):
+                nodes = sorted(self.links[layer].keys())
+                file.write(struct.pack('<Q', len(nodes)))
+                file.write(np.asarray(nodes, dtype='<i4').tobytes())
+                file.write(self.links_matrix(layer, nodes, self.m).tobytes())
+        ids_tmp_file = f'{self.ids_file(path)}.{os.getpid()}.tmp'
+        with open(file=ids_tmp_file, encoding='utf-8', mode='w') as file:
+            for id in self.ids:
+                file.write(id + "\n")
+        os.replace(tmp_file, path)
+        os.replace(ids_tmp_file, self.ids_file(path))
+
+    def links_matrix(self, layer: int, nodes, width: int) -> np.ndarray:
+        matrix = np.full((len(nodes), width), -1, dtype='<i4')
+        for idx, node in enumerate(nodes):
+            neighbors = self.links[layer][node]
+            matrix[idx, :len(neighbors)] = neighbors
+        return matrix
+
+    @classmethod
+    def ids_file(cls, path: str) -> str:
+        return f'{path}.ids'
+
+    @classmethod
+    def load(cls, path: str) -> 'HNSWIndex':
+        with open(file=path, mode='rb') as file:
+            data = file.read()
+        if len(data) < cls.HEADER_SIZE:
+            raise ValueError(f'truncated hnsw index header: {path}')
+        magic, version, dims, count, m, ef_construction, ef_search, max_level, entry_point = \
+            struct.unpack(cls.HEADER_FORMAT, data[:cls.HEADER_SIZE])
+        if magic != cls.MAGIC:
+            raise ValueError(f'not an hnsw index file: {path}')
+        if version != cls.VERSION:
+            raise ValueError(f'unsupported hnsw index version {version}: {path}')
+        index = HNSWIndex(dims, m, ef_construction, ef_search)
+        offset = cls.HEADER_SIZE
+        levels = np.frombuffer(data, dtype=np.int8, count=count, offset=offset)
+        offset += count
+        index.vectors = np.frombuffer(data, dtype='<f4', count=count * dims, offset=offset).reshape(count, dims).copy()
+        offset += count * dims * 4
+        index.links = [cls.links_dict(range(count), np.frombuffer(
+            data, dtype='<i4', count=count * index.m0, offset=offset).reshape(count, index.m0))]
+        offset += count * index.m0 * 4
+        for layer in range(1, max_level + 1):
+            (nodes_count,) = struct.unpack('<Q', data[offset:offset + 8])
+            offset += 8
+            nodes = np.frombuffer(data, dtype='<i4', count=nodes_count, offset=offset).tolist()
+            offset += nodes_count * 4
+            matrix = np.frombuffer(data, dtype='<i4', count=nodes_count * m, offset=offset).reshape(nodes_count, m)
+            offset += nodes_count * m * 4
+            index.links.append(cls.links_dict(nodes, matrix))
+        if offset != len(data):
+            raise ValueError(f'hnsw index file has {len(data) - offset} unexpected trailing bytes: {path}')
+        with open(file=cls.ids_file(path), encoding='utf-8', mode='rt') as file:
+            index.ids = [line.strip() for line in file if len(line.strip()) > 0]
+        if len(index.ids) != count:
+            raise ValueError(f'hnsw index has {count} vectors but {len(index.ids)} ids: {path}')
+        index.rows = {id: idx for idx, id in enumerate(index.ids)}
+        index.levels = levels.tolist()
+        index.max_level = max_level
+        index.entry_point = entry_point
+        index.count = count
+        return index
+
+    @classmethod
+    def links_dict(cls, nodes, matrix: np.ndarray) -> dict:
+        return {node: [n for n in row if n >= 0] for node, row in zip(nodes, matrix.tolist())}
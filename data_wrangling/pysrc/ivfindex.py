@@ -0,0 +1,95 @@
+"""
+Module ivfindex.py - a local inverted-file (IVF) approximate vector index.
+
+Like the Cosmos DB vCore 'vector-ivf' index, the IVFIndex partitions the
+vectors into num_lists clusters with k-means, a coarse quantizer, and keeps
+an inverted list of the vectors of each cluster.  A query is compared with
+the cluster centroids, and then only with the vectors of the nprobe nearest
+lists; a higher nprobe scans more vectors, for higher recall and lower
+throughput.  The vectors of each list are stored contiguously, so a list is
+scanned with one matrix-vector product.
+
+The similarity is cosine: the vectors and centroids are normalized to unit
+length.  The index, including its vectors, is saved to and loaded from an
+.npz file.
+
+Usage:
+  from pysrc.ivfindex import IVFIndex
+  index = IVFIndex.build(store.matrix, store.ids, num_lists=100)
+  index.save('tmp/indexes/ivf_100.npz')
+  indexes, scores = IVFIndex.load('tmp/indexes/ivf_100.npz').search(queries, 10, nprobe=4)
+"""
+
+import numpy as np
+
+from pysrc.quantization import kmeans, nearest
+from pysrc.vectorsearch import normalized, top_k
+
+
+class IVFIndex():
+
+    def __init__(self, centroids: np.ndarray, vectors: np.ndarray, rows: np.ndarray,
+                 offsets: np.ndarray, ids: list[str]):
+        self.centroids = centroids    # (num_lists, dims)
+        self.vectors = vectors        # (count, dims), ordered by list
+        self.rows = rows              # the original row index of each of the ordered vectors
+        self.offsets = offsets        # list i is vectors[offsets[i]:offsets[i + 1]]
+        self.ids = ids                # the id of each original row
+        self.num_lists = len(centroids)
+        self.count, self.dims = vectors.shape
+
+    @classmethod
+    def build(cls, matrix: np.ndarray, ids: list[str], num_lists=100, iterations=20,
+              training_rows=50000, seed=42) -> 'IVFIndex':
+        """ Cluster the given vectors with k-means, and build the inverted lists. """
+        vectors = normalized(np.asarray(matrix, dtype=np.float32))
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(len(vectors), size=min(len(vectors), training_rows), replace=False)
+        centroids = normalized(kmeans(vectors[np.sort(sample)], num_lists, iterations, rng))
+        assignments = np.concatenate([
+            nearest(vectors[start:start + 8192], centroids) for start in range(0, len(vectors), 8192)])
+        rows = np.argsort(assignments, kind='stable')
+        offsets = np.searchsorted(assignments[rows], np.arange(len(centroids) + 1))
+        return IVFIndex(centroids, np.ascontiguousarray(vectors[rows]), rows, offsets, list(ids))
+
+    def search(self, queries: np.ndarray, k: int, nprobe=1) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the (queries, k) original row indexes and cosine similarities of
+        the k most similar vectors in the nprobe lists nearest each query, most
+        similar first; if those lists have fewer than k vectors the remaining
+        indexes are -1.
+        """
+        queries = normalized(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        nprobe = max(1, min(nprobe, self.num_lists))
+        probes, _ = top_k(queries @ self.centroids.T, nprobe)
+        indexes = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for q, query in enumerate(queries):
+            candidates = np.concatenate([
+                np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes[q].tolist()])
+            sims = self.vectors[candidates] @ query
+            top, top_scores = top_k(sims[None, :], min(k, len(candidates)))
+            indexes[q, :top.shape[1]] = self.rows[candidates[top[0]]]
+            scores[q, :top.shape[1]] = top_scores[0]
+        return indexes, scores
+
+    def scanned(self, queries: np.ndarray, nprobe=1) -> float:
+        """ Return the mean number of vectors scanned per query with the given nprobe. """
+        queries = normalized(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        probes, _ = top_k(queries @ self.centroids.T, max(1, min(nprobe, self.num_lists)))
+        sizes = np.diff(self.offsets)
+        return float(sizes[probes].sum(axis=1).mean())
+
+    def list_sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def save(self, path: str) -> None:
+        with open(file=path, mode='wb') as file:
+            np.savez(file, centroids=self.centroids, vectors=self.vectors, rows=self.rows,
+                     offsets=self.offsets, ids=np.array(self.ids))
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFIndex':
+        with np.load(path) as arrays:
+            return IVFIndex(arrays['centroids'], arrays['vectors'], arrays['rows'],
+                            arrays['offsets'], arrays['ids'].tolist())
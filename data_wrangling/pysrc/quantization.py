@@ -0,0 +1,268 @@
+"""
+Module quantization.py - scalar and product quantization of embeddings.
+
+Each codec encodes float32 vectors to compact codes, decodes the codes back
+to approximate float32 vectors, and scores float32 query vectors against the
+codes without decoding them (asymmetric distance computation):
+
+  float16  2 bytes per dim, 2x smaller; scores are the dot products with the
+           codes converted chunk by chunk.
+  int8     1 byte per dim, 4x smaller; each dim has its own scale and offset,
+           fitted to its minimum and maximum, so the dot product of a query
+           with a code is (query * scale) . (code + 128) + query . offset.
+  pq       product quantization; the vector is split into m subvectors, each
+           replaced by the 1-byte index of its nearest of 256 k-means
+           centroids of that subspace, so 1536 dims with m=192 take 192 bytes,
+           32x smaller.  A query is scored with a per-subspace table of its
+           dot products with the centroids, summed over the code's entries.
+
+The scores are inner products, which rank unit-length embeddings as cosine
+similarity does.  A fitted codec, and optionally its codes, is saved to and
+loaded from an .npz file.
+
+Usage:
+  from pysrc.quantization import create_codec, load_codec
+  codec = create_codec('int8').fit(matrix)
+  codes = codec.encode(matrix)
+  scores = codec.scores(queries, codes)
+"""
+
+import abc
+
+import numpy as np
+
+CODECS = ['float16', 'int8', 'pq']
+
+
+def create_codec(name: str, **kwargs):
+    if name == 'float16':
+        return Float16Codec()
+    if name == 'int8':
+        return Int8Codec()
+    if name == 'pq':
+        return PQCodec(**kwargs)
+    raise ValueError(f'unknown codec: {name}, codecs: {CODECS}')
+
+def load_codec(path: str) -> tuple[object, np.ndarray | None]:
+    """ Return the codec saved in the given .npz file, and its codes or None. """
+    with np.load(path) as arrays:
+        arrays = {name: arrays[name] for name in arrays.files}
+    codec = create_codec(str(arrays['codec']))
+    codec.set_params(arrays)
+    return codec, arrays.get('codes')
+
+
+class Codec(abc.ABC):
+    """ The methods common to the codecs. """
+
+    name = None
+
+    def fit(self, matrix: np.ndarray, chunk_rows=8192):
+        return self
+
+    def params(self) -> dict:
+        return {}
+
+    def set_params(self, arrays: dict) -> None:
+        pass
+
+    def save(self, path: str, codes: np.ndarray = None) -> None:
+        arrays = self.params()
+        arrays['codec'] = np.array(self.name)
+        if codes is not None:
+            arrays['codes'] = codes
+        with open(file=path, mode='wb') as file:
+            np.savez(file, **arrays)
+
+    @abc.abstractmethod
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        pass
+
+    @abc.abstractmethod
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        pass
+
+    @abc.abstractmethod
+    def scores(self, queries: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        pass
+
+    @abc.abstractmethod
+    def bytes_per_vector(self, dims: int) -> int:
+        pass
+
+
+class Float16Codec(Codec):
+
+    name = 'float16'
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors, dtype=np.float32).astype(np.float16)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, chunk_rows=65536) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        results = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            chunk = codes[start:start + chunk_rows].astype(np.float32)
+            results[:, start:start + len(chunk)] = queries @ chunk.T
+        return results
+
+    def bytes_per_vector(self, dims: int) -> int:
+        return 2 * dims
+
+
+class Int8Codec(Codec):
+
+    name = 'int8'
+
+    def __init__(self):
+        self.scale = None
+        self.offset = None
+
+    def fit(self, matrix: np.ndarray, chunk_rows=8192) -> 'Int8Codec':
+        low = np.full(matrix.shape[1], np.inf)
+        high = np.full(matrix.shape[1], -np.inf)
+        for start in range(0, len(matrix), chunk_rows):
+            chunk = np.asarray(matrix[start:start + chunk_rows], dtype=np.float64)
+            low = np.minimum(low, chunk.min(axis=0))
+            high = np.maximum(high, chunk.max(axis=0))
+        self.offset = low.astype(np.float32)
+        self.scale = np.where(high > low, (high - low) / 255.0, 1.0).astype(np.float32)
+        return self
+
+    def params(self) -> dict:
+        return {'scale': self.scale, 'offset': self.offset}
+
+    def set_params(self, arrays: dict) -> None:
+        self.scale = arrays['scale']
+        self.offset = arrays['offset']
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        levels = np.rint((np.asarray(vectors, dtype=np.float32) - self.offset) / self.scale)
+        return (np.clip(levels, 0, 255) - 128).astype(np.int8)
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        return ((codes.astype(np.float32) + 128.0) * self.scale) + self.offset
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, chunk_rows=65536) -> np.ndarray:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        scaled = queries * self.scale
+        constant = queries @ self.offset
+        results = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            chunk = codes[start:start + chunk_rows].astype(np.float32) + 128.0
+            results[:, start:start + len(chunk)] = (scaled @ chunk.T) + constant[:, None]
+        return results
+
+    def bytes_per_vector(self, dims: int) -> int:
+        return dims
+
+
+class PQCodec(Codec):
+
+    name = 'pq'
+
+    def __init__(self, m=192, centroids=256, iterations=12, training_rows=10000, seed=42):
+        self.m = m
+        self.centroids = centroids
+        self.iterations = iterations
+        self.training_rows = training_rows
+        self.seed = seed
+        self.codebooks = None  # (m, centroids, dims / m)
+
+    def fit(self, matrix: np.ndarray, chunk_rows=8192) -> 'PQCodec':
+        """ Fit the codebook of each subspace with k-means over a sample of the rows. """
+        count, dims = matrix.shape
+        if dims % self.m != 0:
+            raise ValueError(f'dims {dims} is not a multiple of m {self.m}')
+        rng = np.random.default_rng(self.seed)
+        sample = np.sort(rng.choice(count, size=min(count, self.training_rows), replace=False))
+        training = np.asarray(matrix[sample], dtype=np.float32).reshape(len(sample), self.m, dims // self.m)
+        self.codebooks = kmeans(training.transpose(1, 0, 2), self.centroids, self.iterations, rng)
+        return self
+
+    def params(self) -> dict:
+        return {'codebooks': self.codebooks}
+
+    def set_params(self, arrays: dict) -> None:
+        self.codebooks = arrays['codebooks']
+        self.m, self.centroids = self.codebooks.shape[0], self.codebooks.shape[1]
+
+    def encode(self, vectors: np.ndarray, chunk_rows=8192) -> np.ndarray:
+        vectors = np.atleast_2d(vectors)
+        codes = np.zeros((len(vectors), self.m), dtype=np.uint8 if self.centroids <= 256 else np.uint16)
+        for start in range(0, len(vectors), chunk_rows):
+            chunk = np.asarray(vectors[start:start + chunk_rows], dtype=np.float32)
+            chunk = chunk.reshape(len(chunk), self.m, -1)
+            for sub in range(self.m):
+                codes[start:start + len(chunk), sub] = nearest(chunk[:, sub, :], self.codebooks[sub])
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        parts = self.codebooks[np.arange(self.m), codes.astype(np.int64)]  # (n, m, dims / m)
+        return parts.reshape(len(codes), -1)
+
+    def tables(self, queries: np.ndarray) -> np.ndarray:
+        """ Return the (queries, m, centroids) dot products of each query subvector with the centroids. """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32)).reshape(-1, self.m, self.codebooks.shape[2])
+        return np.einsum('qsd,scd->qsc', queries, self.codebooks)
+
+    def scores(self, queries: np.ndarray, codes: np.ndarray, chunk_rows=16384) -> np.ndarray:
+        tables = self.tables(queries)
+        results = np.zeros((len(tables), len(codes)), dtype=np.float32)
+        for start in range(0, len(codes), chunk_rows):
+            chunk = codes[start:start + chunk_rows].astype(np.int64)
+            for sub in range(self.m):
+                results[:, start:start + len(chunk)] += tables[:, sub, chunk[:, sub]]
+        return results
+
+    def bytes_per_vector(self, dims: int) -> int:
+        return self.m * (1 if self.centroids <= 256 else 2)
+
+
+def nearest(vectors: np.ndarray, centers: np.ndarray) -> np.ndarray:
+    """ Return the index of the nearest center, by euclidean distance, of each vector. """
+    # the argmax of v.c - |c|^2 / 2 is the argmin of |v - c|^2
+    products = vectors @ centers.T
+    products -= 0.5 * (centers * centers).sum(axis=1)
+    return np.argmax(products, axis=1)
+
+def kmeans(vectors: np.ndarray, k: int, iterations: int, rng) -> np.ndarray:
+    """
+    Return k centers fitted with Lloyd's algorithm, from k random vectors.
+    Given (m, n, dims) vectors, fit the m subspaces together and return
+    (m, k, dims) centers; the centers of every subspace are updated at once
+    with cluster_means.
+    """
+    batched = vectors.ndim == 3
+    vectors = np.ascontiguousarray(vectors if batched else vectors[None], dtype=np.float32)
+    m, n, dims = vectors.shape
+    k = min(k, n)
+    centers = np.stack([vectors[sub, rng.choice(n, size=k, replace=False)] for sub in range(m)])
+    rows = vectors.reshape(m * n, dims)
+    offsets = (np.arange(m) * k)[:, None]
+    for iteration in range(iterations):
+        assignments = np.stack([nearest(vectors[sub], centers[sub]) for sub in range(m)])
+        clusters = (assignments + offsets).ravel()  # the center of each row, numbered across the subspaces
+        means, counts = cluster_means(rows, clusters, m * k)
+        centers = np.where((counts == 0).reshape(m, k, 1), centers, means.reshape(m, k, dims))
+    return centers if batched else centers[0]
+
+def cluster_means(rows: np.ndarray, clusters: np.ndarray, count: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return the (count, dims) float32 mean of the rows of each of count
+    clusters, given the cluster of each row, and the row count of each; the
+    mean of an empty cluster is zero.  The rows are sorted by cluster and
+    summed with one reduceat over the starts of the non-empty clusters, as
+    reduceat can't express an empty slice.
+    """
+    order = np.argsort(clusters, kind='stable')
+    counts = np.bincount(clusters, minlength=count)
+    nonempty = counts > 0
+    starts = np.cumsum(counts) - counts
+    sums = np.zeros((count, rows.shape[1]), dtype=np.float64)
+    if len(rows) > 0:
+        sums[nonempty] = np.add.reduceat(rows[order], starts[nonempty], axis=0, dtype=np.float64)
+    return (sums / np.maximum(counts, 1)[:, None]).astype(np.float32), counts
@@ -0,0 +1,233 @@
+"""
+Module searchbenchmark.py - measure the recall, nDCG, and latency of vector search backends.
+
+The SearchBenchmark searches a fixed set of players with each backend, and
+compares the playerIDs returned with the exact top k found by the local
+ExactIndex.  The recall@k is the fraction of the exact top k which are
+returned.  The nDCG@k weights each returned player by its exact rank, with a
+gain of k for the nearest player down to 1 for the k-th, and a log2 rank
+discount; it is 1.0 when the exact top k are returned in order.  The latency
+of each search is measured, after a few warmup searches, and summarized as
+the mean, p50, p95, and p99 in milliseconds.
+
+Each backend is given the playerID and the embedding of the query player, so
+the database backends time only the vector search, not the lookup of the
+player.  The local backends wrap the ExactIndex, IVFIndex, HNSWIndex, and
+NeighborTable, and need no network; the vCore, PostgreSQL, and Cognitive
+Search backends run the same vector searches as cosmos_vcore/main.py,
+cosmos_pg/main.py, and cognitive_search/cogsearch_main.py.
+
+Usage:
+  from pysrc.searchbenchmark import LocalBackend, SearchBenchmark
+  benchmark = SearchBenchmark(exact_index, pids, k=10)
+  result = benchmark.run(LocalBackend('hnsw', hnsw_index, {'efSearch': 40}, 40))
+"""
+
+import abc
+import math
+import time
+
+import numpy as np
+import requests
+
+from pysrc.aibundle import Mongo
+
+
+class SearchBackend(abc.ABC):
+    """ A vector search service; search returns the playerIDs of the k players most similar to the vector. """
+    name = 'backend'
+
+    @abc.abstractmethod
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        pass
+
+    def params(self) -> dict:
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+class LocalBackend(SearchBackend):
+    """ An ExactIndex, IVFIndex, or HNSWIndex, searched with the given nprobe or efSearch setting. """
+
+    def __init__(self, name: str, index, params: dict = None, setting: int = None):
+        self.name = name
+        self.index = index
+        self.setting = setting
+        self._params = params or {}
+
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        if self.setting is None:
+            indexes, _ = self.index.search(vector, k)
+        else:
+            indexes, _ = self.index.search(vector, k, self.setting)
+        return [self.index.ids[idx] for idx in indexes[0].tolist() if idx >= 0]
+
+    def params(self) -> dict:
+        return self._params
+
+
+class NeighborTableBackend(SearchBackend):
+    """ The precomputed neighbors of the player in a NeighborTable, after the player itself. """
+    name = 'table'
+
+    def __init__(self, table):
+        self.table = table
+
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        neighbors = self.table.lookup(pid, k - 1) or []
+        return [pid] + [id for id, _ in neighbors]
+
+    def params(self) -> dict:
+        return {'path': self.table.path, 'k': self.table.k}
+
+    def close(self) -> None:
+        self.table.close()
+
+
+class VCoreBackend(SearchBackend):
+    """ The cosmosSearch aggregation of the search_player_like function of cosmos_vcore/main.py. """
+    name = 'vcore'
+
+    def __init__(self, conn_string: str, dbname='dev', cname='baseball_players'):
+        self.dbname, self.cname = dbname, cname
+        self.mongo = Mongo({'conn_string': conn_string})
+        self.mongo.set_db(dbname)
+        self.mongo.set_coll(cname)
+
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        cosmos_search = {'vector': vector.tolist(), 'path': 'embeddings', 'k': k}
+        pipeline = [
+            {'$search': {'cosmosSearch': cosmos_search, 'returnStoredSource': True}},
+            {'$project': {'_id': 0, 'playerID': 1}}]
+        return [doc['playerID'] for doc in self.mongo.aggregate(pipeline)]
+
+    def params(self) -> dict:
+        return {'dbname': self.dbname, 'cname': self.cname}
+
+    def close(self) -> None:
+        self.mongo.client().close()
+
+
+class PGBackend(SearchBackend):
+    """ The pgvector query of the search_similar_baseball_players function of cosmos_pg/main.py. """
+    name = 'pg'
+
+    def __init__(self, conn_string: str, dbname: str):
+        # psycopg2 is in the cosmos_pg virtual environment, but not in this one
+        import psycopg2
+        self.dbname = dbname
+        self.conn = psycopg2.connect(conn_string)
+        self.cursor = self.conn.cursor()
+
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        sql = 'select player_id from players order by embeddings <-> %s limit %s'
+        self.cursor.execute(sql, (str(vector.tolist()), k))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    def params(self) -> dict:
+        return {'dbname': self.dbname}
+
+    def close(self) -> None:
+        self.cursor.close()
+        self.conn.close()
+
+
+class CogSearchBackend(SearchBackend):
+    """ The vector query of the vector_search_like function of cognitive_search/cogsearch_main.py. """
+    name = 'cogsearch'
+
+    def __init__(self, client, index_name='baseballplayers'):
+        self.index_name = index_name
+        self.url = client.search_index_url(index_name)
+        self.headers = client.query_headers
+        self.session = requests.Session()
+
+    def search(self, pid: str, vector: np.ndarray, k: int) -> list[str]:
+        # not ordered by playerID, as in vector_search_like, so the results are in score order
+        search_params = {}
+        search_params['select'] = 'playerID'
+        search_params['vectors'] = [{'value': vector.tolist(), 'fields': 'embeddings', 'k': k}]
+        r = self.session.post(url=self.url, headers=self.headers, json=search_params)
+        r.raise_for_status()
+        return [doc['playerID'] for doc in r.json()['value']][:k]
+
+    def params(self) -> dict:
+        return {'index_name': self.index_name, 'url': self.url}
+
+    def close(self) -> None:
+        self.session.close()
+
+
+class SearchBenchmark():
+
+    def __init__(self, exact_index, pids: list[str], k=10, warmup=5):
+        self.exact_index = exact_index
+        self.k = k
+        self.warmup = warmup
+        self.pids = [pid for pid in pids if exact_index.row(pid) is not None]
+        self.missing = [pid for pid in pids if exact_index.row(pid) is None]
+        self.rows = np.array([exact_index.row(pid) for pid in self.pids], dtype=np.int64)
+        truth, _ = exact_index.search(exact_index.matrix[self.rows], k)
+        self.truth = [[exact_index.ids[idx] for idx in row] for row in truth.tolist()]
+
+    def run(self, backend: SearchBackend, vectors: np.ndarray) -> dict:
+        """
+        Search for each of the query players with the given backend, using the
+        given query vectors, one per query player, and return the summary and
+        the per-query recall, nDCG, and latency.
+        """
+        for pid, vector in list(zip(self.pids, vectors))[:self.warmup]:
+            try:
+                backend.search(pid, vector, self.k)
+            except Exception:
+                pass
+        queries, latencies, errors = [], [], []
+        for pid, vector, truth in zip(self.pids, vectors, self.truth):
+            t1 = time.perf_counter()
+            try:
+                found = backend.search(pid, vector, self.k)
+            except Exception as e:
+                errors.append({'pid': pid, 'error': str(e)})
+                continue
+            seconds = time.perf_counter() - t1
+            latencies.append(seconds)
+            query = {}
+            query['pid'] = pid
+            query['recall_at_k'] = recall(found, truth, self.k)
+            query['ndcg_at_k'] = ndcg(found, truth, self.k)
+            query['ms'] = seconds * 1000.0
+            query['results'] = found
+            queries.append(query)
+
+        result = {}
+        result['backend'] = backend.name
+        result['params'] = backend.params()
+        result['k'] = self.k
+        result['queries'] = len(queries)
+        result['errors'] = len(errors)
+        if len(queries) > 0:
+            result['recall_at_k'] = float(np.mean([q['recall_at_k'] for q in queries]))
+            result['ndcg_at_k'] = float(np.mean([q['ndcg_at_k'] for q in queries]))
+            result['queries_per_sec'] = len(latencies) / sum(latencies)
+            result['latency'] = latency_summary(latencies)
+        result['error_details'] = errors[:10]
+        result['per_query'] = queries
+        return result
+
+
+def recall(found: list[str], truth: list[str], k: int) -> float:
+    return len(set(found[:k]) & set(truth[:k])) / k
+
+def ndcg(found: list[str], truth: list[str], k: int) -> float:
+    gains = {pid: k - rank for rank, pid in enumerate(truth[:k])}
+    dcg = sum(gains.get(pid, 0) / math.log2(rank + 2) for rank, pid in enumerate(found[:k]))
+    ideal = sum((k - rank) / math.log2(rank + 2) for rank in range(k))
+    return dcg / ideal
+
+def latency_summary(seconds: list[float]) -> dict:
+    """ Return the mean, p50, p95, and p99 of the given latencies, in milliseconds. """
+    ms = np.asarray(seconds) * 1000.0
+    return {'mean_ms': float(ms.mean()), 'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99))}
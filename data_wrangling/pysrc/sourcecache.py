@@ -0,0 +1,72 @@
+"""
+Module sourcecache.py - a columnar Arrow IPC cache of parsed source tables.
+
+Each parsed and typed source csv file is saved as an uncompressed Arrow IPC
+(feather v2) file, named for the sha256 of the csv bytes and of the schema
+it was parsed with.  Later reads memory-map the Arrow file instead of
+parsing the csv again; a changed csv or schema has a different key, so its
+stale cache file is simply replaced.
+
+Usage:  from pysrc.sourcecache import SourceCache
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+class SourceCache():
+
+    def __init__(self, cache_dir: str, verbose=False):
+        self.cache_dir = cache_dir
+        self.verbose = verbose
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, infile: str, schema: dict, parser) -> pd.DataFrame:
+        """
+        Return the DataFrame for the given csv file and schema, from the cache
+        if present, else by calling parser() and caching its result.
+        """
+        cache_file = self.cache_file(infile, schema)
+        if os.path.isfile(cache_file):
+            self.hits += 1
+            if self.verbose:
+                print(f'source cache hit: {infile} -> {cache_file}')
+            table = feather.read_table(cache_file, memory_map=True)
+            return table.to_pandas()
+
+        self.misses += 1
+        df = parser()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.remove_stale(infile, cache_file)
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        feather.write_feather(df, tmp_file, compression='uncompressed')
+        os.replace(tmp_file, cache_file)
+        if self.verbose:
+            print(f'source cache miss: {infile} -> {cache_file}')
+        return df
+
+    def cache_file(self, infile: str, schema: dict) -> str:
+        h = hashlib.sha256()
+        with open(file=infile, mode='rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                h.update(chunk)
+        h.update(json.dumps(schema, sort_keys=True).encode('utf-8'))
+        h.update(pa.__version__.encode('utf-8'))
+        basename = os.path.basename(infile).split('.')[0]
+        return os.path.join(self.cache_dir, f'{basename}-{h.hexdigest()[:24]}.arrow')
+
+    def remove_stale(self, infile: str, current_file: str) -> None:
+        """ Delete the cache files of previous versions of the given csv file. """
+        if not os.path.isdir(self.cache_dir):
+            return
+        prefix = os.path.basename(infile).split('.')[0] + '-'
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.startswith(prefix) and name.endswith('.arrow') and path != current_file:
+                os.remove(path)
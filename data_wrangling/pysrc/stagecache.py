@@ -0,0 +1,194 @@
+"""
+Module stagecache.py - a make-style dependency graph of wrangling stages.
+
+Each Stage declares its input files, output files, parameters, and source
+modules.  The StageCache fingerprints a stage from the bytes of its inputs,
+its code, and its parameters, and skips the stage when the fingerprint and
+its output files are unchanged since the stage last ran.  A stage's code is
+the source of its function and of the functions of the same module which it
+calls, transitively, and the contents of its source modules, so an edit to
+one stage's code doesn't rerun the others.  Since a stage's
+outputs are the inputs of its downstream stages, a rerun after a small
+change redoes only the stages whose inputs actually changed.
+
+Usage:  from pysrc.stagecache import Stage, StageCache
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import time
+
+
+class Stage():
+    """
+    A named unit of work; func is called with no arguments and is expected
+    to (re)write all of the given output files.  sources are the paths of
+    the other modules whose code the stage depends on.
+    """
+    def __init__(self, name: str, func, inputs: list[str], outputs: list[str], params: dict = None,
+                 sources: list[str] = None):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params if params is not None else {}
+        self.sources = sources if sources is not None else []
+
+
+class StageCache():
+    """
+    Persists the fingerprint and output file hashes of each completed stage
+    in a JSON state file, and runs a graph of stages in dependency order.
+    """
+    def __init__(self, state_file: str, code_version: str):
+        self.state_file = state_file
+        self.code_version = code_version
+        self.state = {}
+        if os.path.isfile(state_file):
+            with open(file=state_file, encoding='utf-8', mode='rt') as file:
+                self.state = json.loads(file.read())
+
+    @classmethod
+    def file_sha256(cls, path: str) -> str | None:
+        """ Return the sha256 hex digest of the given file, or None if absent. """
+        if not os.path.isfile(path):
+            return None
+        h = hashlib.sha256()
+        with open(file=path, mode='rb') as file:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @classmethod
+    def sources_sha256(cls, paths: list[str]) -> str:
+        """ Return a code version string from the contents of the given source files. """
+        h = hashlib.sha256()
+        for path in paths:
+            h.update(str(cls.file_sha256(path)).encode('utf-8'))
+        return h.hexdigest()
+
+    @classmethod
+    def func_sources(cls, func) -> list[str]:
+        """
+        Return the source of the given function and of the functions of its
+        module which it calls, transitively, ordered by function name.
+        """
+        funcs, todo = {}, [func]
+        while len(todo) > 0:
+            f = todo.pop()
+            if f.__name__ in funcs:
+                continue
+            funcs[f.__name__] = f
+            codes = [f.__code__]
+            while len(codes) > 0:
+                code = codes.pop()
+                codes.extend(c for c in code.co_consts if inspect.iscode(c))
+                for name in code.co_names:
+                    g = f.__globals__.get(name)
+                    if inspect.isfunction(g) and g.__module__ == func.__module__:
+                        todo.append(g)
+        return [inspect.getsource(funcs[name]) for name in sorted(funcs.keys())]
+
+    def code_sha256(self, stage: Stage) -> str:
+        """ Return the hash of the stage's functions, its source modules, and the code version. """
+        h = hashlib.sha256()
+        h.update(self.code_version.encode('utf-8'))
+        for source in self.func_sources(stage.func):
+            h.update(source.encode('utf-8'))
+        h.update(self.sources_sha256(stage.sources).encode('utf-8'))
+        return h.hexdigest()
+
+    def fingerprint(self, stage: Stage) -> str:
+        h = hashlib.sha256()
+        h.update(stage.name.encode('utf-8'))
+        h.update(self.code_sha256(stage).encode('utf-8'))
+        h.update(json.dumps(stage.params, sort_keys=True).encode('utf-8'))
+        for path in stage.inputs:
+            h.update(path.encode('utf-8'))
+            h.update(str(self.file_sha256(path)).encode('utf-8'))
+        return h.hexdigest()
+
+    def is_current(self, stage: Stage, fingerprint: str) -> bool:
+        """
+        Return True if the stage last ran with the given fingerprint and its
+        output files still have the content that run produced.
+        """
+        entry = self.state.get(stage.name)
+        if entry is None or entry['fingerprint'] != fingerprint:
+            return False
+        for path in stage.outputs:
+            if self.file_sha256(path) != entry['outputs'].get(path):
+                return False
+        return True
+
+    def record(self, stage: Stage, fingerprint: str) -> None:
+        entry = {}
+        entry['fingerprint'] = fingerprint
+        entry['outputs'] = {path: self.file_sha256(path) for path in stage.outputs}
+        entry['epoch'] = time.time()
+        self.state[stage.name] = entry
+        self.save()
+
+    def save(self) -> None:
+        state_dir = os.path.dirname(self.state_file)
+        if len(state_dir) > 0:
+            os.makedirs(state_dir, exist_ok=True)
+        with open(file=self.state_file, encoding='utf-8', mode='w') as file:
+            file.write(json.dumps(self.state, sort_keys=False, indent=2))
+
+    @classmethod
+    def ordered(cls, stages: list[Stage]) -> list[Stage]:
+        """
+        Return the given stages in dependency order, where a stage depends on
+        every stage that produces one of its inputs.
+        """
+        producers = {}
+        for stage in stages:
+            for path in stage.outputs:
+                producers[path] = stage.name
+        by_name = {stage.name: stage for stage in stages}
+        ordered, visiting, done = [], set(), set()
+
+        def visit(stage):
+            if stage.name in done:
+                return
+            if stage.name in visiting:
+                raise ValueError(f'stage dependency cycle at: {stage.name}')
+            visiting.add(stage.name)
+            for path in stage.inputs:
+                if path in producers and producers[path] != stage.name:
+                    visit(by_name[producers[path]])
+            visiting.discard(stage.name)
+            done.add(stage.name)
+            ordered.append(stage)
+
+        for stage in stages:
+            visit(stage)
+        return ordered
+
+    def run(self, stages: list[Stage], force=False, dry_run=False) -> list[dict]:
+        """
+        Run each stage that is not current, in dependency order, and return
+        a list of {stage, status, seconds} dicts.  With dry_run, only report
+        which stages would run; downstream stages of a stale stage are
+        reported as stale since their inputs will change.
+        """
+        results, stale_outputs = [], set()
+        for stage in self.ordered(stages):
+            fingerprint = self.fingerprint(stage)
+            upstream_stale = any(path in stale_outputs for path in stage.inputs)
+            if not force and not upstream_stale and self.is_current(stage, fingerprint):
+                results.append({'stage': stage.name, 'status': 'skipped', 'seconds': 0.0})
+                continue
+            if dry_run:
+                stale_outputs.update(stage.outputs)
+                results.append({'stage': stage.name, 'status': 'stale', 'seconds': 0.0})
+                continue
+            t1 = time.perf_counter()
+            stage.func()
+            seconds = time.perf_counter() - t1
+            self.record(stage, self.fingerprint(stage))
+            results.append({'stage': stage.name, 'status': 'ran', 'seconds': seconds})
+        return results
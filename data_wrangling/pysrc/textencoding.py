@@ -0,0 +1,223 @@
+"""
+Module textencoding.py - a registry of embeddings_str text-encoding algorithms.
+
+Each algorithm is a function, registered by name, which is given the list of
+player documents and returns their embeddings_str values in the same order.
+The algorithms build each output word for all players at once, as a column,
+and then join the columns of each player; the value-to-word conversions are
+numpy array operations rather than per-value function calls.
+
+A player whose document lacks a value an algorithm requires gets an empty
+embeddings_str, and a player without a category gets None.  An optional
+binned or floating value that is absent contributes an empty word.
+
+Usage:
+  from pysrc.textencoding import TextEncodings
+  strings = TextEncodings.encode('binned-text', players)
+"""
+
+import numpy as np
+import pandas as pd
+
+MISSING = object()
+
+
+class TextEncodings():
+
+    registry = {}
+
+    @classmethod
+    def register(cls, name: str):
+        """ Decorator which registers the decorated function as the named algorithm. """
+        def decorator(func):
+            cls.registry[name] = func
+            return func
+        return decorator
+
+    @classmethod
+    def names(cls) -> list[str]:
+        return sorted(cls.registry.keys())
+
+    @classmethod
+    def encode(cls, name: str, players: list[dict]) -> list:
+        if name not in cls.registry:
+            raise ValueError(f'unknown text encoding: {name}, registered: {cls.names()}')
+        return cls.registry[name](players)
+
+
+def lookup(values: list, *keys) -> list:
+    """ Return the value at the given key path of each dict, or MISSING if absent. """
+    results = []
+    for value in values:
+        for key in keys:
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            else:
+                value = MISSING
+                break
+        results.append(value)
+    return results
+
+def numeric_array(values: list) -> np.ndarray:
+    """ Return the values as a float64 array, with nan for non-numeric values. """
+    series = pd.Series([None if v is MISSING else v for v in values], dtype=object)
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=np.float64)
+
+def text_words(label: str, values: list) -> list[str]:
+    """ For label 'bats' and value 'R' return word 'bats_r'. """
+    return [f'{label}_{str(v).strip()}'.lower() for v in values]
+
+def floating_words(label: str, values: list, multiplier: int) -> list[str]:
+    """
+    For label 'era', value 4.27299703264095, and multiplier 1000 return word
+    'era_4273'.  The product is rounded half-to-even, as round() does.  Values
+    which are not finite numbers yield an empty word.
+    """
+    scaled = np.rint(numeric_array(values) * float(multiplier))
+    valid = np.isfinite(scaled)
+    ints = np.where(valid, scaled, 0).astype(np.int64).tolist()
+    prefix = f'{label}_'.lower()
+    return [f'{prefix}{i}' if ok else '' for i, ok in zip(ints, valid.tolist())]
+
+def binned_words(label: str, values: list, bin_factor: int) -> list[str]:
+    """
+    For label 'so_pct', value 0.22576361221779548, and bin_factor 100 return
+    word 'so_pct_23'.  The rounded value is clipped to the tiers 0..bin_factor-2,
+    with '?' below tier 0 and '??' for a value that is not a finite number.
+    An absent value yields an empty word.
+    """
+    present = np.array([v is not MISSING for v in values], dtype=bool)
+    scaled = np.rint(numeric_array(values) * float(bin_factor))
+    valid = np.isfinite(scaled)
+    tiers = np.minimum(np.where(valid, scaled, 0), bin_factor - 2).astype(np.int64)
+    prefix = f'{label}_'.lower()
+    words = np.array([f'{prefix}{t}' for t in tiers.tolist()], dtype=object)
+    words[valid & (scaled < 0)] = f'{prefix}?'
+    words[~valid] = f'{prefix}??'
+    words[~present] = ''
+    return words.tolist()
+
+def raw_words(values: list) -> list[str]:
+    return [str(v) for v in values]
+
+def joined(players: list[dict], columns: list[list[str]], required: list[list]) -> list[str]:
+    """
+    Join the word columns of each player with spaces, or return an empty
+    string for the players missing any of the required values.
+    """
+    complete = np.ones(len(players), dtype=bool)
+    for values in required:
+        complete &= np.array([v is not MISSING for v in values], dtype=bool)
+    return [' '.join(words) if ok else '' for words, ok in zip(zip(*columns), complete.tolist())]
+
+def encode_by_category(players: list[dict], encode_pitchers, encode_fielders) -> list:
+    """
+    Encode the pitchers and the other players as two groups, since their
+    words differ, and return the strings in the order of the given players.
+    """
+    results = [None] * len(players)
+    categories = lookup(players, 'category')
+    pitcher_idx = [i for i, c in enumerate(categories) if c == 'pitcher']
+    fielder_idx = [i for i, c in enumerate(categories) if c is not MISSING and c != 'pitcher']
+    for indexes, encoder in ((pitcher_idx, encode_pitchers), (fielder_idx, encode_fielders)):
+        if len(indexes) > 0:
+            group = [players[i] for i in indexes]
+            for i, s in zip(indexes, encoder(group)):
+                results[i] = s
+    return results
+
+def common_columns(players: list[dict]) -> tuple[list, list]:
+    category = lookup(players, 'category')
+    position = lookup(players, 'primary_position')
+    total_games = lookup(players, 'teams', 'total_games')
+    bats = lookup(players, 'bats')
+    throws = lookup(players, 'throws')
+    columns = [
+        raw_words(category),
+        text_words('primary_position', position),
+        text_words('total_games', total_games),
+        text_words('bats', bats),
+        text_words('throws', throws)]
+    return columns, [category, position, total_games, bats, throws]
+
+
+@TextEncodings.register('binned-text')
+def binned_text(players: list[dict]) -> list:
+    return encode_by_category(players, binned_text_pitchers, binned_text_fielders)
+
+def binned_text_pitchers(players: list[dict]) -> list[str]:
+    columns, required = common_columns(players)
+    wins = lookup(players, 'pitching', 'W')
+    losses = lookup(players, 'pitching', 'L')
+    calculated = lookup(players, 'pitching', 'calculated')
+    full_games = lookup(calculated, 'full_games_pitched_equiv')
+    era = lookup(calculated, 'era')
+    columns.append(text_words('wins', wins))
+    columns.append(text_words('losses', losses))
+    columns.append(floating_words('full_games_pitched_equiv', full_games, 1))
+    columns.append(floating_words('era', era, 1000))
+    for stat, bin_factor in (
+            ('opp_batting_avg', 1000), ('so_pct', 1000), ('bb_pct', 1000),
+            ('hbp_pct', 1000), ('hr_pct', 1000), ('win_pct', 100),
+            ('sho_pct', 100), ('cg_pct', 100)):
+        columns.append(binned_words(stat, lookup(calculated, stat), bin_factor))
+    required.extend([wins, losses, calculated, full_games, era])
+    return joined(players, columns, required)
+
+def binned_text_fielders(players: list[dict]) -> list[str]:
+    columns, required = common_columns(players)
+    hits = lookup(players, 'batting', 'H')
+    hr = lookup(players, 'batting', 'HR')
+    calculated = lookup(players, 'batting', 'calculated')
+    columns.append(text_words('hits', hits))
+    columns.append(text_words('hr', hr))
+    for stat in (
+            'batting_avg', 'runs_per_ab', '2b_avg', '3b_avg', 'hr_avg',
+            'rbi_avg', 'bb_avg', 'so_avg', 'ibb_avg', 'hbp_avg'):
+        columns.append(binned_words(stat, lookup(calculated, stat), 1000))
+    required.extend([hits, hr, calculated])
+    return joined(players, columns, required)
+
+
+@TextEncodings.register('raw-numbers')
+def raw_numbers(players: list[dict]) -> list:
+    return encode_by_category(players, raw_numbers_pitchers, raw_numbers_fielders)
+
+def raw_numbers_common_columns(players: list[dict], flag: str) -> tuple[list, list]:
+    category = lookup(players, 'category')
+    position = lookup(players, 'primary_position')
+    total_games = lookup(players, 'teams', 'total_games')
+    bats = [v if isinstance(v, str) else MISSING for v in lookup(players, 'bats')]
+    throws = [v if isinstance(v, str) else MISSING for v in lookup(players, 'throws')]
+    columns = [
+        raw_words(category),
+        [flag] * len(players),
+        raw_words(position),
+        raw_words(total_games),
+        [str(v).lower() for v in bats],
+        [str(v).lower() for v in throws]]
+    return columns, [category, position, total_games, bats, throws]
+
+def raw_numbers_pitchers(players: list[dict]) -> list[str]:
+    columns, required = raw_numbers_common_columns(players, '0')
+    calculated = lookup(players, 'pitching', 'calculated')
+    stats = [lookup(players, 'pitching', 'W'), lookup(players, 'pitching', 'L')]
+    for stat in (
+            'full_games_pitched_equiv', 'era', 'opp_batting_avg', 'so_pct', 'bb_pct',
+            'hbp_pct', 'hr_pct', 'win_pct', 'sho_pct', 'cg_pct'):
+        stats.append(lookup(calculated, stat))
+    columns.extend([raw_words(values) for values in stats])
+    required.extend(stats)
+    return joined(players, columns, required)
+
+def raw_numbers_fielders(players: list[dict]) -> list[str]:
+    columns, required = raw_numbers_common_columns(players, '1')
+    calculated = lookup(players, 'batting', 'calculated')
+    stats = [lookup(players, 'batting', 'H'), lookup(players, 'batting', 'HR')]
+    for stat in (
+            'batting_avg', 'runs_per_ab', '2b_avg', '3b_avg', 'hr_avg',
+            'rbi_avg', 'bb_avg', 'so_avg', 'ibb_avg', 'hbp_avg'):
+        stats.append(lookup(calculated, stat))
+    columns.extend([raw_words(values) for values in stats])
+    required.extend(stats)
+    return joined(players, columns, required)
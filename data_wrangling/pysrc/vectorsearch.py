@@ -0,0 +1,81 @@
+"""
+Module vectorsearch.py - local, in-memory exact k-nearest-neighbor search.
+
+The ExactIndex holds all of the vectors in one contiguous float32 matrix,
+normalized to unit length, so the cosine similarity of a query with every
+vector is a single matrix-vector product, and the top k are selected with
+argpartition rather than a full sort.  A batch of queries is answered with
+one matrix multiply per chunk of queries.  It needs no database or network,
+and is the ground truth for the approximate indexes.
+
+Usage:
+  from pysrc.vectorsearch import ExactIndex
+  index = ExactIndex.from_store(EmbeddingStore('../data/wrangled/embeddings.f32'))
+  ids, scores = index.search_ids(index.vector('aaronha01'), 10)
+"""
+
+import numpy as np
+
+
+class ExactIndex():
+
+    def __init__(self, matrix: np.ndarray, ids: list[str], normalize=True):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        if normalize:
+            self.matrix = normalized(self.matrix)
+        self.ids = list(ids)
+        self.rows = {id: idx for idx, id in enumerate(self.ids)}
+        self.count, self.dims = self.matrix.shape
+
+    @classmethod
+    def from_store(cls, store) -> 'ExactIndex':
+        """ Return an ExactIndex of the vectors of the given EmbeddingStore. """
+        return ExactIndex(store.matrix, store.ids)
+
+    def row(self, id: str) -> int | None:
+        return self.rows.get(id)
+
+    def vector(self, id: str) -> np.ndarray | None:
+        row = self.rows.get(id)
+        return None if row is None else self.matrix[row]
+
+    def search(self, queries: np.ndarray, k: int, exclude: np.ndarray = None,
+               chunk_queries=256) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return the (queries, k) row indexes and cosine similarities of the k
+        vectors most similar to each query vector, most similar first.  The
+        optional exclude array has a row index per query to leave out of its
+        results, such as the query's own row.
+        """
+        queries = normalized(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+        k = min(k, self.count - (0 if exclude is None else 1))
+        indexes = np.zeros((len(queries), k), dtype=np.int64)
+        scores = np.zeros((len(queries), k), dtype=np.float32)
+        for start in range(0, len(queries), chunk_queries):
+            sims = queries[start:start + chunk_queries] @ self.matrix.T
+            if exclude is not None:
+                sims[np.arange(len(sims)), exclude[start:start + chunk_queries]] = -np.inf
+            top, top_scores = top_k(sims, k)
+            indexes[start:start + len(sims)] = top
+            scores[start:start + len(sims)] = top_scores
+        return indexes, scores
+
+    def search_ids(self, query: np.ndarray, k: int) -> tuple[list[str], list[float]]:
+        """ Return the ids and cosine similarities of the k vectors most similar to the query. """
+        indexes, scores = self.search(query, k)
+        return [self.ids[idx] for idx in indexes[0].tolist()], scores[0].tolist()
+
+
+def normalized(matrix: np.ndarray) -> np.ndarray:
+    """ Return the rows of the given matrix scaled to unit length; zero rows are unchanged. """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1.0)
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Return the column indexes and values of the k highest scores of each row, highest first. """
+    if k <= 0:
+        return np.zeros((len(scores), 0), dtype=np.int64), np.zeros((len(scores), 0), dtype=scores.dtype)
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top_scores = np.take_along_axis(scores, top, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)